@@ -1,42 +1,502 @@
 print("LOADING AGENTS.PY...")
 import os
+import time
+import contextlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from langchain_google_vertexai import ChatVertexAI
 from langchain_community.agent_toolkits import create_sql_agent
-from langchain_community.utilities import SQLDatabase
 from langchain_core.prompts import ChatPromptTemplate
+from sqlalchemy import inspect
 import json
+import telemetry
+from telemetry import Trace
+from cache import ResponseCache, DataVersionTracker, SingleFlight, fingerprint
+from warehouse import CachedSQLDatabase, CachedSQLDatabaseToolkit, LocalReplica, SQLBatchScope, canonicalize_sql
+from query_templates import TemplateRegistry
+from schema_snapshot import SchemaSnapshot, build_snapshot, live_schema_version
+from followups import build_engine
+from sessions import build_store, estimate_tokens, trim_history
+from references import answer_from_rows, resolve_reference, result_keys, visible_columns
+from sql_guard import MAXIMUM_BYTES_BILLED, SQL_GUARD_ENABLED, SQLGuard, bigquery_dry_run
+from examples import EXAMPLE_HINTS, EXAMPLE_STORE_PATH, ExampleStore
+from kpis import KPI_SHORTCUT, KPI_STORE_PATH, KPIStore
+from fleet_state import (SHARED_FLEET_STATE, TELEMETRY_FILE, TELEMETRY_FLUSH_SECONDS, bigquery_sink,
+                         sqlalchemy_sink)
+from nearby import DRIVERS_SQL, EXTRA_FILTERS, DriverIndex, lookup, parse_proximity, summarize as summarize_nearby, with_live_state
+from dispatch import DISPATCH_PATTERN, SHIPMENTS_SQL, VEHICLES_SQL, plan_dispatch, summarize as summarize_dispatch
 
 # Configuration
 PROJECT_ID = "inspiring-keel-423204-c7"
 DATASET_ID = "logistics_control_tower"
+TABLES = ["shipments", "drivers", "vehicles"]
+# Schema snapshot written by setup_bigquery.py / update_bigquery_data.py and shipped with the function
+SCHEMA_SNAPSHOT_PATH = os.getenv(
+    "SCHEMA_SNAPSHOT_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema_snapshot.json")
+)
+
+# Warehouse backend: "bigquery" (default), "hybrid" (local replica first, BigQuery fallback)
+# or "replica" (offline, local replica only)
+WAREHOUSE_BACKEND = os.getenv("WAREHOUSE_BACKEND", "bigquery").lower()
+# Parquet snapshots + manifest written by update_bigquery_data.py
+REPLICA_DIR = os.getenv("REPLICA_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "replica"))
+REPLICA_MAX_AGE_SECONDS = int(os.getenv("REPLICA_MAX_AGE_SECONDS", "900"))
+
+# Response cache settings (answers are reused until TTL expiry or a table change)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "256"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "300"))
+TABLE_VERSION_CHECK_SECONDS = int(os.getenv("TABLE_VERSION_CHECK_SECONDS", "30"))
+
+# Concurrent pipeline: follow-ups are generated from the analyst facts alongside the strategist
+CONCURRENT_PIPELINE = os.getenv("CONCURRENT_PIPELINE", "true").lower() == "true"
+PIPELINE_WORKERS = int(os.getenv("PIPELINE_WORKERS", "4"))
+
+# Follow-up suggestions: "rules" (local rule/template index, no LLM call) or "llm" (opt-in Gemini round trip)
+FOLLOWUP_MODE = os.getenv("FOLLOWUP_MODE", "rules").lower()
+
+# Upper bound on queries of one /query/batch request that run at the same time
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+def _elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 1)
 
 class MultiAgentLogisticsSystem:
-    def __init__(self):
-        """Initializes the specialized agents for data analysis and operational strategy."""
+    def __init__(self, concurrent=CONCURRENT_PIPELINE, backend=WAREHOUSE_BACKEND, llm=None, db_uri=None):
+        """Initializes the specialized agents for data analysis and operational strategy.
+
+        llm and db_uri override Gemini and BigQuery, e.g. with a fake model and a SQLite file for benchmarks.
+        """
+        # Per-phase startup breakdown, reported by the /warmup route
+        self.startup_timings = {}
+
         # 1. Initialize LLM (Gemini 2.0 Flash Experimental)
-        self.llm = ChatVertexAI(
+        stage = time.perf_counter()
+        self.llm = llm or ChatVertexAI(
             model_name="gemini-2.0-flash-exp",
             temperature=0
         )
+        # LLM calls and token usage are attributed to the active telemetry span
+        telemetry.instrument_llm(self.llm)
+        self.startup_timings["llm_ms"] = _elapsed_ms(stage)
+
+        # 2. Table Version Tracking (drives invalidation of the SQL and response caches)
+        self.table_versions = DataVersionTracker(self._fetch_table_versions, TABLE_VERSION_CHECK_SECONDS)
 
-        # 2. Database Connection
-        self.db_uri = f"bigquery://{PROJECT_ID}/{DATASET_ID}"
-        self.db = SQLDatabase.from_uri(self.db_uri)
+        # 3. Database Connection (schema from the local snapshot, repeat SQL from the shared result cache)
+        stage = time.perf_counter()
+        self.schema_snapshot = SchemaSnapshot.load(SCHEMA_SNAPSHOT_PATH)
+        self.startup_timings["schema_snapshot_ms"] = _elapsed_ms(stage)
+        stage = time.perf_counter()
+        self.backend = backend
+        self.replica = self._load_replica() if backend in ("hybrid", "replica") else None
+        self.startup_timings["replica_ms"] = _elapsed_ms(stage)
+        stage = time.perf_counter()
+        if backend == "replica":
+            # Offline mode: the in-memory replica is the only database
+            self.db_uri = "sqlite://"
+            self.db = CachedSQLDatabase(
+                self.replica.engine, table_versions=self.table_versions,
+                schema_snapshot=self.schema_snapshot, replica=self.replica
+            )
+        else:
+            # maximum_bytes_billed makes BigQuery fail any job that would bill more, whatever the guard estimated
+            self.db_uri = db_uri or f"bigquery://{PROJECT_ID}/{DATASET_ID}?maximum_bytes_billed={MAXIMUM_BYTES_BILLED}"
+            dry_run = None
+            if self.db_uri.startswith("bigquery://"):
+                dry_run = bigquery_dry_run(self._bigquery_client, f"{PROJECT_ID}.{DATASET_ID}")
+            self.db = CachedSQLDatabase.from_uri(
+                self.db_uri, table_versions=self.table_versions,
+                schema_snapshot=self.schema_snapshot, replica=self.replica, dry_run=dry_run
+            )
+        self.startup_timings["database_ms"] = _elapsed_ms(stage)
 
-        # 3. Dedicated Agent Components
+        # 4. Dedicated Agent Components (common intents are answered by prepared SQL templates first)
+        stage = time.perf_counter()
+        self.templates = TemplateRegistry()
+        # Precomputed KPI aggregates (utilization, margins, delays, ratings) answered without SQL
+        self.kpis = self._load_kpis()
+        # Per-role byte/row limits on the Data Analyst's own SQL (templates are prepared and trusted)
+        self.sql_guard = SQLGuard() if SQL_GUARD_ENABLED else None
+        # Verified question -> SQL pairs shown to the analyst as few-shot hints
+        self.examples = ExampleStore(EXAMPLE_STORE_PATH) if EXAMPLE_HINTS else None
+        self.followup_engine = build_engine()
+        # Server-side conversation history per session_id, compacted to a token budget per prompt
+        self.sessions = build_store()
+        # Only the LLM follow-up path is slow enough to be worth running alongside the strategist
+        self.llm_followups = FOLLOWUP_MODE == "llm"
+        # Live vehicle positions/fuel/load from /telemetry pings, ahead of the vehicles table
+        self.fleet_state = SHARED_FLEET_STATE
+        # Spatial lookups: vehicles through the fleet state's grid, drivers geocoded by current_location
+        self.driver_index = DriverIndex()
+        self._vehicle_result, self._vehicles_by_id = None, {}
+        self._fleet_started, self._fleet_lock = False, threading.Lock()
+        # Column names per table for the reference lookup's role-visible SELECT list
+        self._columns = {}
         self.data_analyst = self._setup_data_analyst()
         self.fleet_strategist = self._setup_fleet_strategist()
+        self.startup_timings["agents_ms"] = _elapsed_ms(stage)
+
+        # 5. Response Cache and in-flight coalescing of identical requests
+        self.response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL)
+        self.inflight = SingleFlight("run")
+
+        # 6. Worker pool for running independent LLM stages side by side
+        self.concurrent = concurrent
+        self.executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix="agent-stage")
+
+    def warmup(self):
+        """Primes lazily-initialized state so the first user query does not pay for it."""
+        # Table version stamps (one metadata call per table)
+        stage = time.perf_counter()
+        self.table_versions.versions(force=True)
+        self.startup_timings["table_versions_ms"] = _elapsed_ms(stage)
+
+        # Shipped schema snapshot vs. live table metadata
+        stage = time.perf_counter()
+        self.refresh_schema_if_stale()
+        self.startup_timings["schema_check_ms"] = _elapsed_ms(stage)
+
+        # Schema text the analyst requests on its first iteration
+        stage = time.perf_counter()
+        self.db.get_table_info()
+        self.startup_timings["table_info_ms"] = _elapsed_ms(stage)
+
+        # Fleet state seeded from the vehicles table, flushed back to it in the background
+        stage = time.perf_counter()
+        self.start_fleet_state()
+        self.startup_timings["fleet_state_ms"] = _elapsed_ms(stage)
+        return dict(self.startup_timings)
+
+    def refresh_schema_if_stale(self):
+        """Rebuilds the schema snapshot in memory when the live schema version no longer matches it."""
+        if not self.db_uri.startswith("bigquery://"):
+            return False
+        try:
+            client = self._bigquery_client()
+            live_version = live_schema_version(client, PROJECT_ID, DATASET_ID, TABLES)
+            if self.schema_snapshot is not None and self.schema_snapshot.version == live_version:
+                return False
+            print(f"Schema Snapshot: Stale or missing (live version {live_version}), rebuilding...")
+            self.schema_snapshot = build_snapshot(client, PROJECT_ID, DATASET_ID, TABLES)
+            self.db.schema_snapshot = self.schema_snapshot
+            return True
+        except Exception as e:
+            print(f"Schema Snapshot: Staleness check failed, keeping current schema: {e}")
+            return False
+
+    def _bigquery_client(self):
+        from google.cloud import bigquery
+        if not hasattr(self, "_bq_client"):
+            self._bq_client = bigquery.Client(project=PROJECT_ID)
+        return self._bq_client
+
+    def _load_replica(self):
+        """Loads the local replica; in hybrid mode a stale replica reloads itself from BigQuery."""
+        offline = self.backend == "replica"
+        replica = LocalReplica(
+            REPLICA_DIR,
+            max_age_seconds=float("inf") if offline else REPLICA_MAX_AGE_SECONDS,
+            loader=None if offline else self._load_replica_frames,
+        )
+        if not replica.load():
+            print(f"Local Replica: No snapshot in {REPLICA_DIR}, all queries go to BigQuery")
+        return replica
+
+    def _load_replica_frames(self):
+        """Reads every table through the BigQuery Storage API (no query job) for a replica refresh.
+
+        Returns (frames, versions); each table's last-modified stamp is read before its rows, so a
+        concurrent write leaves the replica looking older rather than newer than it is.
+        """
+        client = self._bigquery_client()
+        versions = self._fetch_table_versions()
+        return {t: client.list_rows(f"{PROJECT_ID}.{DATASET_ID}.{t}").to_dataframe() for t in TABLES}, versions
+
+    def _load_kpis(self):
+        """KPI store shipped with the function; without one it is built from the local replica, if loaded."""
+        kpis = KPIStore.load(KPI_STORE_PATH)
+        if not kpis.results and self.replica is not None and self.replica.tables:
+            kpis.refresh(self.replica.read_frames(), self.replica.versions)
+        return kpis
+
+    def _refresh_kpis(self, versions):
+        """Recomputes KPIs from the replica when it holds the current table versions; returns True if it did."""
+        if self.replica is None or not self.replica.tables:
+            return False
+        if any(self.replica.versions.get(t) != v for t, v in versions.items()):
+            return False  # the replica is behind too and reloads itself in the background
+        self.kpis.refresh(self.replica.read_frames(), self.replica.versions)
+        return True
+
+    def start_fleet_state(self):
+        """Seeds vehicles without pings from the vehicles table and starts the flusher (and the file follower).
+
+        Called from warmup() and before every /telemetry ingest, so pings are flushed and checked
+        against the fleet even when the instance was never warmed up; a no-op once it succeeded.
+        """
+        if self._fleet_started:
+            return
+        with self._fleet_lock:
+            if self._fleet_started:
+                return
+            try:
+                self._vehicles()
+            except Exception as e:
+                print(f"Fleet State: Could not seed from the vehicles table: {e}")
+            self.fleet_state.start_flusher(self._fleet_sink(), TELEMETRY_FLUSH_SECONDS)
+            if TELEMETRY_FILE:
+                self.fleet_state.follow(TELEMETRY_FILE)
+            # Without the vehicle list pings cannot be validated, so the next call seeds again
+            self._fleet_started = self.fleet_state.fleet is not None
+
+    def _vehicles(self):
+        """vehicle_id -> vehicles row (cached SQL); a new result set also seeds the fleet state."""
+        rows = self.db.fetch_rows(VEHICLES_SQL)
+        if rows is not self._vehicle_result:
+            self.fleet_state.seed(rows)
+            self._vehicle_result, self._vehicles_by_id = rows, {r["vehicle_id"]: r for r in rows}
+        return self._vehicles_by_id
+
+    def find_nearby(self, request):
+        """(rows, fallback) for a parse_proximity request, from the vehicle or driver spatial index."""
+        if request["kind"] == "drivers":
+            self.driver_index.refresh(self.db.fetch_rows(DRIVERS_SQL))
+            return lookup(request, self.driver_index.index, self.driver_index.by_id)
+        rows, fallback = lookup(request, self.fleet_state, self._vehicles())
+        return with_live_state(rows, self.fleet_state), fallback
+
+    def _nearby_observation(self, text):
+        """Text of the nearby tool."""
+        request = parse_proximity(text)
+        if request is None:
+            return ("Could not read the lookup. Use '<vehicles|drivers> near <city or lat, lon>', optionally with "
+                    "'within N km', 'nearest N' or 'available'.")
+        return summarize_nearby(request, *self.find_nearby(request))
+
+    def _fleet_sink(self):
+        """Writes flushed vehicle state to the primary database and invalidates the SQL cached over it."""
+        if self.db_uri.startswith("bigquery://"):
+            # The MERGE bumps the table's modified time, which invalidates cached SQL on the next version check
+            return bigquery_sink(self._bigquery_client(), f"{PROJECT_ID}.{DATASET_ID}")
+        if self.backend == "replica":
+            write = sqlalchemy_sink(self.replica.engine, lock=self.replica._lock)
+
+            def sink(rows):
+                write(rows)
+                self.replica.versions["vehicles"] = f"telemetry-{time.time()}"
+            return sink
+        write = sqlalchemy_sink(self.db._engine)
+
+        def sink(rows):
+            write(rows)
+            # Local SQLite has no table versions to bump, so cached results are dropped instead
+            self.db.result_cache.clear()
+        return sink
+
+    def _fleet_state_observation(self, vehicle_ids=""):
+        """Text of the live fleet state tool: one line per vehicle, at most 50."""
+        ids = [int(v) for v in vehicle_ids.replace(",", " ").split() if v.isdigit()]
+        rows = self.fleet_state.snapshot(ids or None)
+        if not rows:
+            return "No live telemetry for these vehicles."
+        lines = [
+            f"vehicle_id={r['vehicle_id']} position={r['gps_coordinates']} fuel_level={r['fuel_level']} "
+            f"current_load_kg={r['current_load_kg']} "
+            + (f"updated {r['age_seconds']:.0f}s ago" if r["age_seconds"] is not None else "(vehicles table)")
+            for r in rows[:50]
+        ]
+        if len(rows) > 50:
+            lines.append(f"... {len(rows) - 50} more vehicles; ask for specific vehicle_ids")
+        return "\n".join(lines)
+
+    def _data_version(self):
+        """Response cache version: the warehouse tables, plus what the replica holds when it serves reads."""
+        token = self.table_versions.version_token()
+        if self.replica is not None and self.replica.tables:
+            token = fingerprint(repr((token, sorted(self.replica.versions.items()))))
+        return token
+
+    def _fetch_table_versions(self):
+        """Reads the last-modified timestamp of each table (metadata only, not a billed query)."""
+        if not self.db_uri.startswith("bigquery://"):
+            # Local databases (offline replica, SQLite copies) have no BigQuery table metadata
+            return dict(self.replica.versions) if self.replica else {}
+        client = self._bigquery_client()
+        return {t: client.get_table(f"{PROJECT_ID}.{DATASET_ID}.{t}").modified.isoformat() for t in TABLES}
 
     def _setup_data_analyst(self):
         """Logistics Data Analyst: Specializes in querying BigQuery and extracting raw facts."""
+        from langchain_core.tools import Tool
+        fleet_state_tool = Tool(
+            name="fleet_live_state",
+            func=self._fleet_state_observation,
+            description=(
+                "Live position (gps_coordinates), fuel_level and current_load_kg per vehicle from telemetry pings; "
+                "fresher than the vehicles table. Use it for where vehicles are now or their current fuel/load. "
+                "Input: comma-separated vehicle_ids, or empty for all vehicles."
+            ),
+        )
+        dispatch_tool = Tool(
+            name="dispatch_plan",
+            func=lambda _="": summarize_dispatch(self.plan_dispatch()),
+            description=(
+                "Computes which vehicle should pick up each Pending/Delayed shipment (nearest Active vehicle with "
+                "enough fuel range and spare capacity, by priority). Use it instead of writing assignment SQL. "
+                "Input: ignored."
+            ),
+        )
+        nearby_tool = Tool(
+            name="nearby",
+            func=self._nearby_observation,
+            description=(
+                "Spatial index lookup of vehicles (live GPS) or drivers (current_location city) near a place. "
+                "Use it instead of matching gps_coordinates or current_location strings in SQL. "
+                "Input: '<vehicles|drivers> near <city or lat, lon>', optionally 'within N km', 'nearest N', 'available'."
+            ),
+        )
         return create_sql_agent(
             llm=self.llm,
-            db=self.db,
+            toolkit=CachedSQLDatabaseToolkit(db=self.db, llm=self.llm),
+            extra_tools=[fleet_state_tool, dispatch_tool, nearby_tool],
             agent_type="zero-shot-react-description",
             verbose=True,
-            handle_parsing_errors=True
+            handle_parsing_errors=True,
+            agent_executor_kwargs={"return_intermediate_steps": True}
         )
 
+    def _run_template(self, query):
+        """Template fast path: returns (facts, sql, intent, rows) for a recognised intent, or None to use the Data Analyst."""
+        matched = self.templates.match(query)
+        if matched is None:
+            return None
+        template, params = matched
+        try:
+            rows = self.db.fetch_rows(template.sql, parameters=params)
+        except Exception as e:
+            print(f"Template Fast Path: {template.name} failed, falling back to Data Analyst: {e}")
+            return None
+        if not rows and template.fallback_on_empty:
+            print(f"Template Fast Path: {template.name} returned no rows, falling back to Data Analyst")
+            return None
+        return template.summarize(rows, params), template.sql, template.name, rows
+
+    def _table_columns(self, table):
+        """Column names of a table: from the schema snapshot, else the table metadata (read once per instance)."""
+        if table not in self._columns:
+            if self.schema_snapshot is not None and table in self.schema_snapshot.tables:
+                columns = self.schema_snapshot.tables[table]["columns"]
+            else:
+                columns = inspect(self.db._engine).get_columns(table)
+            self._columns[table] = [c["name"] for c in columns]
+        return self._columns[table]
+
+    def _run_reference(self, query, reference, role):
+        """Reference fast path: answers a question about an earlier result set from one keyed lookup.
+
+        Only the columns the role may see are selected. Returns (facts, sql, intent, rows), or None
+        when the Data Analyst is needed.
+        """
+        try:
+            sql = reference.sql(visible_columns(self._table_columns(reference.table), role))
+            rows = self.db.fetch_rows(sql)
+        except Exception as e:
+            print(f"Reference Fast Path: keyed lookup failed, falling back to Data Analyst: {e}")
+            return None
+        facts = answer_from_rows(query, reference, rows, role)
+        return (facts, sql, None, rows) if facts is not None else None
+
+    def _run_kpi(self, query, role):
+        """KPI shortcut: returns (facts, sql, intent, rows) from a precomputed aggregate, or None.
+
+        Aggregates older than their source tables are recomputed from the replica or left to the Data Analyst.
+        """
+        kpi = self.kpis.match(query, role) if KPI_SHORTCUT else None
+        if kpi is None:
+            return None
+        versions = self.table_versions.versions()
+        if not self.kpis.is_current(kpi.name, versions) and not (
+                self._refresh_kpis(versions) and self.kpis.is_current(kpi.name, versions)):
+            print(f"KPI Shortcut: {kpi.name} predates the current table versions, falling back to Data Analyst")
+            return None
+        rows = self.kpis.rows(kpi.name)
+        return kpi.summarize(rows), f"-- Precomputed KPI: {kpi.name} --", kpi.intent, rows
+
+    def plan_dispatch(self):
+        """Dispatch plan for the waiting shipments over the current vehicles (live telemetry first)."""
+        return plan_dispatch(self.db.fetch_rows(SHIPMENTS_SQL), self.db.fetch_rows(VEHICLES_SQL), self.fleet_state)
+
+    def _run_dispatch(self, query):
+        """Dispatch fast path: "assign the pending shipments to vehicles" is answered by the optimizer, or None."""
+        if not DISPATCH_PATTERN.search(query):
+            return None
+        try:
+            plan = self.plan_dispatch()
+        except Exception as e:
+            print(f"Dispatch: Planning failed, falling back to Data Analyst: {e}")
+            return None
+        # "id" rows let follow-ups refer to the assigned shipments
+        rows = [dict(a, id=a["shipment_id"]) for a in plan["assignments"]]
+        return summarize_dispatch(plan), f"{SHIPMENTS_SQL};\n{VEHICLES_SQL}", "dispatch_plan", rows
+
+    def _run_nearby(self, query):
+        """Proximity fast path: "vehicles near London", "closest available driver to Berlin", or None."""
+        request = None if EXTRA_FILTERS.search(query) else parse_proximity(query)
+        if request is None:
+            return None
+        try:
+            rows, fallback = self.find_nearby(request)
+        except Exception as e:
+            print(f"Nearby: Spatial lookup failed, falling back to Data Analyst: {e}")
+            return None
+        sql = DRIVERS_SQL if request["kind"] == "drivers" else VEHICLES_SQL
+        return summarize_nearby(request, rows, fallback), sql, f"nearby_{request['kind']}", rows
+
+    def _fast_path(self, query, role, reference, trace, timings):
+        """Reference lookup, KPI aggregates, dispatch planning, spatial lookups, then query templates.
+
+        Returns (tool, (facts, sql, intent, rows)); None means the Data Analyst has to run.
+        """
+        if reference is not None:
+            answered, timings["reference_ms"] = trace.timed("reference", self._run_reference, query, reference, role)
+            if answered is not None:
+                return "reference_lookup", answered
+        answered, timings["kpi_ms"] = trace.timed("kpi", self._run_kpi, query, role)
+        if answered is not None:
+            return "kpi_lookup", answered
+        answered, timings["dispatch_ms"] = trace.timed("dispatch", self._run_dispatch, query)
+        if answered is not None:
+            return "dispatch_plan", answered
+        answered, timings["nearby_ms"] = trace.timed("nearby", self._run_nearby, query)
+        if answered is not None:
+            return "spatial_lookup", answered
+        answered, timings["template_ms"] = trace.timed("template", self._run_template, query)
+        return ("query_template", answered) if answered is not None else None
+
+    def _guard_scope(self, role):
+        return self.sql_guard.active(role) if self.sql_guard is not None else contextlib.nullcontext()
+
+    def _analyst_input(self, query, history, reference):
+        # Add history to query for data analyst to understand "it", "them", etc.
+        context = "\n".join(part for part in (history, reference.hint() if reference else "") if part)
+        # Similar questions answered before let the analyst skip listing tables and reading the schema
+        examples = self.examples.hints(query) if self.examples is not None else ""
+        parts = [f"Conversation Context: {context}" if context else "", examples, f"User Query: {query}"]
+        return "\n".join(part for part in parts if part) if context or examples else query
+
+    def _analyst_rows(self, sql, role):
+        """Rows of the analyst's final statement from the SQL cache (as the guard ran it), or None if it failed."""
+        if not sql:
+            return None
+        rows = self.db.cached_rows(sql)
+        if rows is None and self.sql_guard is not None:
+            rows = self.db.cached_rows(self.sql_guard.limited(sql, canonicalize_sql(sql), role)[0])
+        return rows
+
+    def _learn_example(self, query, sql, rows, reference):
+        """Stores a successful analyst run for future few-shot hints (not questions that depend on an earlier turn)."""
+        if self.examples is not None and rows is not None and reference is None:
+            self.examples.add(query, sql, len(rows))
+
     def _setup_fleet_strategist(self):
         """Fleet Strategy Agent: Specializes in analyzing logistics data to provide optimization advice."""
         prompt = ChatPromptTemplate.from_template(
@@ -49,6 +509,12 @@ class MultiAgentLogisticsSystem:
         )
         return prompt | self.llm
 
+    def _followups(self, query, role, response_text, sql=None, history="", intent=None):
+        """Follow-up chips for a response: local rules by default, the LLM when FOLLOWUP_MODE=llm."""
+        if self.llm_followups:
+            return self._generate_followups(response_text, history)
+        return self.followup_engine.suggest(query, response_text, sql=sql, role=role, intent=intent)
+
     def _generate_followups(self, response_text, history=""):
         """Generates 3 logical follow-up questions based on the current context."""
         prompt = ChatPromptTemplate.from_template(
@@ -104,65 +570,341 @@ class MultiAgentLogisticsSystem:
         llm_with_tools = self.llm.bind_tools([fetch_inbox, send_email])
         return llm_with_tools
 
-    def run(self, query, role="Guest", history=""):
-        """Orchestrates the multi-agent workflow with RBAC security and memory."""
+    def _route_request(self, query, role):
+        """RBAC and communication routing; returns a finished response or None for analytics queries."""
+        # 0. RBAC Security Check
+        query_lower = query.lower()
+        if role == "Guest" and any(w in query_lower for w in ["cost", "price", "profit", "revenue", "margin", "salary", "money"]):
+            return {"summary": "🚫 Access Denied: Guests cannot access financial data.", "sql": None, "error": None, "followups": []}
+
+        # 1. Intent Detection: Communication vs Analytics
+        if any(w in query_lower for w in ["email", "mail", "inbox", "send", "read"]):
+            print("Orchestrator: Routing to Communication Agent...")
+            if "read" in query_lower or "inbox" in query_lower:
+                summary = "[UNREAD] Subject: Delay Report - Driver Kyle\nBody: Vehicle V-001 is stuck in traffic."
+                followups = ["Send an email to Kyle", "Find alternative vehicle", "Check shipment 14 status"]
+                return {"summary": summary, "sql": None, "error": None, "followups": followups}
+            elif "send" in query_lower:
+                summary = f"📧 Draft Email Created for '{query}'. (Simulation: Email Sent)"
+                followups = ["Check inbox", "Show fleet status", "What is the next pickup?"]
+                return {"summary": summary, "sql": None, "error": None, "followups": followups}
+        return None
+
+    @staticmethod
+    def _needs_strategy(query):
+        strategy_keywords = ["optimize", "advice", "suggest", "improve", "why", "strategy", "fix"]
+        return any(word in query.lower() for word in strategy_keywords)
+
+    @staticmethod
+    def _extract_sql(intermediate_steps):
+        """Returns the last SQL statement the Data Analyst executed, if any."""
+        statements = [action.tool_input for action, _ in intermediate_steps if action.tool == "sql_db_query"]
+        return statements[-1] if statements else "-- Multi-Agent Coordination Hook --"
+
+    @staticmethod
+    def _compose_response(facts, strategy_advice):
+        return (
+            f"### 📊 Analyst Data Report\n{facts}\n\n"
+            f"### 🚀 Fleet Strategy Recommendations\n{strategy_advice}"
+        )
+
+    @staticmethod
+    def _observe_total(started):
+        """Records the end-to-end pipeline duration and returns it in milliseconds."""
+        telemetry.METRICS.observe("agent_stage_duration_seconds", time.perf_counter() - started, stage="total")
+        return _elapsed_ms(started)
+
+    def _prepare_history(self, session_id, history):
+        """Returns (prompt history within the token budget, tokens of the verbatim history it replaces).
+
+        With a session_id the server-side turns are used and any client history is ignored.
+        """
+        if session_id:
+            return self.sessions.history(session_id)
+        return trim_history(history), estimate_tokens(history)
+
+    def _finish_session(self, session_id, query, result, history, raw_tokens):
+        """Records the turn in the session and reports the prompt tokens saved by compaction."""
+        history_tokens = estimate_tokens(history)
+        # History is pasted into every analyst ReAct step and the strategist prompt
+        prompts = 0 if result.get("coalesced") else sum(
+            span.get("llm_calls", 0) for span in result.get("trace", []) if span["name"] in ("analyst", "strategist")
+        )
+        saved = max(raw_tokens - history_tokens, 0) * prompts
+        if saved:
+            telemetry.METRICS.inc("session_prompt_tokens_saved_total", saved)
+        if session_id and not result.get("error"):
+            self.sessions.append(session_id, query, result.get("summary", ""), result.get("sql"), result.get("keys"))
+        return dict(result, session_id=session_id, history_tokens=history_tokens, prompt_tokens_saved=saved)
+
+    def _resolve_reference(self, query, session_id):
+        """ID set of an earlier turn that the query refers to ("those shipments", "them"), or None."""
+        if not session_id:
+            return None
+        reference = resolve_reference(query, self.sessions.turns(session_id))
+        if reference is not None:
+            print(f"Orchestrator: Resolved reference to {len(reference.ids)} {reference.table}")
+        return reference
+
+    def _cache_key(self, query, role, history, reference=None):
+        # The same words refer to different rows in different conversations
+        return self.response_cache.make_key(query, role, f"{history}\n{reference.marker()}" if reference else history)
+
+    def run(self, query, role="Guest", history="", session_id=None):
+        """Orchestrates the multi-agent workflow with RBAC security and memory.
+
+        Concurrent identical requests (same query, role and history) share one execution.
+        """
+        history, raw_tokens = self._prepare_history(session_id, history)
+        reference = self._resolve_reference(query, session_id)
+        key = self._cache_key(query, role, history, reference)
+        result, coalesced = self.inflight.do(key, lambda: self._run(query, role, history, reference))
+        if coalesced:
+            print("Orchestrator: Coalesced with an identical in-flight request")
+            result = dict(result, followups=list(result.get("followups", [])), coalesced=True)
+        return self._finish_session(session_id, query, result, history, raw_tokens)
+
+    def _run(self, query, role, history, reference=None):
         try:
+            started = time.perf_counter()
+            timings = {}
+            trace = Trace()
             print(f"Orchestrator: User Role = {role}")
-            
-            # 0. RBAC Security Check
-            query_lower = query.lower()
-            if role == "Guest" and any(w in query_lower for w in ["cost", "price", "profit", "salary", "money"]):
-                return {"summary": "🚫 Access Denied: Guests cannot access financial data.", "sql": None, "error": None, "followups": []}
-            
-            # 1. Intent Detection: Communication vs Analytics
-            if any(w in query_lower for w in ["email", "mail", "inbox", "send", "read"]):
-                print("Orchestrator: Routing to Communication Agent...")
-                if "read" in query_lower or "inbox" in query_lower:
-                    summary = "[UNREAD] Subject: Delay Report - Driver Kyle\nBody: Vehicle V-001 is stuck in traffic."
-                    followups = ["Send an email to Kyle", "Find alternative vehicle", "Check shipment 14 status"]
-                    return {"summary": summary, "sql": None, "error": None, "followups": followups}
-                elif "send" in query_lower:
-                    summary = f"📧 Draft Email Created for '{query}'. (Simulation: Email Sent)"
-                    followups = ["Check inbox", "Show fleet status", "What is the next pickup?"]
-                    return {"summary": summary, "sql": None, "error": None, "followups": followups}
-            
-            # 2. Analytics Workflow
-            # Data Analyst fetching facts
-            print(f"Orchestrator: Engaging Data Analyst for: {query} (Context included)")
-            # Add history to query for data analyst to understand "it", "them", etc.
-            contextual_query = f"Conversation Context: {history}\nUser Query: {query}" if history else query
-            data_result = self.data_analyst.invoke(contextual_query)
-            facts = data_result.get("output", "No data retrieved.")
-
-            # 3. Strategy Layer
-            strategy_keywords = ["optimize", "advice", "suggest", "improve", "why", "strategy", "fix"]
-            needs_strategy = any(word in query.lower() for word in strategy_keywords)
+
+            routed = self._route_request(query, role)
+            if routed is not None:
+                return routed
+
+            # 2. Response Cache
+            cache_key = self._cache_key(query, role, history, reference)
+            data_version = self._data_version()
+            cached = self.response_cache.get(cache_key, data_version)
+            if cached is not None:
+                print("Orchestrator: Serving cached response")
+                timings["total_ms"] = self._observe_total(started)
+                return dict(cached, followups=list(cached["followups"]), cached=True, timings=timings, trace=[])
+
+            # 3. Analytics Workflow
+            # Reference, KPI and template fast paths, otherwise the Data Analyst fetches facts
+            fast_path = self._fast_path(query, role, reference, trace, timings)
+            if fast_path is not None:
+                facts, sql, intent, rows = fast_path[1]
+            else:
+                print(f"Orchestrator: Engaging Data Analyst for: {query} (Context included)")
+                contextual_query = self._analyst_input(query, history, reference)
+                intent = None
+                with trace.span("analyst") as span, self._guard_scope(role):
+                    data_result = self.data_analyst.invoke(contextual_query)
+                    span.add("agent_iterations", len(data_result.get("intermediate_steps", [])))
+                timings["analyst_ms"] = span.duration_ms
+                facts = data_result.get("output", "No data retrieved.")
+                sql = self._extract_sql(data_result.get("intermediate_steps", []))
+                rows = self._analyst_rows(sql, role)
+                self._learn_example(query, sql, rows, reference)
+
+            # 4. Strategy Layer
+            needs_strategy = self._needs_strategy(query)
 
             if needs_strategy:
                 print("Orchestrator: Engaging Fleet Strategist for operational insight...")
-                strategy_advice = self.fleet_strategist.invoke({"data_facts": facts, "history": history}).content
-                
-                final_response = (
-                    f"### 📊 Analyst Data Report\n{facts}\n\n"
-                    f"### 🚀 Fleet Strategy Recommendations\n{strategy_advice}"
+                if self.concurrent and self.llm_followups:
+                    # Follow-ups only need the analyst facts, so they run alongside the strategist
+                    followup_future = self.executor.submit(
+                        trace.timed, "followups", self._followups, query, role, facts, sql, history, intent
+                    )
+                strategy_message, timings["strategist_ms"] = trace.timed(
+                    "strategist", self.fleet_strategist.invoke, {"data_facts": facts, "history": history}
                 )
+                final_response = self._compose_response(facts, strategy_message.content)
             else:
                 final_response = facts
 
-            # 4. Follow-up Generation
-            followups = self._generate_followups(final_response, history)
+            # 5. Follow-up Generation
+            if needs_strategy and self.concurrent and self.llm_followups:
+                followups, timings["followups_ms"] = followup_future.result()
+            else:
+                followups, timings["followups_ms"] = trace.timed(
+                    "followups", self._followups, query, role, final_response, sql, history, intent
+                )
+
+            timings["total_ms"] = self._observe_total(started)
+            print(f"Orchestrator: Stage timings (ms) {timings}")
 
-            return {
+            result = {
                 "summary": final_response,
-                "sql": "-- Multi-Agent Coordination Hook --",
+                "sql": sql,
                 "error": None,
-                "followups": followups
+                "followups": followups,
+                "keys": result_keys(sql, rows)
             }
+            self.response_cache.set(cache_key, result, data_version)
+            return dict(result, followups=list(followups), cached=False, timings=timings, trace=trace.to_list())
         except Exception as e:
             import traceback
             error_trace = traceback.format_exc()
             print(f"Agent Execution Crash: {error_trace}")
             return {"summary": "System error in multi-agent workflow.", "sql": None, "error": str(e), "followups": []}
 
+    def run_batch(self, items, concurrency=None):
+        """Runs many queries through run() with bounded concurrency.
+
+        items are dicts with query, optional role/history/session_id and an optional id echoed back.
+        Identical SQL issued by different items executes once for the whole batch.
+        """
+        started = time.perf_counter()
+        scope = SQLBatchScope()
+
+        def run_item(index, item):
+            item_started = time.perf_counter()
+            base = {"index": index, "id": item.get("id")}
+            if not item.get("query"):
+                return dict(base, summary="", sql=None, error="No query provided", followups=[], latency_ms=0.0)
+            with scope.active():
+                result = self.run(item["query"], role=item.get("role", "Guest"), history=item.get("history", ""),
+                                  session_id=item.get("session_id"))
+            # Results may be shared with coalesced callers, so copy rather than mutate
+            return dict(base, **{k: v for k, v in result.items() if k != "trace"}, latency_ms=_elapsed_ms(item_started))
+
+        workers = max(1, min(concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY, len(items)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="batch-item") as pool:
+            results = list(pool.map(run_item, range(len(items)), items))
+
+        failed = sum(1 for r in results if r.get("error"))
+        print(f"Orchestrator: Batch of {len(items)} finished ({failed} failed, SQL {scope.stats()})")
+        return {
+            "results": results,
+            "succeeded": len(results) - failed,
+            "failed": failed,
+            "concurrency": workers,
+            "sql": scope.stats(),
+            "total_ms": _elapsed_ms(started),
+        }
+
+    def run_stream(self, query, role="Guest", history="", session_id=None):
+        """Streaming variant of run(): yields progress events as each agent produces output.
+
+        Events are dicts with an "event" key: status, step, sql, observation, facts,
+        strategy_token, followups and finally done (same fields as run()) or error.
+        """
+        history, raw_tokens = self._prepare_history(session_id, history)
+        reference = self._resolve_reference(query, session_id)
+        for event in self._stream(query, role, history, reference):
+            if event["event"] == "done":
+                event = self._finish_session(session_id, query, event, history, raw_tokens)
+            yield event
+
+    def _stream(self, query, role, history, reference=None):
+        try:
+            started = time.perf_counter()
+            timings = {}
+            trace = Trace()
+            yield {"event": "status", "message": "Orchestrator: Engaging collaborative agents..."}
+
+            routed = self._route_request(query, role)
+            if routed is not None:
+                yield {"event": "done", **routed}
+                return
+
+            cache_key = self._cache_key(query, role, history, reference)
+            data_version = self._data_version()
+            cached = self.response_cache.get(cache_key, data_version)
+            if cached is not None:
+                timings["total_ms"] = self._observe_total(started)
+                yield {"event": "done", **cached, "followups": list(cached["followups"]), "cached": True, "timings": timings}
+                return
+
+            # Reference/KPI/template fast paths, otherwise the Data Analyst with each ReAct action and observation forwarded
+            fast_path = self._fast_path(query, role, reference, trace, timings)
+            if fast_path is not None:
+                tool, (facts, sql, intent, rows) = fast_path
+                yield {"event": "step", "tool": tool, "input": query}
+                yield {"event": "sql", "sql": sql}
+            else:
+                yield {"event": "status", "message": "Data Analyst: Querying BigQuery..."}
+                contextual_query = self._analyst_input(query, history, reference)
+                facts, intermediate_steps, intent = "No data retrieved.", [], None
+                with trace.span("analyst") as span, self._guard_scope(role):
+                    for chunk in self.data_analyst.stream(contextual_query):
+                        for action in chunk.get("actions", []):
+                            yield {"event": "step", "tool": action.tool, "input": action.tool_input}
+                            if action.tool == "sql_db_query":
+                                yield {"event": "sql", "sql": action.tool_input}
+                        for step in chunk.get("steps", []):
+                            intermediate_steps.append((step.action, step.observation))
+                            yield {"event": "observation", "tool": step.action.tool, "output": str(step.observation)[:1000]}
+                        if "output" in chunk:
+                            facts = chunk["output"]
+                    span.add("agent_iterations", len(intermediate_steps))
+                timings["analyst_ms"] = span.duration_ms
+                sql = self._extract_sql(intermediate_steps)
+                rows = self._analyst_rows(sql, role)
+                self._learn_example(query, sql, rows, reference)
+            yield {"event": "facts", "facts": facts}
+
+            # Fleet Strategist: stream tokens while follow-ups are generated in the background
+            if self._needs_strategy(query):
+                yield {"event": "status", "message": "Fleet Strategist: Drafting recommendations..."}
+                if self.concurrent and self.llm_followups:
+                    followup_future = self.executor.submit(
+                        trace.timed, "followups", self._followups, query, role, facts, sql, history, intent
+                    )
+                strategy_advice = ""
+                with trace.span("strategist") as span:
+                    for token in self.fleet_strategist.stream({"data_facts": facts, "history": history}):
+                        strategy_advice += token.content
+                        yield {"event": "strategy_token", "token": token.content}
+                timings["strategist_ms"] = span.duration_ms
+                final_response = self._compose_response(facts, strategy_advice)
+                if self.concurrent and self.llm_followups:
+                    followups, timings["followups_ms"] = followup_future.result()
+                else:
+                    followups, timings["followups_ms"] = trace.timed(
+                        "followups", self._followups, query, role, final_response, sql, history, intent
+                    )
+            else:
+                final_response = facts
+                followups, timings["followups_ms"] = trace.timed(
+                    "followups", self._followups, query, role, final_response, sql, history, intent
+                )
+            yield {"event": "followups", "followups": followups}
+
+            timings["total_ms"] = self._observe_total(started)
+            result = {"summary": final_response, "sql": sql, "error": None, "followups": followups,
+                      "keys": result_keys(sql, rows)}
+            self.response_cache.set(cache_key, result, data_version)
+            yield {"event": "done", **result, "followups": list(followups), "cached": False, "timings": timings,
+                   "trace": trace.to_list()}
+        except Exception as e:
+            import traceback
+            print(f"Agent Execution Crash: {traceback.format_exc()}")
+            yield {"event": "error", "summary": "System error in multi-agent workflow.", "error": str(e)}
+
+    def cache_stats(self):
+        """Cache, routing and coalescing statistics served by /cache."""
+        return {
+            "response_cache": self.response_cache.stats(),
+            "sql_cache": self.db.result_cache.stats(),
+            "warehouse": {
+                "backend": self.backend,
+                "routing": dict(self.db.routing),
+                "replica": self.replica.stats() if self.replica else None
+            },
+            "coalescing": {
+                "runs": self.inflight.stats(),
+                "sql": self.db.sql_flight.stats()
+            },
+            "sessions": self.sessions.stats(),
+            "sql_guard": self.sql_guard.stats() if self.sql_guard else None,
+            "examples": self.examples.stats() if self.examples else None,
+            "kpis": self.kpis.stats(),
+            "fleet_state": self.fleet_state.stats()
+        }
+
+    def invalidate_caches(self):
+        """Drops cached responses and SQL results (/cache/invalidate)."""
+        self.response_cache.invalidate()
+        self.db.result_cache.clear()
+        return {"response_cache": self.response_cache.stats(), "sql_cache": self.db.result_cache.stats()}
+
 def get_multi_agent():
     return MultiAgentLogisticsSystem()
@@ -3,6 +3,7 @@ import os
 import requests
 import json
 import time
+import uuid
 from streamlit_mic_recorder import mic_recorder
 import speech_recognition as sr
 import io
@@ -48,6 +49,40 @@ st.markdown("""
 # Page Config
 st.set_page_config(page_title="Multi-Agent Logistics Control Tower", page_icon="🚚", layout="wide")
 
+def stream_query(payload, placeholder):
+    """Consumes the NDJSON event stream from /query/stream, rendering progress as it arrives."""
+    trace, sql, facts, strategy = [], None, "", ""
+    with requests.post(f"{API_URL}/query/stream", json=payload, stream=True, timeout=60) as response:
+        if response.status_code != 200:
+            return {"error": f"Backend Insight Failure ({response.status_code})"}
+        for line in response.iter_lines(decode_unicode=True):
+            if not line:
+                continue
+            event = json.loads(line)
+            kind = event.get("event")
+            if kind in ("done", "error"):
+                return event
+            if kind == "status":
+                trace.append(f"🤖 *{event['message']}*")
+            elif kind == "step":
+                trace.append(f"🔧 `{event['tool']}` {str(event.get('input', ''))[:120]}")
+            elif kind == "sql":
+                sql = event["sql"]
+            elif kind == "facts":
+                facts = event["facts"]
+            elif kind == "strategy_token":
+                strategy += event["token"]
+
+            view = "\n\n".join(trace[-6:])
+            if sql:
+                view += f"\n\n```sql\n{sql}\n```"
+            if facts:
+                view += f"\n\n**[Data Analyst]**: {facts}"
+            if strategy:
+                view += f"\n\n**[Fleet Strategist]**: {strategy}"
+            placeholder.markdown(view)
+    return {"error": "Stream ended before the agents finished."}
+
 def transcribe_audio(audio_bytes):
     """Transcribes audio using SpeechRecognition and Pydub for conversion."""
     r = sr.Recognizer()
@@ -125,35 +160,38 @@ with st.sidebar.expander("📧 Communication Hub"):
 
 st.sidebar.markdown("---")
 
-# --- Sidebar: Sample Data Explorer (Hardcoded) ---
+# --- Sidebar: Sample Data Explorer (live rows from the backend /sample endpoint) ---
+def fetch_sample_data():
+    """Fetches /sample, revalidating the copy kept in the session with its ETag (304 = unchanged)."""
+    cached = st.session_state.get("sample_data")
+    request_headers = {"If-None-Match": cached["etag"]} if cached and cached.get("etag") else {}
+    response = requests.get(f"{API_URL}/sample", headers=request_headers, timeout=30)
+    if response.status_code == 304 and cached:
+        return cached["tables"]
+    response.raise_for_status()
+    tables = response.json()
+    st.session_state.sample_data = {"etag": response.headers.get("ETag"), "tables": tables}
+    return tables
+
 st.sidebar.title("📊 Data Explorer")
 if st.sidebar.button("Show Sample Data"):
     with st.sidebar:
-        # Enhanced BigQuery-like sample data
-        sample_shipments = [
-            {"id": 10, "origin": "London", "destination": "Paris", "status": "In Transit", "priority": "High", "cost": 1200.50, "revenue": 1800.00, "weight_kg": 500.5, "cargo_type": "Electronics", "customer_name": "Tech Corp"},
-            {"id": 14, "origin": "Wrightview", "destination": "New Donport", "status": "Delayed", "priority": "Standard", "cost": 850.00, "revenue": 1200.00, "weight_kg": 1200.0, "cargo_type": "Furniture", "customer_name": "Home Furnishings"},
-            {"id": 22, "origin": "Delhi", "destination": "Mumbai", "status": "Delivered", "priority": "Urgent", "cost": 3400.00, "revenue": 5000.00, "weight_kg": 2500.0, "cargo_type": "Medical Supplies", "customer_name": "Health Plus"}
-        ]
-        sample_vehicles = [
-            {"vehicle_id": 1, "type": "Heavy Truck", "capacity_kg": 15000, "status": "Active", "fuel_level": 75.5, "current_load_kg": 5000.0},
-            {"vehicle_id": 4, "type": "Light Van", "capacity_kg": 2500, "status": "Maintenance", "fuel_level": 10.5, "current_load_kg": 0.0}
-        ]
-        sample_drivers = [
-            {"id": 1, "name": "Kyle Miller", "status": "On Duty", "rating": 4.8, "experience_years": 10, "current_location": "London"},
-            {"id": 2, "name": "Sarah Jenkins", "status": "Off Duty", "rating": 4.9, "experience_years": 5, "current_location": "Paris"}
-        ]
-        
-        st.write("**Table: Shipments (Enriched)**")
-        st.dataframe(sample_shipments, hide_index=True)
-        
-        st.write("**Table: Vehicles (Enriched)**")
-        st.dataframe(sample_vehicles, hide_index=True)
+        try:
+            with st.spinner("Loading sample rows..."):
+                sample_tables = fetch_sample_data()
 
-        st.write("**Table: Drivers (Enriched)**")
-        st.dataframe(sample_drivers, hide_index=True)
-        
-        st.info("💡 Useful for verifying data-driven queries.")
+            st.write("**Table: Shipments**")
+            st.dataframe(sample_tables.get("shipments", []), hide_index=True)
+
+            st.write("**Table: Vehicles**")
+            st.dataframe(sample_tables.get("vehicles", []), hide_index=True)
+
+            st.write("**Table: Drivers**")
+            st.dataframe(sample_tables.get("drivers", []), hide_index=True)
+
+            st.info("💡 Useful for verifying data-driven queries.")
+        except Exception as e:
+            st.error(f"Could not load sample data: {e}")
 
 st.sidebar.markdown("---")
 st.sidebar.title("🤖 Multi-Agent Fleet")
@@ -161,13 +199,18 @@ st.sidebar.success("Orchestrator: Active")
 st.sidebar.info("📊 Agent 1: Logistics Analyst (Online)")
 st.sidebar.info("🚀 Agent 2: Fleet Strategist (Online)")
 
+stream_responses = st.sidebar.toggle("⚡ Stream Agent Output", value=True, help="Show analyst steps and strategist output as they arrive.")
+
 if st.sidebar.button("🗑️ Clear Chat History"):
     st.session_state.messages = []
+    st.session_state.session_id = uuid.uuid4().hex  # new server-side conversation
     st.rerun()
 
-# Initialize Chat History
+# Initialize Chat History (the backend keeps the conversation for this session ID)
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 
 # Display Chat History
 for i, message in enumerate(st.session_state.messages):
@@ -229,22 +272,23 @@ if final_prompt:
         message_placeholder.markdown("🤖 *Orchestrator: Engaging collaborative agents...*")
         
         try:
-            # Prepare History (last 5 messages for context window)
-            history_str = "\n".join([f"{m['role'].upper()}: {m['content']}" for m in st.session_state.messages[-6:-1]])
-            
-            # Backend Call
-            response = requests.post(
-                f"{API_URL}/query", 
-                json={
-                    "query": final_prompt, 
-                    "role": user_role,
-                    "history": history_str
-                }, 
-                timeout=60
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
+            # History is kept and compacted server-side for this session
+            payload = {
+                "query": final_prompt, 
+                "role": user_role,
+                "session_id": st.session_state.session_id
+            }
+
+            # Backend Call (streamed events, or a single JSON response)
+            if stream_responses:
+                result = stream_query(payload, message_placeholder)
+                status_code = 200 if result.get("event") == "done" else 500
+            else:
+                response = requests.post(f"{API_URL}/query", json=payload, timeout=60)
+                status_code = response.status_code
+                result = response.json() if status_code == 200 else {}
+
+            if status_code == 200:
                 summary = result.get("summary", "No insight provided.")
                 followups = result.get("followups", [])
                 
@@ -270,7 +314,7 @@ if final_prompt:
                 # RERUN to show followups immediately (Streamlit hack)
                 st.rerun()
             else:
-                st.error(f"Backend Insight Failure ({response.status_code})")
+                st.error(result.get("error") or f"Backend Insight Failure ({status_code})")
         except Exception as e:
             st.error(f"Connection Error: {e}")
 
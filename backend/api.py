@@ -1,52 +1,292 @@
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
-from agents import LogisticsAgent
-import uvicorn
+import asyncio
+import contextvars
+import functools
+import json
 import os
+import time
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+import anyio
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+
+import telemetry
+from samples import SAMPLE_CACHE_TTL, SamplePayloadCache, etag_matches, fetch_samples, shared_client
+
+# Configuration
+PROJECT_ID = "inspiring-keel-423204-c7"
+DATASET_ID = "logistics_control_tower"
+
+# Agent runs block on Gemini and BigQuery, so each one is offloaded to a worker thread.
+# This caps how many run at once per worker process; further requests wait without blocking the event loop.
+API_MAX_INFLIGHT = int(os.getenv("API_MAX_INFLIGHT", "64"))
+PREWARM_ON_START = os.getenv("PREWARM_ON_START", "true").lower() == "true"
+
+# Largest number of queries accepted by one /query/batch request
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+
+# Per-process agent (each uvicorn worker builds its own)
+agent = None
+_agent_task = None
+_limiter = None
+# KPI store read from the shipped file until the agent (which keeps it current) is ready
+_kpi_store = None
+
+
+async def _run_blocking(fn, *args, **kwargs):
+    """Runs a blocking call on the agent thread pool so the event loop keeps serving other requests."""
+    return await anyio.to_thread.run_sync(functools.partial(fn, *args, **kwargs), limiter=_limiter)
+
+
+def _in_one_context(iterator):
+    """Steps a sync generator inside one copied context.
+
+    Starlette runs each next() of a streamed generator in a fresh copy of the context, which breaks
+    ContextVar.reset (telemetry spans) and drops values set by an earlier step (the active SQL guard).
+    """
+    context = contextvars.copy_context()
+    while True:
+        try:
+            item = context.run(next, iterator)
+        except StopIteration:
+            return
+        yield item
 
-app = FastAPI(title="Logistics Control Tower API", version="1.0.0")
 
-# Initialize Agent
-# Note: In a real cloud run, this logic might be per-request or cached
-agent = LogisticsAgent(db_path="sales_data.db")
+def _build_agent():
+    from agents import get_multi_agent
+    new_agent = get_multi_agent()
+    new_agent.warmup()
+    return new_agent
+
+
+async def get_agent():
+    """Builds the agent once per process; concurrent first requests await the same initialization."""
+    global agent, _agent_task
+    if agent is None:
+        if _agent_task is None:
+            _agent_task = asyncio.ensure_future(_run_blocking(_build_agent))
+        try:
+            agent = await asyncio.shield(_agent_task)
+        except Exception:
+            _agent_task = None  # let the next request retry
+            raise
+    return agent
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global _limiter
+    _limiter = anyio.CapacityLimiter(API_MAX_INFLIGHT)
+    if PREWARM_ON_START and agent is None:
+        asyncio.ensure_future(get_agent())
+    yield
+
+
+app = FastAPI(title="Logistics Control Tower API", version="1.0.0", lifespan=lifespan)
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    telemetry.observe_request(route.path if route else "unmatched", request.method,
+                              response.status_code, time.perf_counter() - started)
+    return response
+
 
 class QueryRequest(BaseModel):
-    query: str
+    query: str = ""
+    role: str = "Guest"
+    history: str = ""
+    session_id: Optional[str] = None
+    timings: bool = False
+
 
 class QueryResponse(BaseModel):
     summary: str
-    sql: str
-    error: str = None
+    sql: Optional[str] = None
+    error: Optional[str] = None
+    followups: List[str] = []
+    cached: bool = False
+    coalesced: bool = False
+    session_id: Optional[str] = None
+    history_tokens: int = 0
+    prompt_tokens_saved: int = 0
+    timings: Optional[dict] = None
 
-@app.post("/query", response_model=QueryResponse)
+
+@app.post("/query", response_model=QueryResponse, response_model_exclude_none=True)
 async def process_query(request: QueryRequest):
+    if not request.query:
+        raise HTTPException(status_code=400, detail="No query provided")
+    print(f"Processing Query: {request.query} | Role: {request.role} | History Length: {len(request.history)}")
+    current_agent = await get_agent()
+    result = await _run_blocking(current_agent.run, request.query, role=request.role, history=request.history,
+                                 session_id=request.session_id)
+    return QueryResponse(
+        summary=result.get("summary", ""),
+        sql=result.get("sql", "-- Agent Executed --"),
+        error=result.get("error"),
+        followups=result.get("followups", []),
+        cached=result.get("cached", False),
+        coalesced=result.get("coalesced", False),
+        session_id=result.get("session_id"),
+        history_tokens=result.get("history_tokens", 0),
+        prompt_tokens_saved=result.get("prompt_tokens_saved", 0),
+        timings={"stages": result.get("timings", {}), "spans": result.get("trace", [])} if request.timings else None,
+    )
+
+
+class BatchRequest(BaseModel):
+    queries: List[dict]
+    concurrency: Optional[int] = None
+
+
+@app.post("/query/batch")
+async def process_query_batch(request: BatchRequest):
+    """Many queries with bounded concurrency; identical SQL is shared across the batch."""
+    if not request.queries:
+        raise HTTPException(status_code=400, detail="Body must contain a non-empty 'queries' list of objects")
+    if len(request.queries) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_ITEMS} queries per batch")
+    if request.concurrency is not None and request.concurrency < 1:
+        raise HTTPException(status_code=400, detail="'concurrency' must be a positive integer")
+    current_agent = await get_agent()
+    batch = await _run_blocking(current_agent.run_batch, request.queries, concurrency=request.concurrency)
+    return Response(json.dumps(batch, default=str), media_type="application/json")
+
+
+@app.post("/query/stream")
+async def process_query_stream(request: QueryRequest):
+    if not request.query:
+        raise HTTPException(status_code=400, detail="No query provided")
+    current_agent = await get_agent()
+    events = (json.dumps(event) + "\n"
+              for event in _in_one_context(current_agent.run_stream(
+                  request.query, role=request.role, history=request.history, session_id=request.session_id)))
+    # Starlette iterates sync generators on its thread pool, each step in a new context copy
+    return StreamingResponse(events, media_type="application/x-ndjson",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.get("/health")
+async def health_check():
+    return {"status": "healthy", "agent_ready": agent is not None}
+
+
+@app.get("/warmup")
+async def warmup():
+    current_agent = await get_agent()
+    return {"status": "ready", "startup": current_agent.startup_timings}
+
+
+sample_cache = SamplePayloadCache(
+    lambda: fetch_samples(shared_client(PROJECT_ID), PROJECT_ID, DATASET_ID), SAMPLE_CACHE_TTL
+)
+
+
+@app.get("/sample")
+async def get_sample(request: Request):
     try:
-        print(f"Received query: {request.query}")
-        result = agent.run(request.query)
-        
-        # Determine if result was successful based on 'error' key
-        if result.get("error"):
-            return QueryResponse(
-                summary=result.get("summary", "An error occurred."),
-                sql=result.get("sql", "ERROR"),
-                error=result.get("error")
-            )
-            
-        return QueryResponse(
-            summary=result.get("summary", ""),
-            sql=result.get("sql", "-- Agent Executed --")
-        )
+        body, etag = await _run_blocking(sample_cache.get)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={SAMPLE_CACHE_TTL}"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+def get_kpis():
+    global _kpi_store
+    if agent is not None:
+        return agent.kpis
+    if _kpi_store is None:
+        from kpis import KPI_STORE_PATH, KPIStore
+        _kpi_store = KPIStore.load(KPI_STORE_PATH)
+    return _kpi_store
+
+
+@app.get("/kpis")
+async def get_kpis_route(request: Request, role: str = "Guest"):
+    """Precomputed KPI aggregates for dashboards; financial KPIs are hidden from Guests."""
+    body, etag = get_kpis().payload(include_financial=role != "Guest")
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(body, media_type="application/json", headers=headers)
+
+
+@app.post("/telemetry")
+async def ingest_telemetry(request: Request):
+    """Vehicle pings ({"pings": [...]}, a JSON list or NDJSON) for known vehicles into the in-memory fleet state."""
+    from fleet_state import TELEMETRY_MAX_PINGS, authorize, parse_payload
+    denied = authorize(request.headers.get("x-api-key"))
+    if denied:
+        raise HTTPException(status_code=denied[0], detail=denied[1])
+    pings, unparsable = parse_payload(await request.body(), request.headers.get("content-type", ""))
+    if len(pings) > TELEMETRY_MAX_PINGS:
+        raise HTTPException(status_code=413, detail=f"At most {TELEMETRY_MAX_PINGS} pings per request")
+    current_agent = await get_agent()
+    # Seeds the known fleet and starts the flusher on the first ping of a cold worker
+    await _run_blocking(current_agent.start_fleet_state)
+    if current_agent.fleet_state.fleet is None:
+        raise HTTPException(status_code=503, detail="Vehicle list not loaded yet, retry later")
+    # Batches are applied with array operations; parsing large ones still belongs off the event loop
+    result = await _run_blocking(current_agent.fleet_state.ingest, pings)
+    result["rejected"] += unparsable
+    result["vehicles"] = current_agent.fleet_state.size
+    return result
+
+
+@app.get("/dispatch")
+async def get_dispatch():
+    """Vehicle assignment for pending/delayed shipments (capacity, fuel range and distance aware)."""
+    current_agent = await get_agent()
+    return await _run_blocking(current_agent.plan_dispatch)
 
-@app.get("/health")
-def health_check():
-    return {"status": "healthy"}
 
 @app.get("/schema")
-def get_schema():
+async def get_schema():
     """Returns the database schema for the frontend to visualize."""
-    return {"schema": agent.db.get_table_info()}
+    current_agent = await get_agent()
+    return {"schema": await _run_blocking(current_agent.db.get_table_info)}
+
+
+@app.get("/cache")
+async def cache_stats():
+    current_agent = await get_agent()
+    return current_agent.cache_stats()
+
+
+@app.post("/cache/invalidate")
+async def invalidate_cache(request: Request):
+    from cache import authorize_invalidation
+    denied = authorize_invalidation(request.headers.get("x-api-key"))
+    if denied:
+        raise HTTPException(status_code=denied[0], detail=denied[1])
+    current_agent = await get_agent()
+    return current_agent.invalidate_caches()
+
+
+@app.get("/templates")
+async def template_stats():
+    """Hits per query template and recent misses."""
+    current_agent = await get_agent()
+    return current_agent.templates.stats()
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(telemetry.METRICS.render(), media_type="text/plain; version=0.0.4")
+
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Each worker is a separate process with its own agent and caches
+    uvicorn.run("api:app", host="0.0.0.0", port=int(os.getenv("PORT", "8000")),
+                workers=int(os.getenv("WEB_CONCURRENCY", "1")))
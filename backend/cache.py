@@ -0,0 +1,238 @@
+import hashlib
+import hmac
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from telemetry import METRICS
+
+# Key required in the X-API-Key header of POST /cache/invalidate; left unset, the route is disabled
+CACHE_ADMIN_API_KEY = os.getenv("CACHE_ADMIN_API_KEY", "")
+
+
+def normalize_query(query):
+    """Canonical form of a user question: lowercase, no punctuation, single spaces."""
+    text = re.sub(r"[^\w\s%.-]", " ", (query or "").lower())
+    text = re.sub(r"(?<!\d)\.|\.(?!\d)", " ", text)  # keep decimal points, drop sentence periods
+    return " ".join(text.split())
+
+
+def authorize_invalidation(api_key):
+    """None if a /cache/invalidate request's X-API-Key is accepted, else (HTTP status, error message)."""
+    if not CACHE_ADMIN_API_KEY:
+        return 503, "Cache invalidation is disabled (CACHE_ADMIN_API_KEY is not set)"
+    if not api_key or not hmac.compare_digest(api_key.encode("utf-8"), CACHE_ADMIN_API_KEY.encode("utf-8")):
+        return 401, "Missing or invalid X-API-Key"
+    return None
+
+
+def fingerprint(text):
+    """Short stable hash of an arbitrary string (e.g. the conversation history)."""
+    return hashlib.sha1((text or "").encode("utf-8")).hexdigest()[:16]
+
+
+class DataVersionTracker:
+    """Tracks per-table modification stamps so caches can drop entries when the warehouse changes."""
+
+    def __init__(self, fetch_versions, check_interval=30):
+        # fetch_versions: callable returning {table_name: stamp}
+        self._fetch_versions = fetch_versions
+        self.check_interval = check_interval
+        self._versions = {}
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def versions(self, force=False):
+        """Returns the latest known stamps, re-polling at most once per check_interval."""
+        with self._lock:
+            now = time.monotonic()
+            if force or not self._checked_at or now - self._checked_at >= self.check_interval:
+                try:
+                    self._versions = dict(self._fetch_versions())
+                except Exception as e:
+                    # Keep serving with the last known versions rather than failing the request
+                    print(f"Cache: Could not refresh table versions: {e}")
+                self._checked_at = now
+            return dict(self._versions)
+
+    def version_token(self, tables=None):
+        """Single token summarising the stamps of the given tables (all tables by default)."""
+        versions = self.versions()
+        if tables is not None:
+            versions = {t: versions.get(t) for t in tables}
+        return fingerprint(repr(sorted(versions.items())))
+
+
+class ResponseCache:
+    """Thread-safe TTL cache with LRU eviction for complete multi-agent responses."""
+
+    def __init__(self, max_entries=256, ttl_seconds=300):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._data_version = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def make_key(query, role, history=""):
+        return (normalize_query(query), role, fingerprint(history))
+
+    def _sync_version(self, data_version):
+        # A new warehouse version makes every cached answer suspect
+        if data_version != self._data_version:
+            if self._entries:
+                self._entries.clear()
+                self.invalidations += 1
+            self._data_version = data_version
+
+    def get(self, key, data_version=None):
+        with self._lock:
+            self._sync_version(data_version)
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value, data_version=None):
+        with self._lock:
+            self._sync_version(data_version)
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        """Drops every entry, e.g. after the BigQuery tables were reloaded."""
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+class SQLResultCache:
+    """Memory-capped LRU cache for SQL result sets and schema text, shared by every request in a warm instance."""
+
+    def __init__(self, max_bytes=32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (size_bytes, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def estimate_size(value):
+        # repr() length is a cheap, stable proxy for the memory held by rows of scalars
+        return len(repr(value))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        size = self.estimate_size(value)
+        if size > self.max_bytes // 4:
+            return  # A single huge result would flush everything else
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[0]
+            self._entries[key] = (size, value)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key onto one in-progress execution.
+
+    Callers that arrive while a call for their key is running wait for it and receive its
+    result (or exception) instead of executing again. Nothing is kept once the call ends.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._calls = {}  # key -> Future of the in-progress call
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Returns (result, coalesced), running fn only if no identical call is in flight."""
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            METRICS.inc("coalesced_total", level=self.name)
+            return future.result(), True
+        try:
+            result = fn()
+            future.set_result(result)
+            return result, False
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def stats(self):
+        with self._lock:
+            return {"executed": self.executed, "coalesced": self.coalesced, "in_flight": len(self._calls)}
@@ -0,0 +1,304 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+from geo import CITY_COORDINATES
+
+# Precomputed KPI aggregates written by update_bigquery_data.py and shipped with the function
+KPI_STORE_PATH = os.getenv(
+    "KPI_STORE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "kpis.json")
+)
+KPI_SHORTCUT = os.getenv("KPI_SHORTCUT", "true").lower() == "true"
+# Rows listed in a KPI answer; dashboards get every row through /kpis
+KPI_ANSWER_ROWS = int(os.getenv("KPI_ANSWER_ROWS", "10"))
+
+# Conditions the precomputed (whole-table) aggregates cannot apply, left to the Data Analyst: statuses, priorities,
+# cities, time windows, cargo types and filtering prepositions ("margin by customer for delayed shipments",
+# "fleet utilization last week", "delay rates for shipments to Paris", "most profitable in electronics")
+EXTRA_FILTERS = re.compile(
+    r"\b(?:delayed|pending|delivered|in transit|active|inactive|maintenance|idle|on duty|off duty|insured|uninsured"
+    r"|urgent|priority|today|yesterday|tomorrow|since|before|after|until|during|ytd"
+    r"|(?:last|this|next|past|previous)\s+(?:\d+\s+)?(?:days?|weeks?|months?|quarters?|years?)"
+    r"|january|february|march|april|may|june|july|august|september|october|november|december|q[1-4]|\d{4}"
+    r"|electronics|apparel|furniture|medical|textiles|machinery|robotics"
+    r"|for|in|with|where|from|to|at|between|above|below|over|under|than"
+    r"|" + "|".join(re.escape(city) for city in CITY_COORDINATES) + r")\b|%",
+)
+# KPI phrases that would otherwise read as filters ("margin for each customer", "utilization for the fleet")
+_KPI_PHRASES = re.compile(r"\b(?:by|per|for each|for every|across)\s+|\butili[sz]ation (?:of|for|across)\b")
+
+RATING_BINS = [0.0, 3.5, 4.0, 4.5, 4.8, 5.0]
+RATING_LABELS = ["below 3.5", "3.5-3.9", "4.0-4.4", "4.5-4.7", "4.8-5.0"]
+
+
+def _records(df):
+    """JSON-safe row dicts (numpy scalars, NaN and timestamps converted)."""
+    return json.loads(df.to_json(orient="records", date_format="iso"))
+
+
+# 1. Aggregates (vectorized over whole columns, no per-row Python)
+
+def _fleet_utilization(frames):
+    v = frames["vehicles"]
+    capacity = v["capacity_kg"].astype(float)
+    load = v["current_load_kg"].astype(float)
+    out = v[["vehicle_id", "type", "status"]].copy()
+    out["capacity_kg"] = capacity
+    out["current_load_kg"] = load
+    out["utilization_pct"] = np.where(capacity > 0, load / capacity.where(capacity > 0) * 100, 0.0).round(1)
+    out["available_kg"] = (capacity - load).clip(lower=0)
+    return out.sort_values(["utilization_pct", "vehicle_id"], ascending=[False, True])
+
+
+def _utilization_by_type(frames):
+    v = frames["vehicles"].assign(
+        capacity_kg=lambda d: d["capacity_kg"].astype(float),
+        current_load_kg=lambda d: d["current_load_kg"].astype(float),
+        active=lambda d: (d["status"] == "Active").astype(int),
+    )
+    out = v.groupby("type", as_index=False).agg(
+        vehicles=("vehicle_id", "count"), active_vehicles=("active", "sum"),
+        capacity_kg=("capacity_kg", "sum"), current_load_kg=("current_load_kg", "sum"),
+    )
+    out["utilization_pct"] = np.where(
+        out["capacity_kg"] > 0, out["current_load_kg"] / out["capacity_kg"].where(out["capacity_kg"] > 0) * 100, 0.0
+    ).round(1)
+    return out.sort_values("utilization_pct", ascending=False)
+
+
+def _margin_by(column):
+    def compute(frames):
+        s = frames["shipments"].assign(margin=lambda d: d["revenue"] - d["cost"])
+        out = s.groupby(column, as_index=False).agg(
+            shipments=("id", "count"), revenue=("revenue", "sum"), cost=("cost", "sum"), margin=("margin", "sum"),
+        )
+        out["margin_pct"] = np.where(
+            out["revenue"] != 0, out["margin"] / out["revenue"].where(out["revenue"] != 0) * 100, 0.0
+        ).round(1)
+        return out.round({"revenue": 2, "cost": 2, "margin": 2}).sort_values("margin", ascending=False)
+    return compute
+
+
+def _delays_by_origin(frames):
+    s = frames["shipments"].assign(delayed=lambda d: (d["status"] == "Delayed").astype(int))
+    out = s.groupby("origin", as_index=False).agg(shipments=("id", "count"), delayed=("delayed", "sum"))
+    out["delay_rate_pct"] = (out["delayed"] / out["shipments"] * 100).round(1)
+    return out.sort_values(["delayed", "delay_rate_pct", "origin"], ascending=[False, False, True])
+
+
+def _driver_rating_distribution(frames):
+    ratings = frames["drivers"]["rating"].astype(float)
+    buckets = pd.cut(ratings, RATING_BINS, labels=RATING_LABELS, include_lowest=True)
+    counts = buckets.value_counts(sort=False).reindex(RATING_LABELS, fill_value=0)
+    out = pd.DataFrame({"rating_band": RATING_LABELS, "drivers": counts.to_numpy()})
+    out["share_pct"] = (out["drivers"] / max(len(ratings), 1) * 100).round(1)
+    return out
+
+
+# 2. Answers for the analyst shortcut (rows are small aggregates, already sorted)
+
+def _summarize_fleet_utilization(rows):
+    capacity = sum(r["capacity_kg"] for r in rows)
+    load = sum(r["current_load_kg"] for r in rows)
+    lines = "\n".join(
+        f"- Vehicle {r['vehicle_id']} ({r['type']}, {r['status']}): {r['utilization_pct']}% "
+        f"({r['current_load_kg']:,.0f} of {r['capacity_kg']:,.0f} kg)"
+        for r in rows[:KPI_ANSWER_ROWS]
+    )
+    overall = load / capacity * 100 if capacity else 0.0
+    return (f"Fleet utilization is {overall:.1f}% ({load:,.0f} kg loaded of {capacity:,.0f} kg capacity "
+            f"across {len(rows)} vehicles).\n{lines}")
+
+
+def _summarize_utilization_by_type(rows):
+    lines = "\n".join(
+        f"- {r['type']}: {r['utilization_pct']}% ({r['current_load_kg']:,.0f} of {r['capacity_kg']:,.0f} kg, "
+        f"{r['active_vehicles']} of {r['vehicles']} vehicles active)"
+        for r in rows[:KPI_ANSWER_ROWS]
+    )
+    return f"Fleet utilization by vehicle type:\n{lines}"
+
+
+def _summarize_margin(label):
+    def summarize(rows):
+        revenue = sum(r["revenue"] for r in rows)
+        margin = sum(r["margin"] for r in rows)
+        lines = "\n".join(
+            f"- {r[label]}: margin ${r['margin']:,.2f} ({r['margin_pct']}%) on revenue ${r['revenue']:,.2f}, "
+            f"{r['shipments']} shipment{'s' if r['shipments'] != 1 else ''}"
+            for r in rows[:KPI_ANSWER_ROWS]
+        )
+        overall = margin / revenue * 100 if revenue else 0.0
+        title = label.replace("_name", "").replace("_", " ")
+        return f"Profit margin by {title} (total ${margin:,.2f}, {overall:.1f}% of revenue):\n{lines}"
+    return summarize
+
+
+def _summarize_delays_by_origin(rows):
+    delayed = [r for r in rows if r["delayed"]]
+    if not delayed:
+        return "No shipments are currently delayed at any origin."
+    lines = "\n".join(
+        f"- {r['origin']}: {r['delayed']} of {r['shipments']} shipments delayed ({r['delay_rate_pct']}%)"
+        for r in delayed[:KPI_ANSWER_ROWS]
+    )
+    return f"Delays by origin city ({sum(r['delayed'] for r in delayed)} delayed shipments):\n{lines}"
+
+
+def _summarize_rating_distribution(rows):
+    lines = "\n".join(f"- {r['rating_band']}: {r['drivers']} driver{'s' if r['drivers'] != 1 else ''} ({r['share_pct']}%)" for r in rows)
+    return f"Driver rating distribution ({sum(r['drivers'] for r in rows)} drivers):\n{lines}"
+
+
+class KPI:
+    """A precomputed aggregate: how to build it from the source tables and which questions it answers."""
+
+    def __init__(self, name, sources, compute, summarize, patterns=(), intent="general", financial=False, topic=None):
+        self.name = name
+        self.sources = sources
+        self.compute = compute
+        self.summarize = summarize
+        self.patterns = [re.compile(p) for p in patterns]
+        self.intent = intent  # follow-up intent of the answer
+        self.financial = financial  # hidden from Guests
+        self.topic = re.compile(topic) if topic else None  # words the KPI itself is about, not filters
+
+    def matches(self, query_lower):
+        """True if a pattern matches and the question adds no condition the precomputed rows cannot apply."""
+        if not any(p.search(query_lower) for p in self.patterns):
+            return False
+        rest = _KPI_PHRASES.sub(" ", query_lower)
+        if self.topic is not None:
+            rest = self.topic.sub(" ", rest)
+        return not EXTRA_FILTERS.search(rest)
+
+
+_BY = r"\b(?:by|per|for each|for every|across)\s+"
+
+DEFAULT_KPIS = [
+    # Checked in order, so the "by type" breakdown wins over overall utilization
+    KPI("utilization_by_type", ["vehicles"], _utilization_by_type, _summarize_utilization_by_type,
+        [r"\butili[sz]ation\b.*" + _BY + r"(?:vehicle |truck )?types?\b"], intent="fleet_capacity"),
+    KPI("fleet_utilization", ["vehicles"], _fleet_utilization, _summarize_fleet_utilization,
+        [r"\b(?:fleet|vehicle|truck|capacity)s? utili[sz]ation\b", r"\butili[sz]ation (?:of|for|across) (?:the |our )?"
+         r"(?:fleet|vehicles|trucks)\b", r"\bload factors?\b"], intent="fleet_capacity"),
+    KPI("margin_by_customer", ["shipments"], _margin_by("customer_name"), _summarize_margin("customer_name"),
+        [r"\b(?:profit|margin|profitability)s?\b.*" + _BY + r"customers?\b", r"\bmost profitable customers?\b",
+         r"\bcustomers?\b.*\bmost profitable\b"], intent="financial", financial=True),
+    KPI("margin_by_cargo_type", ["shipments"], _margin_by("cargo_type"), _summarize_margin("cargo_type"),
+        [r"\b(?:profit|margin|profitability)s?\b.*" + _BY + r"(?:cargo|product)(?: types?)?\b",
+         r"\bmost profitable (?:cargo|product)(?: types?)?\b", r"\b(?:cargo|product)(?: types?)?\b.*\bmost profitable\b"], intent="financial", financial=True),
+    KPI("delays_by_origin", ["shipments"], _delays_by_origin, _summarize_delays_by_origin,
+        [r"\bdelay(?:s|ed)?\b.*" + _BY + r"(?:origin|origin city|city|cities)\b",
+         r"\bwhich (?:origin )?cities\b.*\bdelay", r"\bdelay rates?\b"], intent="delayed_shipments",
+        topic=r"\bdelay(?:s|ed)?\b"),
+    KPI("driver_rating_distribution", ["drivers"], _driver_rating_distribution, _summarize_rating_distribution,
+        [r"\bratings?\b.*\b(?:distribution|breakdown|spread|histogram)\b",
+         r"\b(?:distribution|breakdown|spread|histogram) of (?:the )?(?:driver )?ratings?\b"], intent="drivers"),
+]
+
+
+class KPIStore:
+    """KPI result rows with the source table versions they were computed from.
+
+    refresh() only recomputes the KPIs whose source tables changed since the last run.
+    """
+
+    def __init__(self, kpis=None):
+        self.kpis = list(DEFAULT_KPIS if kpis is None else kpis)
+        self.results = {}  # name -> {"rows", "sources", "computed_at"}
+        self.lookups = 0
+        self.hits = 0
+        self._payloads = {}  # include_financial -> (body, etag)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path, kpis=None):
+        store = cls(kpis)
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    store.results = json.load(f)["kpis"]
+            except (OSError, ValueError, KeyError) as e:
+                print(f"KPI Store: Could not load {path}: {e}")
+        return store
+
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path + ".tmp", "w") as f:
+            json.dump({"generated_at": datetime.now(timezone.utc).isoformat(), "kpis": self.results}, f)
+        os.replace(path + ".tmp", path)
+
+    def refresh(self, frames, versions=None):
+        """Recomputes KPIs whose source tables are in frames and have a new version; returns their names."""
+        versions = versions or {}
+        computed_at = datetime.now(timezone.utc).isoformat()
+        changed = []
+        for kpi in self.kpis:
+            if not all(t in frames for t in kpi.sources):
+                continue
+            sources = {t: versions.get(t, computed_at) for t in kpi.sources}
+            current = self.results.get(kpi.name)
+            # Without versions every refresh recomputes
+            if current is not None and current["sources"] == sources:
+                continue
+            rows = _records(kpi.compute(frames))
+            with self._lock:
+                self.results[kpi.name] = {"rows": rows, "sources": sources, "computed_at": computed_at}
+                self._payloads.clear()
+            changed.append(kpi.name)
+        if changed:
+            print(f"KPI Store: Recomputed {changed}")
+        return changed
+
+    def is_current(self, name, versions):
+        """True if the KPI exists and was computed from the given table versions (unknown versions count as current)."""
+        result = self.results.get(name)
+        if result is None:
+            return False
+        return not versions or all(versions.get(t, v) == v for t, v in result["sources"].items())
+
+    def match(self, query, role="Guest"):
+        """KPI answering the query, or None; financial KPIs are never served to Guests."""
+        query_lower = query.lower()
+        with self._lock:
+            self.lookups += 1
+        for kpi in self.kpis:
+            if kpi.name in self.results and kpi.matches(query_lower):
+                if kpi.financial and role == "Guest":
+                    return None
+                with self._lock:
+                    self.hits += 1
+                print(f"KPI Shortcut: HIT {kpi.name}")
+                return kpi
+        return None
+
+    def rows(self, name):
+        return self.results[name]["rows"]
+
+    def payload(self, include_financial=True):
+        """Serialized KPIs for /kpis and their ETag, rebuilt only after refresh()."""
+        with self._lock:
+            cached = self._payloads.get(include_financial)
+            if cached is None:
+                visible = {
+                    kpi.name: self.results[kpi.name] for kpi in self.kpis
+                    if kpi.name in self.results and (include_financial or not kpi.financial)
+                }
+                body = json.dumps({"kpis": visible})
+                etag = '"' + hashlib.sha1(body.encode("utf-8")).hexdigest()[:20] + '"'
+                cached = self._payloads[include_financial] = (body, etag)
+            return cached
+
+    def stats(self):
+        return {
+            "kpis": {name: result["computed_at"] for name, result in self.results.items()},
+            "lookups": self.lookups,
+            "hits": self.hits,
+        }
@@ -1,26 +1,120 @@
 print("LOADING MAIN.PY...")
+import os
+import time
+import threading
+import importlib
 import functions_framework
-from agents import get_multi_agent
+from flask import Response, stream_with_context
 import json
+import telemetry
+from samples import SAMPLE_CACHE_TTL, SamplePayloadCache, etag_matches, fetch_samples, shared_client
 
 # Configuration
 PROJECT_ID = "inspiring-keel-423204-c7"
 DATASET_ID = "logistics_control_tower"
 
+# Cold start: build the agent in a background thread as soon as the instance starts,
+# instead of on the first user request. Heavy LangChain/Vertex imports happen there too.
+PREWARM_ON_START = os.getenv("PREWARM_ON_START", "true").lower() == "true"
+# Import-time profile mode: times each heavy dependency import at startup
+PROFILE_IMPORTS = os.getenv("PROFILE_IMPORTS", "false").lower() == "true"
+HEAVY_IMPORTS = [
+    "google.cloud.bigquery",
+    "sqlalchemy",
+    "sqlalchemy_bigquery",
+    "langchain_core",
+    "langchain_community.utilities",
+    "langchain_community.agent_toolkits",
+    "langchain_google_vertexai",
+]
+
+# Largest number of queries accepted by one /query/batch request
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", "500"))
+
+# Serialized /sample payload shared by all requests on this instance
+sample_cache = SamplePayloadCache(
+    lambda: fetch_samples(shared_client(PROJECT_ID), PROJECT_ID, DATASET_ID), SAMPLE_CACHE_TTL
+)
+
 # Global variable to hold the agent instance
 agent = None
+_agent_lock = threading.Lock()
+startup_timings = {}
+# KPI store read from the shipped file until the agent (which keeps it current) is ready
+_kpi_store = None
+
+def profile_imports():
+    """Imports each heavy dependency in turn and records how long it took (cumulative order matters)."""
+    for module in HEAVY_IMPORTS:
+        started = time.perf_counter()
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            print(f"Import Profile: {module} unavailable ({e})")
+            continue
+        startup_timings[f"import_{module}_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    print(f"Import Profile (ms): {startup_timings}")
 
 def get_agent():
-    """Lazy initialization of the Multi-Agent Logistics System."""
+    """Lazy, thread-safe initialization of the Multi-Agent Logistics System."""
     global agent
     if agent is None:
-        print("Initializing Multi-Agent Logistics Workflow...")
-        agent = get_multi_agent()
+        with _agent_lock:
+            if agent is None:
+                print("Initializing Multi-Agent Logistics Workflow...")
+                started = time.perf_counter()
+                from agents import get_multi_agent
+                startup_timings["import_agents_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                new_agent = get_multi_agent()
+                startup_timings.update(new_agent.startup_timings)
+                startup_timings["init_total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+                print(f"Startup Breakdown (ms): {startup_timings}")
+                agent = new_agent
     return agent
 
+def get_kpis():
+    """KPI store for /kpis; answers from the shipped file without initializing the agent."""
+    global _kpi_store
+    if agent is not None:
+        return agent.kpis
+    if _kpi_store is None:
+        from kpis import KPI_STORE_PATH, KPIStore
+        _kpi_store = KPIStore.load(KPI_STORE_PATH)
+    return _kpi_store
+
+def warmup():
+    """Builds the agent and primes its caches; returns the startup breakdown per phase."""
+    started = time.perf_counter()
+    current_agent = get_agent()
+    startup_timings.update(current_agent.warmup())
+    startup_timings["warmup_total_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return dict(startup_timings)
+
+def _prewarm():
+    try:
+        if PROFILE_IMPORTS:
+            profile_imports()
+        warmup()
+    except Exception as e:
+        # The first request will retry initialization and surface the error
+        print(f"Background pre-initialization failed: {e}")
+
+if PREWARM_ON_START:
+    threading.Thread(target=_prewarm, name="agent-prewarm", daemon=True).start()
+
 @functions_framework.http
 def process_query(request):
     """HTTP Cloud Function to handle /query and /health."""
+    started = time.perf_counter()
+    response = _handle_request(request)
+    status = response.status_code if isinstance(response, Response) else response[1]
+    # Unknown paths share one label so scanners cannot blow up the metric cardinality;
+    # streaming responses are timed until the stream starts
+    route = "unmatched" if status == 404 else (request.path.rstrip('/') or '/')
+    telemetry.observe_request(route, request.method, status, time.perf_counter() - started)
+    return response
+
+def _handle_request(request):
     # CORS headers
     headers = {
         'Access-Control-Allow-Origin': '*',
@@ -38,7 +132,15 @@ def process_query(request):
     # Health Check Route
     if path == '/health' or path == '':
         if request.method == 'GET':
-            return (json.dumps({"status": "healthy"}), 200, headers)
+            return (json.dumps({"status": "healthy", "agent_ready": agent is not None}), 200, headers)
+
+    # Warmup Route (blocks until the agent is initialized; used by startup probes and schedulers)
+    if path == '/warmup':
+        if request.method in ('GET', 'POST'):
+            try:
+                return (json.dumps({"status": "ready", "startup": warmup()}), 200, headers)
+            except Exception as e:
+                return (json.dumps({"status": "failed", "error": str(e), "startup": startup_timings}), 500, headers)
 
     # Query Route
     if path == '/query' or path == '':
@@ -49,49 +151,172 @@ def process_query(request):
             query = request_json.get('query')
             role = request_json.get('role', 'Guest')
             history = request_json.get('history', '')
+            # Server-side history: with a session_id the stored, compacted conversation replaces 'history'
+            session_id = request_json.get('session_id')
             
             if not query:
                 return (json.dumps({"error": "No query provided"}), 400, headers)
 
-            print(f"Processing Query: {query} | Role: {role} | History Length: {len(history)}")
+            print(f"Processing Query: {query} | Role: {role} | History Length: {len(history)} | Session: {session_id}")
             try:
                 current_agent = get_agent()
-                result = current_agent.run(query, role=role, history=history)
-                return (json.dumps({
+                result = current_agent.run(query, role=role, history=history, session_id=session_id)
+                response = {
                     "summary": result.get("summary", ""),
                     "sql": result.get("sql", "-- Agent Executed --"),
                     "error": result.get("error"),
-                    "followups": result.get("followups", [])
-                }), 200, headers)
+                    "followups": result.get("followups", []),
+                    "cached": result.get("cached", False),
+                    "coalesced": result.get("coalesced", False),
+                    "session_id": result.get("session_id"),
+                    "history_tokens": result.get("history_tokens", 0),
+                    "prompt_tokens_saved": result.get("prompt_tokens_saved", 0)
+                }
+                # Optional per-stage breakdown: {"timings": true} in the body or ?timings=1
+                if request_json.get('timings') or request.args.get('timings') in ('1', 'true'):
+                    response["timings"] = {"stages": result.get("timings", {}), "spans": result.get("trace", [])}
+                return (json.dumps(response), 200, headers)
             except Exception as e:
                 print(f"Error running agent: {str(e)}")
                 return (json.dumps({"error": str(e)}), 500, headers)
 
+    # Batch Query Route (many queries, bounded concurrency, identical SQL shared across the batch)
+    if path == '/query/batch':
+        if request.method == 'POST':
+            request_json = request.get_json(silent=True)
+            items = (request_json or {}).get('queries')
+            if not isinstance(items, list) or not items or not all(isinstance(i, dict) for i in items):
+                return (json.dumps({"error": "Body must contain a non-empty 'queries' list of objects"}), 400, headers)
+            if len(items) > BATCH_MAX_ITEMS:
+                return (json.dumps({"error": f"At most {BATCH_MAX_ITEMS} queries per batch"}), 400, headers)
+
+            concurrency = request_json.get('concurrency')
+            if concurrency is not None and (not isinstance(concurrency, int) or concurrency < 1):
+                return (json.dumps({"error": "'concurrency' must be a positive integer"}), 400, headers)
+
+            print(f"Processing Batch: {len(items)} queries")
+            try:
+                batch = get_agent().run_batch(items, concurrency=concurrency)
+                return (json.dumps(batch, default=str), 200, headers)
+            except Exception as e:
+                print(f"Error running batch: {str(e)}")
+                return (json.dumps({"error": str(e)}), 500, headers)
+
+    # Streaming Query Route (newline-delimited JSON events)
+    if path == '/query/stream':
+        if request.method == 'POST':
+            request_json = request.get_json(silent=True)
+            if not request_json:
+                return (json.dumps({"error": "Invalid or missing JSON body"}), 400, headers)
+            query = request_json.get('query')
+            role = request_json.get('role', 'Guest')
+            history = request_json.get('history', '')
+            session_id = request_json.get('session_id')
+
+            if not query:
+                return (json.dumps({"error": "No query provided"}), 400, headers)
+
+            print(f"Streaming Query: {query} | Role: {role} | History Length: {len(history)} | Session: {session_id}")
+            current_agent = get_agent()
+
+            def generate():
+                for event in current_agent.run_stream(query, role=role, history=history, session_id=session_id):
+                    yield json.dumps(event) + "\n"
+
+            # X-Accel-Buffering stops intermediate proxies from holding back chunks
+            stream_headers = dict(headers, **{'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+            return Response(stream_with_context(generate()), status=200,
+                            mimetype='application/x-ndjson', headers=stream_headers)
+
     # Sample Data Route
     if path == '/sample':
         if request.method == 'GET':
             try:
-                from google.cloud import bigquery
-                client = bigquery.Client(project=PROJECT_ID)
-                tables = ["shipments", "drivers", "vehicles"]
-                samples = {}
-                for t in tables:
-                    query = f"SELECT * FROM `{PROJECT_ID}.{DATASET_ID}.{t}` LIMIT 5"
-                    results = client.query(query).result()
-                    samples[t] = [dict(row.items()) for row in results]
-                
-                # Custom serializer for Date/Time objects
-                def json_serial(obj):
-                    from datetime import date, datetime
-                    from decimal import Decimal
-                    if isinstance(obj, (date, datetime)):
-                        return obj.isoformat()
-                    if isinstance(obj, Decimal):
-                        return float(obj)
-                    raise TypeError(f"Type {type(obj)} not serializable")
-
-                return (json.dumps(samples, default=json_serial), 200, headers)
+                body, etag = sample_cache.get()
+                sample_headers = dict(headers, **{
+                    'ETag': etag,
+                    'Cache-Control': f'public, max-age={SAMPLE_CACHE_TTL}',
+                    'Content-Type': 'application/json'
+                })
+                if etag_matches(request.headers.get('If-None-Match'), etag):
+                    return ('', 304, sample_headers)
+                return (body, 200, sample_headers)
+            except Exception as e:
+                return (json.dumps({"error": str(e)}), 500, headers)
+
+    # KPI Route (precomputed aggregates for dashboards; financial KPIs are hidden from Guests)
+    if path == '/kpis':
+        if request.method == 'GET':
+            try:
+                body, etag = get_kpis().payload(include_financial=request.args.get('role', 'Guest') != 'Guest')
             except Exception as e:
                 return (json.dumps({"error": str(e)}), 500, headers)
+            # Clients revalidate with If-None-Match; the ETag changes whenever a KPI is recomputed
+            kpi_headers = dict(headers, **{'ETag': etag, 'Cache-Control': 'no-cache', 'Content-Type': 'application/json'})
+            if etag_matches(request.headers.get('If-None-Match'), etag):
+                return ('', 304, kpi_headers)
+            return (body, 200, kpi_headers)
+
+    # Vehicle Telemetry Route (X-API-Key; pings for known vehicles land in the in-memory fleet state, the agent flushes it)
+    if path == '/telemetry':
+        if request.method == 'POST':
+            from fleet_state import TELEMETRY_MAX_PINGS, authorize, parse_payload
+            denied = authorize(request.headers.get('X-API-Key'))
+            if denied:
+                return (json.dumps({"error": denied[1]}), denied[0], headers)
+            pings, unparsable = parse_payload(request.get_data(), request.content_type)
+            if len(pings) > TELEMETRY_MAX_PINGS:
+                return (json.dumps({"error": f"At most {TELEMETRY_MAX_PINGS} pings per request"}), 413, headers)
+            try:
+                # Seeds the known fleet and starts the flusher on the first ping of a cold instance
+                current_agent = get_agent()
+                current_agent.start_fleet_state()
+            except Exception as e:
+                return (json.dumps({"error": str(e)}), 500, headers)
+            if current_agent.fleet_state.fleet is None:
+                return (json.dumps({"error": "Vehicle list not loaded yet, retry later"}), 503, headers)
+            result = current_agent.fleet_state.ingest(pings)
+            result["rejected"] += unparsable
+            result["vehicles"] = current_agent.fleet_state.size
+            return (json.dumps(result), 200, headers)
+
+    # Dispatch Route (vehicle assignment for pending/delayed shipments, computed by the optimizer)
+    if path == '/dispatch':
+        if request.method == 'GET':
+            try:
+                return (json.dumps(get_agent().plan_dispatch()), 200, headers)
+            except Exception as e:
+                return (json.dumps({"error": str(e)}), 500, headers)
+
+    # Schema Route (table DDL and sample rows for the frontend's schema view)
+    if path == '/schema':
+        if request.method == 'GET':
+            try:
+                return (json.dumps({"schema": get_agent().db.get_table_info()}), 200, headers)
+            except Exception as e:
+                return (json.dumps({"error": str(e)}), 500, headers)
+
+    # Cache Statistics / Invalidation Route
+    if path == '/cache':
+        if request.method == 'GET':
+            return (json.dumps(get_agent().cache_stats()), 200, headers)
+    if path == '/cache/invalidate':
+        if request.method == 'POST':
+            from cache import authorize_invalidation
+            denied = authorize_invalidation(request.headers.get('X-API-Key'))
+            if denied:
+                return (json.dumps({"error": denied[1]}), denied[0], headers)
+            return (json.dumps(get_agent().invalidate_caches()), 200, headers)
+
+    # Prometheus Metrics Route (stage/request histograms, LLM tokens, SQL statements, BigQuery bytes)
+    if path == '/metrics':
+        if request.method == 'GET':
+            metrics_headers = dict(headers, **{'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+            return (telemetry.METRICS.render(), 200, metrics_headers)
+
+    # Query Template Statistics Route (hits per template and recent misses to grow the registry)
+    if path == '/templates':
+        if request.method == 'GET':
+            return (json.dumps(get_agent().templates.stats()), 200, headers)
 
     return (json.dumps({"error": f"Not Found: {path}"}), 404, headers)
@@ -0,0 +1,146 @@
+import os
+import re
+from geo import GridIndex, city_coordinates, find_place
+
+# Radius of "near <place>" questions without an explicit "within N km"
+GEO_NEAR_RADIUS_KM = float(os.getenv("GEO_NEAR_RADIUS_KM", "50"))
+# Matches listed for "nearest vehicles/drivers" without a count, and when nothing is within the radius
+GEO_NEAREST_K = int(os.getenv("GEO_NEAREST_K", "3"))
+# Matches listed per answer
+GEO_ANSWER_ROWS = 10
+
+DRIVERS_SQL = "SELECT id, name, status, rating, current_location FROM drivers"
+# Status values that count as "available"
+AVAILABLE = {"vehicles": ("status", "Active"), "drivers": ("status", "On Duty")}
+
+_PROXIMITY = re.compile(r"\b(near|nearby|nearest|closest|around|close to|within \d+(?:\.\d+)?\s*km)\b")
+_PLURAL = re.compile(r"\b(vehicles|trucks|vans|drivers)\b")
+_COUNT = re.compile(r"\b(?:nearest|closest)\s+(\d+)\b|\b(\d+)\s+(?:nearest|closest)\b")
+_RADIUS = re.compile(r"(\d+(?:\.\d+)?)\s*km\b")
+# Conditions the spatial lookup cannot apply, left to the Data Analyst: comparisons ("trucks near Paris with
+# fuel below 20%"), statuses ("vehicles near Berlin in maintenance"), aggregates ("how many trucks near Paris")
+# and relative clauses ("drivers near Rome who have a rating above 4")
+EXTRA_FILTERS = re.compile(
+    r"\b(below|above|under|over|less|more|than|between|percent"
+    r"|maintenance|repair|service|idle|active|inactive|retired|duty|delayed|pending|transit|delivered"
+    r"|how many|count|number of|total|average|avg|sum"
+    r"|with|that|who|whose|where)\b|%",
+    re.I,
+)
+
+
+def parse_proximity(query):
+    """Parses "vehicles near London" / "closest available driver to Berlin" / "trucks within 100 km of Paris".
+
+    Returns {"kind", "place", "lat", "lon", "available", and "radius_km" or "k"}, or None for other questions.
+    Only explicit proximity words count: "vehicles in Berlin" is not a radius lookup, and "drivers in <city>"
+    is left to the driver template (exact current_location match).
+    """
+    lowered = query.lower()
+    if re.search(r"\bdrivers?\b", lowered):
+        kind = "drivers"
+    elif re.search(r"\b(vehicles?|trucks?|vans?)\b", lowered):
+        kind = "vehicles"
+    else:
+        return None
+    near = _PROXIMITY.search(lowered)
+    if near is None:
+        return None
+    place = find_place(query)
+    if place is None:
+        return None
+    name, (lat, lon) = place
+    request = {"kind": kind, "place": name, "lat": lat, "lon": lon,
+               "available": bool(re.search(r"\b(available|free)\b", lowered))}
+    count, radius = _COUNT.search(lowered), _RADIUS.search(lowered)
+    if radius:
+        request["radius_km"] = float(radius.group(1))
+    elif count:
+        request["k"] = int(count.group(1) or count.group(2))
+    elif near is not None and near.group(1) in ("nearest", "closest"):
+        # "the closest driver" is one, "the nearest trucks" a short list
+        request["k"] = GEO_NEAREST_K if _PLURAL.search(lowered) else 1
+    else:
+        request["radius_km"] = GEO_NEAR_RADIUS_KM
+    return request
+
+
+class DriverIndex:
+    """Drivers geocoded by current_location (CITY_COORDINATES) into a GridIndex, rebuilt when the rows change."""
+
+    def __init__(self):
+        self.rows = None
+        self.index = GridIndex()
+        self.by_id = {}
+
+    def refresh(self, rows):
+        """Rebuilds from a drivers result set; the same (cached) rows object is a no-op."""
+        if rows is self.rows:
+            return
+        index = GridIndex()
+        for r in rows:
+            position = city_coordinates(r.get("current_location"))
+            if position is not None:
+                index.update(r["id"], *position)
+        # Swapped in whole, so concurrent lookups see either the old or the new index
+        self.index, self.by_id, self.rows = index, {r["id"]: r for r in rows}, rows
+
+
+def lookup(request, index, details):
+    """Rows (details plus distance_km) matching a parsed request, nearest first.
+
+    index is a GridIndex or FleetState; details maps its keys to table rows (unknown keys are skipped).
+    Returns (rows, fallback); fallback means nothing was within the radius and the nearest ones are listed.
+    """
+    column, value = AVAILABLE[request["kind"]]
+
+    def where(key):
+        return key in details and (not request["available"] or details[key].get(column) == value)
+
+    lat, lon = request["lat"], request["lon"]
+    fallback = False
+    if "k" in request:
+        found = index.nearest(lat, lon, request["k"], where)
+    else:
+        found = index.within(lat, lon, request["radius_km"], where)
+        if not found:
+            found, fallback = index.nearest(lat, lon, GEO_NEAREST_K, where), True
+    return [dict(details[key], distance_km=round(km, 1)) for key, km in found], fallback
+
+
+def with_live_state(rows, fleet_state):
+    """Vehicle rows with the live position, fuel and load from the fleet state where reported."""
+    live = {r["vehicle_id"]: r for r in fleet_state.snapshot([row["vehicle_id"] for row in rows])}
+    for row in rows:
+        for field in ("gps_coordinates", "fuel_level", "current_load_kg"):
+            if live.get(row["vehicle_id"], {}).get(field) is not None:
+                row[field] = live[row["vehicle_id"]][field]
+    return rows
+
+
+def _describe(kind, row):
+    if kind == "drivers":
+        return (f"driver {row['id']} {row.get('name')} ({row.get('status')}, rating {row.get('rating')}) "
+                f"in {row.get('current_location')}, {row['distance_km']:.0f} km away")
+    return (f"vehicle {row['vehicle_id']} ({row.get('type')}, {row.get('status')}) at {row.get('gps_coordinates')}, "
+            f"{row['distance_km']:.0f} km away, fuel {row.get('fuel_level')}%, "
+            f"load {row.get('current_load_kg')}/{row.get('capacity_kg')} kg")
+
+
+def summarize(request, rows, fallback):
+    """Analyst-style text of a proximity lookup."""
+    noun = ("available " if request["available"] else "") + request["kind"]
+    if "k" in request:
+        scope = f"nearest to {request['place']}"
+    else:
+        scope = f"within {request['radius_km']:.0f} km of {request['place']}"
+    if not rows:
+        return f"No {noun} with a known position."
+    if fallback:
+        lines = [f"No {noun} {scope}. The nearest ones are:"]
+    else:
+        lines = [f"{noun.capitalize()} {scope}:"]
+    lines += [f"- {_describe(request['kind'], row)}" for row in rows[:GEO_ANSWER_ROWS]]
+    if len(rows) > GEO_ANSWER_ROWS:
+        lines.append(f"... {len(rows) - GEO_ANSWER_ROWS} more")
+    return "\n".join(lines)
@@ -0,0 +1,190 @@
+import os
+import re
+from followups import KNOWN_CITIES, extract_entities
+from tables import KEY_COLUMNS
+from warehouse import canonicalize_sql, referenced_tables
+
+# Largest ID set kept per table and turn (bigger result sets are left to the Data Analyst)
+REFERENCE_MAX_KEYS = int(os.getenv("REFERENCE_MAX_KEYS", "200"))
+
+_NOUNS = {
+    "shipments": r"shipments?|orders?|deliveries|delivery|cargo",
+    "vehicles": r"vehicles?|trucks?|vans?",
+    "drivers": r"drivers?",
+}
+# A determiner directly in front of a table noun, optionally with one word between ("those delayed shipments").
+# Bare pronouns (them, their, it) are too ambiguous to resolve without the Data Analyst.
+_REFERENCE = re.compile(
+    r"\b(?:those|these|that|this|the same|the above|the previous|said)\s+(?:\w+\s+)?("
+    + "|".join(f"(?P<{table}>{pattern})" for table, pattern in _NOUNS.items()) + r")\b",
+    re.I,
+)
+# "all vehicles" asks about the whole table again ("all of those shipments" still refers back)
+_ALL = re.compile(r"\ball\b(?!\s+(?:of\s+)?(?:those|these|the same|the above|the previous|said)\b)", re.I)
+# Columns hidden from Guests, like the financial KPIs
+FINANCIAL_COLUMNS = {"cost", "revenue", "salary"}
+_FINANCIAL = re.compile(r"\b(?:cost|costs|revenue|profit|profits|margin|salary|salaries|price|money)\b", re.I)
+# Conditions on the referenced rows ("how many of those shipments are delayed / going to Paris / high priority"):
+# answer_from_rows cannot apply them, so these questions go to the Data Analyst
+_CONDITION = re.compile(
+    r"\b(?:delayed|pending|delivered|in transit|active|maintenance|on duty|off duty|insured|uninsured"
+    r"|urgent|high|standard|low|priority|above|below|over|under|more than|less than|greater|fewer|between"
+    r"|at least|at most|" + "|".join(re.escape(c.lower()) for c in KNOWN_CITIES) + r")\b|[<>=%]",
+    re.I,
+)
+_FIRST_TABLE = re.compile(r"\bfrom\s+`?(?:[\w-]+\.)*(\w+)`?")
+
+_AGGREGATES = [
+    ("sum", re.compile(r"\b(?:total|sum|combined|overall)\b")),
+    ("avg", re.compile(r"\b(?:average|avg|mean)\b")),
+    ("max", re.compile(r"\b(?:highest|max|maximum|most|largest|biggest)\b")),
+    ("min", re.compile(r"\b(?:lowest|min|minimum|least|smallest)\b")),
+    ("count", re.compile(r"\b(?:how many|count|number of)\b")),
+]
+_AGGREGATE_LABELS = {"sum": "Total", "avg": "Average", "max": "Highest", "min": "Lowest"}
+# Column name parts too generic to identify a column on their own
+_GENERIC_WORDS = {"id", "kg", "km", "level", "number", "years", "current", "last"}
+_SYNONYMS = {"fuel_level": ["fuel"], "current_load_kg": ["load"], "gps_coordinates": ["location", "position", "gps"],
+             "current_location": ["location", "where"], "insurance_status": ["insured"], "contact_number": ["phone"]}
+
+
+def _label(table):
+    return table[:-1].title()
+
+
+def result_keys(sql, rows):
+    """Primary keys per table in a result set, e.g. {"shipments": [14, 50]}.
+
+    "id" is attributed to the statement's first FROM table; vehicle_id always identifies vehicles.
+    """
+    if not sql or not rows:
+        return {}
+    canonical = canonicalize_sql(sql)
+    tables = referenced_tables(canonical, list(KEY_COLUMNS))
+    first = _FIRST_TABLE.search(canonical)
+    keys = {}
+    for table in tables:
+        column = KEY_COLUMNS[table]
+        if column == "id" and (first is None or first.group(1) != table):
+            continue
+        values = []
+        for row in rows:
+            value = row.get(column)
+            if isinstance(value, int) and value not in values:
+                values.append(value)
+        if values and len(values) <= REFERENCE_MAX_KEYS:
+            keys[table] = values
+    return keys
+
+
+class Reference:
+    """A pronoun-style reference to the IDs an earlier turn returned."""
+
+    def __init__(self, table, ids, source_query):
+        self.table = table
+        self.column = KEY_COLUMNS[table]
+        self.ids = ids
+        self.source_query = source_query
+
+    def sql(self, columns):
+        """Keyed lookup of the referenced rows (only the given columns); the text is identical for every question
+        about the same set and role."""
+        id_list = ", ".join(str(int(i)) for i in self.ids)
+        return (f"SELECT {', '.join(columns)} FROM {self.table} WHERE {self.column} IN ({id_list}) "
+                f"ORDER BY {self.column}")
+
+    def hint(self):
+        """Context for the Data Analyst when the question cannot be answered from the rows alone."""
+        id_list = ", ".join(str(i) for i in self.ids)
+        return (f"Referenced {self.table} (from \"{self.source_query}\"): {self.column} IN ({id_list}). "
+                f"Filter on these IDs instead of searching again.")
+
+    def marker(self):
+        return f"{self.table}:{','.join(str(i) for i in self.ids)}"
+
+
+def visible_columns(columns, role):
+    """The columns a role may read; Guests do not see financial columns."""
+    return [c for c in columns if role != "Guest" or c not in FINANCIAL_COLUMNS]
+
+
+def resolve_reference(query, turns):
+    """Resolves "those shipments", "these vehicles", "that driver" to the IDs of the most recent turn
+    that returned rows of that table, or None."""
+    match = _REFERENCE.search(query) if turns else None
+    if match is None or _ALL.search(query):
+        return None
+    # Explicit IDs mean the user is naming rows directly
+    entities = extract_entities(query)
+    if entities["shipment_id"] or entities["vehicle_id"]:
+        return None
+    table = next(t for t in _NOUNS if match.group(t))
+    for turn in reversed(turns):
+        ids = (turn.get("keys") or {}).get(table)
+        if ids:
+            return Reference(table, ids, turn["query"])
+    return None
+
+
+def _requested_columns(query, columns):
+    words = set(re.findall(r"[a-z]+", query.lower()))
+    words |= {w[:-1] for w in words if w.endswith("s")}
+    requested = []
+    for column in columns:
+        # The leading distinctive word names the column ("insurance" for insurance_status, "load" for current_load_kg)
+        parts = [p for p in column.split("_") if p not in _GENERIC_WORDS][:1] + _SYNONYMS.get(column, [])
+        if any(p in words for p in parts):
+            requested.append(column)
+    return requested
+
+
+def _format(value):
+    if isinstance(value, float):
+        return f"{value:,.2f}"
+    return str(value)
+
+
+def answer_from_rows(query, reference, rows, role="Guest"):
+    """Answers simple projections and aggregates over the referenced rows, or None for the Data Analyst
+    (also when the question filters them further).
+
+    rows should hold only the role's visible_columns; financial questions are refused for Guests.
+    """
+    if role == "Guest" and _FINANCIAL.search(query):
+        return "🚫 Access Denied: Guests cannot access financial data."
+    if not rows:
+        return f"None of the referenced {reference.table} ({', '.join(map(str, reference.ids))}) were found."
+    # The reference phrase itself may carry the earlier turn's filter ("those delayed shipments")
+    if _CONDITION.search(_REFERENCE.sub(" ", query)):
+        return None
+    query_lower = query.lower()
+    label, noun = _label(reference.table), reference.table
+    scope = f"the {len(rows)} referenced {noun} ({', '.join(str(r[reference.column]) for r in rows)})"
+    columns = [c for c in _requested_columns(query, list(rows[0])) if c != reference.column]
+    aggregate = next((name for name, pattern in _AGGREGATES if pattern.search(query_lower)), None)
+
+    if aggregate == "count" and not columns:
+        return f"There are {len(rows)} {noun} in the referenced set: {', '.join(str(r[reference.column]) for r in rows)}."
+    if not columns:
+        return None
+    if aggregate in _AGGREGATE_LABELS:
+        lines = []
+        for column in columns:
+            values = [r[column] for r in rows if isinstance(r.get(column), (int, float)) and not isinstance(r[column], bool)]
+            if not values:
+                return None
+            if aggregate in ("sum", "avg"):
+                value = sum(values) if aggregate == "sum" else sum(values) / len(values)
+                lines.append(f"{_AGGREGATE_LABELS[aggregate]} {column.replace('_', ' ')}: {_format(value)}")
+            else:
+                best = (max if aggregate == "max" else min)(
+                    (r for r in rows if r.get(column) in values), key=lambda r: r[column]
+                )
+                lines.append(f"{_AGGREGATE_LABELS[aggregate]} {column.replace('_', ' ')}: {_format(best[column])} "
+                             f"({label} {best[reference.column]})")
+        return f"For {scope}:\n" + "\n".join(f"- {line}" for line in lines)
+    lines = [
+        f"- {label} {r[reference.column]}: " + ", ".join(f"{c.replace('_', ' ')} {_format(r.get(c))}" for c in columns)
+        for r in rows
+    ]
+    return f"For {scope}:\n" + "\n".join(lines)
@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime
+from decimal import Decimal
+
+SAMPLE_TABLES = ["shipments", "drivers", "vehicles"]
+SAMPLE_ROWS = int(os.getenv("SAMPLE_ROWS", "5"))
+# How long the serialized /sample payload is reused before the tables are read again
+SAMPLE_CACHE_TTL = int(os.getenv("SAMPLE_CACHE_TTL", "60"))
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def shared_client(project_id):
+    """Process-wide BigQuery client, so requests reuse its HTTP connection pool and credentials."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from google.cloud import bigquery
+                _client = bigquery.Client(project=project_id)
+    return _client
+
+
+def fetch_samples(client, project_id, dataset_id, tables=SAMPLE_TABLES, limit=SAMPLE_ROWS):
+    """Returns the first rows of each table as {table: [row dicts]} for the Data Explorer.
+
+    Rows are read with list_rows (table data API, no query job) and the tables are fetched in parallel.
+    """
+    def read(table):
+        return [dict(row.items()) for row in client.list_rows(f"{project_id}.{dataset_id}.{table}", max_results=limit)]
+
+    with ThreadPoolExecutor(max_workers=len(tables), thread_name_prefix="sample") as pool:
+        return dict(zip(tables, pool.map(read, tables)))
+
+
+def json_serial(obj):
+    """json.dumps default for the Date/Time and NUMERIC values BigQuery returns."""
+    if isinstance(obj, (date, datetime)):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError(f"Type {type(obj)} not serializable")
+
+
+class SamplePayloadCache:
+    """Serialized /sample payload and its ETag, rebuilt by loader() once ttl_seconds have passed."""
+
+    def __init__(self, loader, ttl_seconds=SAMPLE_CACHE_TTL):
+        self.loader = loader
+        self.ttl_seconds = ttl_seconds
+        self._payload = None  # (body, etag, built_at)
+        self._lock = threading.Lock()
+
+    def get(self):
+        """Returns (body, etag); concurrent requests after expiry wait for a single rebuild."""
+        payload = self._payload
+        if payload is None or time.monotonic() - payload[2] > self.ttl_seconds:
+            with self._lock:
+                payload = self._payload
+                if payload is None or time.monotonic() - payload[2] > self.ttl_seconds:
+                    body = json.dumps(self.loader(), default=json_serial)
+                    etag = '"' + hashlib.sha1(body.encode("utf-8")).hexdigest()[:20] + '"'
+                    payload = self._payload = (body, etag, time.monotonic())
+        return payload[0], payload[1]
+
+
+def etag_matches(if_none_match, etag):
+    """True if an If-None-Match header value lists the ETag (or is *)."""
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+from datetime import datetime, timezone
+
+# Descriptions used when a BigQuery column has none, so the analyst knows units and formats
+COLUMN_DESCRIPTIONS = {
+    "shipments": {
+        "id": "Shipment identifier",
+        "status": "One of 'Pending', 'In Transit', 'Delayed', 'Delivered'",
+        "priority": "One of 'Standard', 'High', 'Urgent'",
+        "cost": "Operating cost of the shipment in USD (financial)",
+        "revenue": "Revenue billed for the shipment in USD (financial)",
+        "weight_kg": "Cargo weight in kilograms",
+        "delivery_date": "Scheduled delivery timestamp",
+        "insurance_status": "True if the cargo is insured",
+    },
+    "drivers": {
+        "id": "Driver identifier",
+        "status": "One of 'On Duty', 'Off Duty', 'Maintenance'",
+        "rating": "Average driver rating from 1.0 to 5.0",
+        "current_location": "City the driver is currently in",
+        "salary": "Monthly salary in USD (financial)",
+    },
+    "vehicles": {
+        "vehicle_id": "Vehicle identifier",
+        "status": "One of 'Active', 'Maintenance'",
+        "capacity_kg": "Maximum payload in kilograms",
+        "fuel_level": "Fuel tank level in percent (0-100)",
+        "current_load_kg": "Payload currently on board in kilograms",
+        "gps_coordinates": "Last known position as text, e.g. '51.5074 N, 0.1278 W'",
+    },
+}
+
+
+def _columns(bq_table, table_name):
+    defaults = COLUMN_DESCRIPTIONS.get(table_name, {})
+    return [
+        {
+            "name": field.name,
+            "type": field.field_type,
+            "mode": field.mode,
+            "description": field.description or defaults.get(field.name, ""),
+        }
+        for field in bq_table.schema
+    ]
+
+
+def compute_schema_version(tables):
+    """Hash of every table's column names, types, modes and descriptions."""
+    canonical = json.dumps(
+        {name: [[c["name"], c["type"], c["mode"], c["description"]] for c in columns]
+         for name, columns in sorted(tables.items())},
+        sort_keys=True,
+    )
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()[:16]
+
+
+def live_schema_version(client, project_id, dataset_id, table_names):
+    """Schema version of the live tables, computed from table metadata only (no query jobs)."""
+    return compute_schema_version({
+        t: _columns(client.get_table(f"{project_id}.{dataset_id}.{t}"), t) for t in table_names
+    })
+
+
+def format_table_info(table_name, columns, sample_rows):
+    """Renders DDL, column descriptions and sample rows in the layout LangChain's SQLDatabase uses."""
+    column_lines = []
+    for i, c in enumerate(columns):
+        not_null = " NOT NULL" if c["mode"] == "REQUIRED" else ""
+        separator = "," if i < len(columns) - 1 else ""
+        comment = f" -- {c['description']}" if c["description"] else ""
+        column_lines.append(f"\t`{c['name']}` {c['type']}{not_null}{separator}{comment}")
+    ddl = f"CREATE TABLE `{table_name}` (\n" + "\n".join(column_lines) + "\n)"
+
+    names = [c["name"] for c in columns]
+    rows = "\n".join("\t".join(str(row.get(n)) for n in names) for row in sample_rows)
+    return f"{ddl}\n\n/*\n{len(sample_rows)} rows from {table_name} table:\n" + "\t".join(names) + f"\n{rows}\n*/"
+
+
+class SchemaSnapshot:
+    """Table DDL, column descriptions and sample rows captured once and shipped with the function."""
+
+    def __init__(self, data):
+        self.data = data
+
+    @property
+    def version(self):
+        return self.data["schema_version"]
+
+    @property
+    def tables(self):
+        return self.data["tables"]
+
+    def table_info(self, table_names=None):
+        """Custom table info for the given tables, or None if any of them is not in the snapshot."""
+        names = sorted(table_names) if table_names else sorted(self.tables)
+        if any(name not in self.tables for name in names):
+            return None
+        return "\n\n".join(self.tables[name]["table_info"] for name in names)
+
+    def custom_table_info(self):
+        return {name: table["table_info"] for name, table in self.tables.items()}
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.data, f, indent=2, default=str)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a snapshot file, returning None when it is missing or unreadable."""
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                return cls(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"Schema Snapshot: Could not load {path}: {e}")
+            return None
+
+
+def build_snapshot(client, project_id, dataset_id, table_names, sample_rows=3):
+    """Captures the current schema and a few sample rows per table straight from BigQuery metadata."""
+    tables = {}
+    for name in table_names:
+        bq_table = client.get_table(f"{project_id}.{dataset_id}.{name}")
+        columns = _columns(bq_table, name)
+        # list_rows reads table data directly, so no billed query job is started
+        rows = [dict(row.items()) for row in client.list_rows(bq_table, max_results=sample_rows)]
+        tables[name] = {
+            "columns": columns,
+            "sample_rows": rows,
+            "table_info": format_table_info(name, columns, rows),
+        }
+    return SchemaSnapshot(json.loads(json.dumps({
+        "schema_version": compute_schema_version({n: t["columns"] for n, t in tables.items()}),
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "dataset": f"{project_id}.{dataset_id}",
+        "tables": tables,
+    }, default=str)))
@@ -0,0 +1,180 @@
+import contextlib
+import contextvars
+import json
+import os
+import re
+from telemetry import METRICS
+
+KB = 1024
+MB = 1024 ** 2
+GB = 1024 ** 3
+
+# Per-role limits for one Data Analyst statement: bytes scanned (dry-run estimate) and rows returned.
+# SQL_ROLE_LIMITS (JSON, same shape) overrides them; unknown roles get the Guest limits.
+ROLE_LIMITS = {
+    "Logistics Manager": {"max_bytes": 10 * GB, "max_rows": 5000},
+    "Fleet Operator": {"max_bytes": 2 * GB, "max_rows": 1000},
+    "Guest": {"max_bytes": 200 * MB, "max_rows": 200},
+}
+ROLE_LIMITS.update(json.loads(os.getenv("SQL_ROLE_LIMITS", "{}")))
+# Hard cap BigQuery enforces on every query job, whatever the estimate said
+MAXIMUM_BYTES_BILLED = int(os.getenv("MAXIMUM_BYTES_BILLED", str(10 * GB)))
+# LIMIT appended to exploratory SELECTs that have none (capped by the role's max_rows)
+SQL_AUTO_LIMIT = int(os.getenv("SQL_AUTO_LIMIT", "100"))
+SQL_GUARD_ENABLED = os.getenv("SQL_GUARD_ENABLED", "true").lower() == "true"
+
+# Guard and role of the request whose Data Analyst is running (see SQLGuard.active)
+_active_guard = contextvars.ContextVar("sql_guard", default=None)
+
+_LIMIT = re.compile(r"\blimit\s+(\d+)(?:\s+offset\s+\d+)?$")
+_AGGREGATE = re.compile(r"\b(?:count|sum|avg|min|max)\s*\(")
+_WINDOW = re.compile(r"\bover\s*\(")
+_CROSS_JOIN = re.compile(r"\bcross\s+join\b")
+# Checked per scope, where subqueries are blanked to "(   )"
+_COMMA_JOIN = re.compile(r"\bfrom\s+(?:[`\w.\-]+|\(\s*\))(?:\s+(?:as\s+)?\w+)?\s*,\s*[`\w(]")
+_WHERE = re.compile(r"\bwhere\b")
+_SELECT_LIST = re.compile(r"\bselect\s+(?:distinct\s+)?(.*?)\s+from\b")
+_QUOTES = "'\""
+
+
+def _blank_nested(sql):
+    """sql with everything inside parentheses and string literals replaced by spaces, so positions still line up.
+
+    Regexes over the result only see the statement's own clauses, not those of subqueries or function calls.
+    """
+    out, depth, quote = [], 0, None
+    for ch in sql:
+        if quote:
+            out.append(" ")
+            quote = None if ch == quote else quote
+        elif ch in _QUOTES:
+            out.append(" " if depth else ch)
+            quote = ch
+        elif ch == "(":
+            out.append(ch if depth == 0 else " ")
+            depth += 1
+        elif ch == ")":
+            depth = max(depth - 1, 0)
+            out.append(ch if depth == 0 else " ")
+        else:
+            out.append(" " if depth else ch)
+    return "".join(out)
+
+
+def _scopes(sql):
+    """The statement and every parenthesized part of it (subqueries, CTE bodies), each with its own nesting blanked."""
+    blank = _blank_nested(sql)
+    yield blank
+    start = None
+    for i, ch in enumerate(blank):
+        if ch == "(":
+            start = i + 1
+        elif ch == ")" and start is not None:
+            yield from _scopes(sql[start:i])
+            start = None
+
+
+def _single_row_aggregate(canonical_sql):
+    """True if the outermost SELECT list is only aggregates (no window functions or subqueries) without GROUP BY."""
+    blank = _blank_nested(canonical_sql)
+    select = _SELECT_LIST.search(blank)
+    if select is None or " group by " in blank or re.search(r"\bunion\b", blank):
+        return False
+    start, end = select.span(1)
+    commas = [start + m.start() for m in re.finditer(",", blank[start:end])]
+    items = [canonical_sql[a + 1:b] for a, b in zip([start - 1] + commas, commas + [end])]
+    # A scalar subquery in the SELECT list ("(select count(*) from drivers)") does not make the row an aggregate
+    return all(_AGGREGATE.search(item) and not _WINDOW.search(item) and not re.search(r"\(\s*select\b", item)
+               for item in items)
+
+
+def format_bytes(n):
+    for unit, size in (("GB", GB), ("MB", MB), ("KB", KB)):
+        if n >= size:
+            return f"{n / size:.1f} {unit}"
+    return f"{n} bytes"
+
+
+class QueryRejected(Exception):
+    """Raised to the Data Analyst's query tool; the message tells the agent how to rewrite the query."""
+
+    def __init__(self, reason, message):
+        super().__init__(f"Query rejected by cost guard: {message}")
+        self.reason = reason
+
+
+class SQLGuard:
+    """Checks Data Analyst statements against per-role row and byte limits before they run."""
+
+    def __init__(self, limits=None, auto_limit=SQL_AUTO_LIMIT):
+        self.limits = dict(ROLE_LIMITS if limits is None else limits)
+        self.auto_limit = auto_limit
+
+    def limits_for(self, role):
+        return self.limits.get(role) or self.limits["Guest"]
+
+    @contextlib.contextmanager
+    def active(self, role):
+        """Applies this guard to statements issued through CachedSQLDatabase.run in the current context."""
+        token = _active_guard.set((self, role))
+        try:
+            yield self
+        finally:
+            _active_guard.reset(token)
+
+    def _reject(self, role, reason, message):
+        METRICS.inc("sql_guard_rejected_total", role=role, reason=reason)
+        print(f"SQL Guard: Rejected ({reason}) for {role}: {message}")
+        raise QueryRejected(reason, message)
+
+    def rewrite(self, command, canonical_sql, role):
+        """Structural checks and LIMIT handling; returns (statement to run, injected LIMIT or None)."""
+        if _CROSS_JOIN.search(canonical_sql) or any(_COMMA_JOIN.search(scope) and not _WHERE.search(scope)
+                                                    for scope in _scopes(canonical_sql)):
+            self._reject(role, "cross_join", "the join has no condition and multiplies rows. "
+                                             "Join the tables ON a key column (e.g. vehicle_id) instead.")
+        max_rows = self.limits_for(role)["max_rows"]
+        limit = _LIMIT.search(canonical_sql)
+        if limit and int(limit.group(1)) > max_rows:
+            self._reject(role, "rows", f"LIMIT {limit.group(1)} exceeds the {max_rows}-row limit for {role}. "
+                                       f"Use a smaller LIMIT or aggregate.")
+        command, injected = self.limited(command, canonical_sql, role)
+        if injected:
+            METRICS.inc("sql_guard_limit_injected_total", role=role)
+        return command, injected
+
+    def limited(self, command, canonical_sql, role):
+        """The statement as it runs for role: exploratory SELECTs without a LIMIT get one; returns (sql, LIMIT or None)."""
+        # A bare aggregate returns one row; everything else is exploratory
+        if _LIMIT.search(canonical_sql) or _single_row_aggregate(canonical_sql):
+            return command, None
+        injected = min(self.auto_limit, self.limits_for(role)["max_rows"])
+        return f"{command.rstrip().rstrip(';')}\nLIMIT {injected}", injected
+
+    def check_bytes(self, estimated_bytes, role, estimator):
+        """Rejects a statement whose estimated scan exceeds the role's byte limit."""
+        METRICS.inc("sql_guard_estimated_bytes_total", estimated_bytes, estimator=estimator)
+        max_bytes = self.limits_for(role)["max_bytes"]
+        if estimated_bytes > max_bytes:
+            self._reject(role, "bytes", f"it would scan {format_bytes(estimated_bytes)}, over the "
+                                        f"{format_bytes(max_bytes)} limit for {role}. Select only the columns "
+                                        f"you need and add WHERE filters or an aggregate.")
+
+    def stats(self):
+        return {"limits": self.limits, "auto_limit": self.auto_limit, "maximum_bytes_billed": MAXIMUM_BYTES_BILLED}
+
+
+def current_guard():
+    """(guard, role) for the running Data Analyst, or None outside a guarded scope."""
+    return _active_guard.get()
+
+
+def bigquery_dry_run(client_factory, default_dataset):
+    """Returns a callable estimating the bytes a statement would process, via a free BigQuery dry run."""
+    from google.cloud import bigquery
+
+    def estimate(sql):
+        job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False, default_dataset=default_dataset)
+        return client_factory().query(sql, job_config=job_config).total_bytes_processed or 0
+
+    return estimate
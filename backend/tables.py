@@ -0,0 +1,4 @@
+# Primary key of each warehouse table (remembered per turn by references.py, MERGE key of sync.py).
+# Kept free of imports so batch jobs (update_bigquery_data.py,
+# sync.py) can use it without loading the agent stack.
+KEY_COLUMNS = {"shipments": "id", "drivers": "id", "vehicles": "vehicle_id"}
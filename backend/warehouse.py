@@ -0,0 +1,395 @@
+import os
+import re
+import json
+import time
+import threading
+import contextlib
+import contextvars
+from concurrent.futures import Future
+from datetime import datetime
+from sqlalchemy import create_engine, text
+from sqlalchemy.pool import StaticPool
+from langchain_community.utilities import SQLDatabase
+from langchain_community.utilities.sql_database import truncate_word
+from langchain_community.agent_toolkits import SQLDatabaseToolkit
+from langchain_community.tools.sql_database.tool import QuerySQLCheckerTool
+from cache import SQLResultCache, SingleFlight, fingerprint
+from telemetry import METRICS, instrument_engine
+from sql_guard import QueryRejected, current_guard
+
+# One result cache per process so every request served by a warm instance shares it
+SQL_CACHE_MAX_MB = int(os.getenv("SQL_CACHE_MAX_MB", "32"))
+SHARED_SQL_CACHE = SQLResultCache(max_bytes=SQL_CACHE_MAX_MB * 1024 * 1024)
+
+# Batch the current query belongs to, if any (see SQLBatchScope)
+_batch_scope = contextvars.ContextVar("sql_batch_scope", default=None)
+
+_QUOTED = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`)")
+_COMMENT = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+_PUNCTUATION = re.compile(r"([(),=<>!+*/%;])")
+_TABLE_REF = re.compile(r"\b(?:from|join)\s+(`[^`]+`|[\w.\-]+)")
+_SELECT_STAR = re.compile(r"\bselect\s+(?:distinct\s+)?(?:\w+\s*\.\s*)?\*")
+_QUALIFIED_TABLE = re.compile(r"`[\w\-]+\.[\w\-]+\.(\w+)`|`[\w\-]+\.(\w+)`")
+
+
+def canonicalize_sql(sql):
+    """Normalizes comments, whitespace and keyword case so equivalent SQL text maps to one cache key.
+
+    Quoted literals and identifiers are kept verbatim.
+    """
+    tokens = []
+    for i, part in enumerate(_QUOTED.split(sql)):
+        if i % 2:
+            tokens.append(part)
+        else:
+            tokens.extend(_PUNCTUATION.sub(r" \1 ", _COMMENT.sub(" ", part)).lower().split())
+    while tokens and tokens[-1] == ";":
+        tokens.pop()
+    return " ".join(tokens)
+
+
+def referenced_tables(canonical_sql, known_tables):
+    """Returns the known tables a canonicalized statement reads from."""
+    found = set()
+    for ref in _TABLE_REF.findall(canonical_sql):
+        name = ref.strip("`").split(".")[-1]
+        if name in known_tables:
+            found.add(name)
+    return sorted(found)
+
+
+def is_read_only(canonical_sql):
+    return canonical_sql.startswith(("select", "with"))
+
+
+def to_replica_sql(sql):
+    """Rewrites BigQuery-style `project.dataset.table` references to bare SQLite table names."""
+    return _QUALIFIED_TABLE.sub(lambda m: m.group(1) or m.group(2), sql)
+
+
+class LocalReplica:
+    """In-process SQLite copy of the warehouse tables, loaded from Parquet snapshots.
+
+    The snapshots (plus a manifest.json with their generation time) are written by
+    update_bigquery_data.py. The replica counts as fresh for max_age_seconds after that;
+    when stale it can reload itself in the background through the optional loader,
+    a callable returning ({table_name: DataFrame}, {table_name: version}) where the versions
+    are the warehouse stamps the frames were read at.
+    """
+
+    def __init__(self, replica_dir, max_age_seconds=900, loader=None):
+        self.replica_dir = replica_dir
+        self.max_age_seconds = max_age_seconds
+        self.loader = loader
+        # One shared in-memory database; StaticPool hands every caller the same connection
+        self.engine = create_engine(
+            "sqlite://", poolclass=StaticPool, connect_args={"check_same_thread": False}
+        )
+        instrument_engine(self.engine, "replica")
+        self.tables = set()
+        self.column_bytes = {}  # table -> column -> in-memory size, for estimate_bytes
+        self.versions = {}
+        self.generated_at = 0.0
+        self._lock = threading.RLock()
+        self._refreshing = False
+
+    def load(self):
+        """Loads every table listed in the Parquet manifest; returns False if there is no snapshot."""
+        manifest_path = os.path.join(self.replica_dir, "manifest.json")
+        if not os.path.exists(manifest_path):
+            return False
+        import pandas as pd
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        frames = {
+            name: pd.read_parquet(os.path.join(self.replica_dir, info["file"]))
+            for name, info in manifest["tables"].items()
+        }
+        generated_at = datetime.fromisoformat(manifest["generated_at"]).timestamp()
+        self.load_frames(frames, {n: i.get("version") for n, i in manifest["tables"].items()}, generated_at)
+        return True
+
+    def load_frames(self, frames, versions=None, generated_at=None):
+        """Replaces the tables; versions are the warehouse stamps of the frames (generation time if unknown)."""
+        with self._lock:
+            for name, df in frames.items():
+                df.to_sql(name, self.engine, if_exists="replace", index=False)
+                self.column_bytes[name] = {c: int(df[c].memory_usage(index=False, deep=True)) for c in df.columns}
+            self.tables = set(frames)
+            self.generated_at = generated_at if generated_at is not None else time.time()
+            self.versions = {name: (versions or {}).get(name) or str(self.generated_at) for name in frames}
+        print(f"Local Replica: Loaded {sorted(frames)} ({sum(len(df) for df in frames.values())} rows)")
+
+    def read_frames(self):
+        """The loaded tables as {table_name: DataFrame}, e.g. to rebuild KPI aggregates."""
+        import pandas as pd
+        with self._lock, self.engine.connect() as connection:
+            return {name: pd.read_sql_table(name, connection) for name in sorted(self.tables)}
+
+    def age_seconds(self):
+        return time.time() - self.generated_at
+
+    def is_fresh(self):
+        return bool(self.tables) and self.age_seconds() <= self.max_age_seconds
+
+    def can_serve(self, tables):
+        """Routing rule: fresh replica that holds every table the statement reads."""
+        if not tables or not set(tables) <= self.tables:
+            return False
+        if not self.is_fresh():
+            self.refresh_in_background()
+            return False
+        return True
+
+    def refresh_in_background(self):
+        if self.loader is None:
+            return
+        # A busy lock means a load or read is running; the next stale read tries again instead of waiting
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        finally:
+            self._lock.release()
+
+        def refresh():
+            try:
+                self.load_frames(*self.loader())
+            except Exception as e:
+                print(f"Local Replica: Background refresh failed: {e}")
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=refresh, name="replica-refresh", daemon=True).start()
+
+    def estimate_bytes(self, canonical_sql, tables):
+        """Local stand-in for a dry run: bytes of every referenced column of every table read (columnar, like BigQuery)."""
+        star = _SELECT_STAR.search(canonical_sql) is not None
+        tokens = set(re.findall(r"\w+", canonical_sql))
+        return sum(
+            size for table in tables for column, size in self.column_bytes.get(table, {}).items()
+            if star or column.lower() in tokens
+        )
+
+    def execute(self, command, fetch="all", parameters=None):
+        """Runs a statement on the replica and returns rows as dicts, like SQLDatabase._execute."""
+        with self._lock, self.engine.connect() as connection:
+            cursor = connection.execute(text(to_replica_sql(command)), parameters or {})
+            if not cursor.returns_rows:
+                return []
+            if fetch == "one":
+                row = cursor.fetchone()
+                return [] if row is None else [row._asdict()]
+            return [row._asdict() for row in cursor.fetchall()]
+
+    def stats(self):
+        return {
+            "tables": sorted(self.tables),
+            "age_seconds": round(self.age_seconds(), 1) if self.tables else None,
+            "fresh": self.is_fresh(),
+            "max_age_seconds": self.max_age_seconds,
+        }
+
+
+class SQLBatchScope:
+    """Shares statement results between the queries of one batch.
+
+    Identical SQL issued by different queries runs once, even when they issue it at the
+    same moment, and results too large for the SQL cache are still shared.
+    """
+
+    def __init__(self):
+        self._results = {}  # statement key -> Future
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.deduplicated = 0
+
+    @contextlib.contextmanager
+    def active(self):
+        """Makes this the batch scope for statements issued by the current thread."""
+        token = _batch_scope.set(self)
+        try:
+            yield self
+        finally:
+            _batch_scope.reset(token)
+
+    def run(self, key, execute):
+        with self._lock:
+            future = self._results.get(key)
+            owner = future is None
+            if owner:
+                future = self._results[key] = Future()
+                self.executed += 1
+            else:
+                self.deduplicated += 1
+        if owner:
+            try:
+                future.set_result(execute())
+            except Exception as e:
+                future.set_exception(e)
+        else:
+            METRICS.inc("sql_batch_deduplicated_total")
+        return future.result()
+
+    def stats(self):
+        with self._lock:
+            return {"executed": self.executed, "deduplicated": self.deduplicated}
+
+
+class CachedSQLDatabase(SQLDatabase):
+    """SQLDatabase that serves repeat SELECTs and schema lookups from a local result cache.
+
+    Keys combine the canonicalized SQL with the version stamps of the tables it reads,
+    so a reload of a table only invalidates results that depend on it.
+    """
+
+    def __init__(self, *args, result_cache=None, table_versions=None, schema_snapshot=None, replica=None,
+                 dry_run=None, **kwargs):
+        if schema_snapshot is not None:
+            # Schema text comes from the snapshot, so skip reflecting every table up front
+            kwargs.setdefault("lazy_table_reflection", True)
+            kwargs.setdefault("custom_table_info", schema_snapshot.custom_table_info())
+        super().__init__(*args, **kwargs)
+        instrument_engine(self._engine)
+        self.result_cache = result_cache if result_cache is not None else SHARED_SQL_CACHE
+        self.table_versions = table_versions
+        self.schema_snapshot = schema_snapshot
+        # Optional LocalReplica that serves reads when it is fresh and holds every referenced table
+        self.replica = replica
+        self.routing = {"replica": 0, "warehouse": 0, "replica_fallback": 0}
+        # Identical statements issued at the same time by different requests execute once
+        self.sql_flight = SingleFlight("sql")
+        # Optional callable returning the bytes BigQuery would process for a statement (SQL guard)
+        self.dry_run = dry_run
+
+    def _version_token(self, tables, replica=False):
+        if replica:
+            # Replica reads can lag the warehouse by up to max_age_seconds, so they are keyed on what the replica holds
+            return fingerprint(repr(("replica", sorted((t, self.replica.versions.get(t)) for t in tables))))
+        if self.table_versions is None:
+            return None
+        # Statements we cannot attribute to a table depend on all of them
+        return self.table_versions.version_token(tables or None)
+
+    def _rows_key(self, command, fetch, parameters):
+        """(cache key, tables, served by the replica) of a statement."""
+        canonical = canonicalize_sql(command)
+        tables = referenced_tables(canonical, self.get_usable_table_names())
+        replica = self.replica is not None and self.replica.can_serve(tables)
+        key = ("rows", fetch, canonical, repr(sorted((parameters or {}).items())), self._version_token(tables, replica))
+        return key, tables, replica
+
+    def cached_rows(self, command, fetch="all", parameters=None):
+        """Rows of a statement if they are in the result cache; never executes it."""
+        return self.result_cache.get(self._rows_key(command, fetch, parameters)[0])
+
+    def fetch_rows(self, command, fetch="all", parameters=None):
+        """Executes a read-only statement and returns its rows as dicts, using the result cache."""
+        key, tables, replica = self._rows_key(command, fetch, parameters)
+        rows = self.result_cache.get(key)
+        if rows is None:
+            def execute():
+                return self.sql_flight.do(key, lambda: self._execute_routed(command, fetch, parameters, replica))[0]
+
+            scope = _batch_scope.get()
+            rows = scope.run(key, execute) if scope is not None else execute()
+            self.result_cache.set(key, rows)
+        return rows
+
+    def _execute_routed(self, command, fetch, parameters, replica):
+        if replica:
+            try:
+                rows = self.replica.execute(command, fetch, parameters)
+                self.routing["replica"] += 1
+                return rows
+            except Exception as e:
+                # Dialect gaps (BigQuery-only functions) fall through to the warehouse
+                print(f"Local Replica: Falling back to warehouse: {e}")
+                self.routing["replica_fallback"] += 1
+        self.routing["warehouse"] += 1
+        return self._execute(command, fetch, parameters=parameters)
+
+    def run(self, command, fetch="all", include_columns=False, *, parameters=None, execution_options=None):
+        if fetch == "cursor" or execution_options or not isinstance(command, str) \
+                or not is_read_only(canonicalize_sql(command)):
+            return super().run(command, fetch, include_columns,
+                               parameters=parameters, execution_options=execution_options)
+
+        guarded, injected_limit = current_guard(), None
+        if guarded is not None:
+            command, injected_limit = self._check_guard(command, parameters, *guarded)
+
+        # Same formatting as SQLDatabase.run so the agent sees identical observations
+        res = [
+            {column: truncate_word(value, length=self._max_string_length) for column, value in r.items()}
+            for r in self.fetch_rows(command, fetch, parameters)
+        ]
+        if not include_columns:
+            res = [tuple(row.values()) for row in res]
+        if injected_limit and len(res) == injected_limit:
+            return f"{res}\n(First {injected_limit} rows only: LIMIT {injected_limit} was added automatically.)"
+        return str(res) if res else ""
+
+    def run_no_throw(self, command, fetch="all", include_columns=False, *, parameters=None, execution_options=None):
+        # SQL guard rejections go back to the agent as an observation, like database errors
+        try:
+            return super().run_no_throw(command, fetch, include_columns,
+                                        parameters=parameters, execution_options=execution_options)
+        except QueryRejected as e:
+            return f"Error: {e}"
+
+    def _check_guard(self, command, parameters, guard, role):
+        """Applies the request's SQL guard; returns (statement to run, injected LIMIT) or raises QueryRejected."""
+        command, injected_limit = guard.rewrite(command, canonicalize_sql(command), role)
+        if self.cached_rows(command, parameters=parameters) is not None:
+            return command, injected_limit  # nothing will be scanned
+        canonical = canonicalize_sql(command)
+        tables = referenced_tables(canonical, self.get_usable_table_names())
+        if self.replica is not None and self.replica.can_serve(tables):
+            guard.check_bytes(self.replica.estimate_bytes(canonical, tables), role, "replica")
+        elif self.dry_run is not None:
+            guard.check_bytes(self.dry_run(command), role, "dry_run")
+        return command, injected_limit
+
+    def get_table_info(self, table_names=None, get_col_comments=False):
+        if self.schema_snapshot is not None:
+            info = self.schema_snapshot.table_info(table_names)
+            if info is not None:
+                return info
+        tables = sorted(table_names) if table_names else None
+        key = ("table_info", tuple(tables or ()), get_col_comments, self._version_token(tables))
+        info = self.result_cache.get(key)
+        if info is None:
+            info = super().get_table_info(table_names, get_col_comments)
+            self.result_cache.set(key, info)
+        return info
+
+
+class CachedQueryCheckerTool(QuerySQLCheckerTool):
+    """Query checker that reuses the LLM's verdict for SQL it has already checked."""
+
+    def _run(self, query, run_manager=None):
+        cache = getattr(self.db, "result_cache", None)
+        if cache is None:
+            return super()._run(query, run_manager)
+        key = ("checker", self.db.dialect, canonicalize_sql(query))
+        checked = cache.get(key)
+        if checked is None:
+            checked = super()._run(query, run_manager)
+            cache.set(key, checked)
+        return checked
+
+
+class CachedSQLDatabaseToolkit(SQLDatabaseToolkit):
+    """Standard SQL toolkit with the LLM query checker swapped for its cached variant."""
+
+    def get_tools(self):
+        tools = super().get_tools()
+        return [
+            CachedQueryCheckerTool(db=self.db, llm=self.llm, description=tool.description)
+            if isinstance(tool, QuerySQLCheckerTool) else tool
+            for tool in tools
+        ]
@@ -10,6 +10,10 @@ CONFIG_ID="logistics-v1"
 echo "🚀 Starting Serverless Deployment for $PROJECT_ID..."
 
 # 1. Deploy Cloud Function
+# /telemetry only accepts pings carrying this key in X-API-Key; left unset, telemetry ingestion is disabled
+TELEMETRY_API_KEY=${TELEMETRY_API_KEY:-}
+# POST /cache/invalidate requires this key in X-API-Key; left unset, the route is disabled
+CACHE_ADMIN_API_KEY=${CACHE_ADMIN_API_KEY:-}
 echo "📦 Deploying Cloud Function..."
 gcloud functions deploy $FUNCTION_NAME \
     --gen2 \
@@ -19,12 +23,15 @@ gcloud functions deploy $FUNCTION_NAME \
     --entry-point=process_query \
     --trigger-http \
     --allow-unauthenticated \
-    --set-env-vars "DATABASE_URL=bigquery://$PROJECT_ID/logistics_control_tower"
+    --set-env-vars "DATABASE_URL=bigquery://$PROJECT_ID/logistics_control_tower,TELEMETRY_API_KEY=$TELEMETRY_API_KEY,CACHE_ADMIN_API_KEY=$CACHE_ADMIN_API_KEY"
 
 # Get Function URL
 FUNCTION_URL=$(gcloud functions describe $FUNCTION_NAME --region=$REGION --gen2 --format='value(serviceConfig.uri)')
 echo "✅ Function deployed at: $FUNCTION_URL"
 
+# Warm the new instance so the first user query does not pay for agent initialization
+curl -s --max-time 120 "$FUNCTION_URL/warmup" || echo "Warmup request failed (instance will initialize on first query)"
+
 # 2. Prepare API Gateway
 echo "🛰️ Preparing API Gateway..."
 
@@ -0,0 +1,153 @@
+import os
+import re
+import time
+import numpy as np
+from geo import city_coordinates, haversine_km, parse_gps
+
+# Shipments waiting for a vehicle
+DISPATCH_STATUSES = ("Pending", "Delayed")
+# Vehicles below this fuel level (percent) are not dispatched
+DISPATCH_MIN_FUEL = float(os.getenv("DISPATCH_MIN_FUEL", "20"))
+# Distance a vehicle covers on a full tank; a pickup must be within fuel_level% of it
+DISPATCH_RANGE_KM = float(os.getenv("DISPATCH_RANGE_KM", "1000"))
+# Shipments assigned first (lower rank first), then Delayed before Pending, then heavier first
+PRIORITY_RANK = {"Urgent": 0, "High": 1, "Standard": 2}
+
+SHIPMENTS_SQL = ("SELECT id, origin, destination, status, priority, weight_kg FROM shipments "
+                 f"WHERE status IN ({', '.join(repr(s) for s in DISPATCH_STATUSES)})")
+VEHICLES_SQL = ("SELECT vehicle_id, type, capacity_kg, status, fuel_level, current_load_kg, gps_coordinates "
+                "FROM vehicles")
+
+# Questions answered with a dispatch plan instead of the Data Analyst: requests to assign ("Assign the pending
+# shipments to vehicles") or plan ("Which truck should take ..."), not lookups of existing assignments
+# ("Which vehicle is assigned to shipment 12?", "How many orders were dispatched last week?")
+DISPATCH_PATTERN = re.compile(
+    r"^\s*(?:please\s+|(?:can|could) you\s+)?(?:re-?)?(?:assign|dispatch|allocate)\b"
+    r"(?!.*\b(?:is|are|was|were|been|already)\s+(?:re-?)?(?:assigned|dispatched|allocated)\b)"
+    r".*\b(?:shipments?|loads?|orders?)\b"
+    r"|^\s*(?:please\s+)?(?:plan|optimi[sz]e)\s+(?:the\s+)?(?:dispatch|assignments?|allocation)\b"
+    r"|\bwhich (?:vehicle|truck)s? should\b",
+    re.I,
+)
+
+
+def _gps(text):
+    try:
+        return parse_gps(text)
+    except ValueError:
+        return np.nan, np.nan
+
+
+def vehicle_arrays(vehicles, fleet_state=None):
+    """Per-vehicle arrays (ids, lat, lon, fuel, spare_kg, active) from vehicles rows.
+
+    Live telemetry in fleet_state overrides the table's position, fuel level and load.
+    """
+    n = len(vehicles)
+    ids = np.fromiter((v["vehicle_id"] for v in vehicles), dtype=np.int64, count=n)
+    position = np.array([_gps(v.get("gps_coordinates")) for v in vehicles], dtype=float).reshape(n, 2)
+    fuel = np.array([v.get("fuel_level") for v in vehicles], dtype=float)
+    load = np.array([v.get("current_load_kg") for v in vehicles], dtype=float)
+    capacity = np.array([v.get("capacity_kg") for v in vehicles], dtype=float)
+    active = np.array([v.get("status") == "Active" for v in vehicles], dtype=bool)
+    if fleet_state is not None and fleet_state.size:
+        live_ids, live, _ = fleet_state.arrays()
+        order = np.argsort(live_ids)
+        found = np.searchsorted(live_ids[order], ids).clip(max=len(order) - 1)
+        matched = live_ids[order][found] == ids
+        rows = np.where(matched[:, None], live[order][found], np.nan)
+        has_position = ~np.isnan(rows[:, 0])
+        position[has_position] = rows[has_position, :2]
+        fuel = np.where(np.isnan(rows[:, 2]), fuel, rows[:, 2])
+        load = np.where(np.isnan(rows[:, 3]), load, rows[:, 3])
+    spare = np.nan_to_num(capacity - np.nan_to_num(load), nan=0.0)
+    return ids, position[:, 0], position[:, 1], fuel, spare, active
+
+
+def plan_dispatch(shipments, vehicles, fleet_state=None, min_fuel=DISPATCH_MIN_FUEL, range_km=DISPATCH_RANGE_KM):
+    """Assigns waiting shipments to vehicles, nearest feasible vehicle first.
+
+    A vehicle is feasible for a shipment when it is Active, has at least min_fuel, the pickup
+    (shipment origin) is within its fuel range and its spare capacity covers the weight; a vehicle
+    can take several shipments until its capacity is used up. Distances from every distinct origin
+    to every vehicle are one NumPy matrix; the greedy pass then only scans the in-range vehicles of
+    the shipment's origin, nearest first.
+    Returns {"assignments", "unassigned", ...} with counts, total distance and solve time.
+    """
+    started = time.perf_counter()
+    # 1. Vehicles (live telemetry first) and their pickup range
+    ids, lat, lon, fuel, spare, active = vehicle_arrays(vehicles, fleet_state)
+    available = active & (fuel >= min_fuel) & ~np.isnan(lat)
+    reach_km = np.where(available, fuel / 100 * range_km, -1.0)
+
+    # 2. Cost matrix: distinct origin cities x vehicles, infeasible pairs at infinity
+    origins = np.array([s.get("origin") or "" for s in shipments], dtype=object)
+    names, origin_index = np.unique(origins.astype(str), return_inverse=True)
+    known = [city_coordinates(name) for name in names]
+    origin_position = np.array([c if c else (np.nan, np.nan) for c in known], dtype=float).reshape(len(names), 2)
+    distance = haversine_km(origin_position[:, :1], origin_position[:, 1:], lat[None, :], lon[None, :])
+    cost = np.where(distance <= reach_km[None, :], distance, np.inf)
+
+    # 3. Shipment order: priority, Delayed before Pending, heavier first (packs capacity better)
+    weight = np.array([s.get("weight_kg") or 0.0 for s in shipments], dtype=float)
+    rank = np.array([PRIORITY_RANK.get(s.get("priority"), len(PRIORITY_RANK)) for s in shipments])
+    delayed = np.array([s.get("status") == "Delayed" for s in shipments])
+    order = np.lexsort((-weight, ~delayed, rank))
+
+    # 4. Greedy pass: per origin, the in-range vehicles nearest first; each shipment takes the first with room left
+    nearest = [np.flatnonzero(np.isfinite(row))[np.argsort(row[np.isfinite(row)], kind="stable")] for row in cost]
+    assignments, unassigned = [], []
+    remaining = spare.copy()
+    for s in order:
+        candidates = nearest[origin_index[s]]
+        fits = remaining[candidates] >= weight[s]
+        first = int(fits.argmax()) if len(fits) else 0
+        shipment = shipments[s]
+        if not len(fits) or not fits[first]:
+            if known[origin_index[s]] is None:
+                reason = f"unknown origin {shipment.get('origin')!r}"
+            elif not len(candidates):
+                reason = "no available vehicle within fuel range"
+            else:
+                reason = "no vehicle in range with enough spare capacity"
+            unassigned.append({"shipment_id": shipment["id"], "origin": shipment.get("origin"), "reason": reason})
+            continue
+        choice = candidates[first]
+        remaining[choice] -= weight[s]
+        assignments.append({
+            "shipment_id": shipment["id"],
+            "vehicle_id": int(ids[choice]),
+            "origin": shipment.get("origin"),
+            "destination": shipment.get("destination"),
+            "priority": shipment.get("priority"),
+            "status": shipment.get("status"),
+            "weight_kg": float(weight[s]),
+            "distance_km": round(float(cost[origin_index[s], choice]), 1),
+        })
+    return {
+        "assignments": assignments,
+        "unassigned": unassigned,
+        "shipments": len(shipments),
+        "vehicles_available": int(available.sum()),
+        "vehicles_used": len({a["vehicle_id"] for a in assignments}),
+        "total_distance_km": round(sum(a["distance_km"] for a in assignments), 1),
+        "solve_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+
+
+def summarize(plan, limit=10):
+    """Analyst-style text of a dispatch plan (first `limit` assignments and unassigned shipments)."""
+    lines = [
+        f"Dispatch plan: {len(plan['assignments'])} of {plan['shipments']} pending/delayed shipments assigned "
+        f"to {plan['vehicles_used']} of {plan['vehicles_available']} available vehicles, "
+        f"{plan['total_distance_km']:.0f} km to the pickups in total."
+    ]
+    for a in plan["assignments"][:limit]:
+        lines.append(f"- Shipment {a['shipment_id']} ({a['priority']}, {a['status']}, {a['weight_kg']:.0f} kg "
+                     f"from {a['origin']}) -> vehicle {a['vehicle_id']}, {a['distance_km']:.0f} km away")
+    for u in plan["unassigned"][:limit]:
+        lines.append(f"- Shipment {u['shipment_id']} unassigned: {u['reason']}")
+    hidden = max(0, len(plan["assignments"]) - limit) + max(0, len(plan["unassigned"]) - limit)
+    if hidden:
+        lines.append(f"... {hidden} more (see /dispatch for the full plan)")
+    return "\n".join(lines)
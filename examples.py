@@ -0,0 +1,137 @@
+import json
+import math
+import os
+import threading
+import time
+from collections import Counter
+from cache import normalize_query
+
+# Successful (question, SQL, row count) triples from the Data Analyst, persisted between restarts
+EXAMPLE_STORE_PATH = os.getenv(
+    "EXAMPLE_STORE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "examples.json")
+)
+EXAMPLE_MAX = int(os.getenv("EXAMPLE_MAX", "500"))
+EXAMPLE_TOP_K = int(os.getenv("EXAMPLE_TOP_K", "2"))
+# Minimum cosine similarity for an example to be shown to the analyst
+EXAMPLE_MIN_SCORE = float(os.getenv("EXAMPLE_MIN_SCORE", "0.3"))
+EXAMPLE_HINTS = os.getenv("EXAMPLE_HINTS", "true").lower() == "true"
+
+_STOPWORDS = {
+    "a", "an", "the", "of", "in", "on", "for", "to", "and", "or", "is", "are", "was", "were", "be", "me", "us",
+    "show", "list", "give", "tell", "what", "which", "who", "how", "do", "does", "that", "this", "with", "all",
+    "any", "there", "please", "can", "you", "our", "we", "it", "by", "from", "at",
+}
+
+
+def _features(text):
+    """Word unigrams and bigrams plus character trigrams (so "delay" still matches "delayed")."""
+    words = [w for w in normalize_query(text).split() if w not in _STOPWORDS]
+    features = Counter(words)
+    features.update(f"{a} {b}" for a, b in zip(words, words[1:]))
+    for word in words:
+        padded = f" {word} "
+        features.update("#" + padded[i:i + 3] for i in range(len(padded) - 2))
+    return features
+
+
+class ExampleStore:
+    """Question -> SQL examples with a local TF-IDF cosine index for nearest-neighbour lookups (no network)."""
+
+    def __init__(self, path=None, max_examples=EXAMPLE_MAX):
+        self.path = path
+        self.max_examples = max_examples
+        self.examples = []  # {"question", "sql", "rows", "uses", "at"}
+        self._features = []  # Counter per example, parallel to self.examples
+        self._vectors = None  # normalized TF-IDF vectors, rebuilt after the store changes
+        self._idf = {}
+        self._df = Counter()
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    for example in json.load(f):
+                        self._append(example)
+            except (OSError, ValueError) as e:
+                print(f"Example Store: Could not load {path}: {e}")
+
+    def _append(self, example):
+        features = _features(example["question"])
+        self.examples.append(example)
+        self._features.append(features)
+        self._df.update(features.keys())
+        self._vectors = None
+
+    def _remove(self, index):
+        self._df.subtract(self._features[index].keys())
+        del self.examples[index], self._features[index]
+        self._vectors = None
+
+    def _save(self):
+        if not self.path:
+            return
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.examples, f)
+        os.replace(self.path + ".tmp", self.path)
+
+    def add(self, question, sql, row_count):
+        """Records a successful run; asking the same question again replaces its SQL."""
+        key = normalize_query(question)
+        with self._lock:
+            for example in self.examples:
+                if normalize_query(example["question"]) == key:
+                    example.update(sql=sql, rows=row_count, at=time.time())
+                    break
+            else:
+                if len(self.examples) >= self.max_examples:
+                    # Evict the least used, then oldest, example
+                    self._remove(min(range(len(self.examples)),
+                                     key=lambda i: (self.examples[i]["uses"], self.examples[i]["at"])))
+                self._append({"question": question, "sql": sql, "rows": row_count, "uses": 0, "at": time.time()})
+            self._save()
+
+    def _build_vectors(self):
+        n = len(self.examples)
+        self._idf = {term: math.log((1 + n) / (1 + df)) + 1 for term, df in self._df.items() if df > 0}
+        self._vectors = [self._weigh(features) for features in self._features]
+
+    def _weigh(self, features):
+        vector = {term: count * self._idf.get(term, 1.0) for term, count in features.items()}
+        norm = math.sqrt(sum(w * w for w in vector.values())) or 1.0
+        return {term: w / norm for term, w in vector.items()}
+
+    def search(self, question, k=EXAMPLE_TOP_K, min_score=EXAMPLE_MIN_SCORE):
+        """Returns up to k (score, example) pairs by cosine similarity, best first."""
+        with self._lock:
+            self.lookups += 1
+            if not self.examples:
+                return []
+            if self._vectors is None:
+                self._build_vectors()
+            query = self._weigh(_features(question))
+            scored = []
+            for example, vector in zip(self.examples, self._vectors):
+                score = sum(w * vector.get(term, 0.0) for term, w in query.items())
+                if score >= min_score:
+                    scored.append((round(score, 3), example))
+            scored.sort(key=lambda pair: pair[0], reverse=True)
+            for _, example in scored[:k]:
+                example["uses"] += 1
+            if scored:
+                self.hits += 1
+            return scored[:k]
+
+    def hints(self, question, k=EXAMPLE_TOP_K):
+        """Few-shot block for the Data Analyst's input, or "" when nothing similar has been answered."""
+        matches = self.search(question, k)
+        if not matches:
+            return ""
+        lines = ["Verified SQL from similar past questions (the tables and columns are correct; "
+                 "reuse or adapt it with sql_db_query):"]
+        for _, example in matches:
+            lines += [f"Q: {example['question']}", f"SQL: {example['sql']}", f"(returned {example['rows']} rows)"]
+        return "\n".join(lines)
+
+    def stats(self):
+        return {"examples": len(self.examples), "lookups": self.lookups, "hits": self.hits, "path": self.path}
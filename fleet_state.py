@@ -0,0 +1,349 @@
+import contextlib
+import hmac
+import json
+import math
+import os
+import threading
+import time
+import numpy as np
+from geo import GridIndex, format_gps, parse_gps
+from telemetry import METRICS
+
+# How often changed vehicles are written back to the warehouse vehicles table
+TELEMETRY_FLUSH_SECONDS = float(os.getenv("TELEMETRY_FLUSH_SECONDS", "60"))
+# Optional NDJSON file of pings (one JSON object per line) that is followed like `tail -f`
+TELEMETRY_FILE = os.getenv("TELEMETRY_FILE")
+# Largest number of pings accepted by one /telemetry request
+TELEMETRY_MAX_PINGS = int(os.getenv("TELEMETRY_MAX_PINGS", "10000"))
+# Shared secret senders pass in the X-API-Key header; /telemetry refuses every request while it is unset
+TELEMETRY_API_KEY = os.getenv("TELEMETRY_API_KEY", "")
+# Ping timestamps further ahead of the server clock are clamped, so one bad clock cannot make later pings stale
+TELEMETRY_MAX_SKEW_SECONDS = float(os.getenv("TELEMETRY_MAX_SKEW_SECONDS", "300"))
+
+# Columns of FleetState.values
+FIELDS = ("lat", "lon", "fuel_level", "current_load_kg")
+LAT, LON, FUEL, LOAD = range(len(FIELDS))
+
+
+def _number(value):
+    return math.nan if value is None else float(value)
+
+
+def authorize(api_key):
+    """None if a /telemetry request's X-API-Key is accepted, else (HTTP status, error message)."""
+    if not TELEMETRY_API_KEY:
+        return 503, "Telemetry ingestion is disabled (TELEMETRY_API_KEY is not set)"
+    if not api_key or not hmac.compare_digest(api_key.encode("utf-8"), TELEMETRY_API_KEY.encode("utf-8")):
+        return 401, "Missing or invalid X-API-Key"
+    return None
+
+
+def _timestamp(value, now):
+    """Ping time in epoch seconds: milliseconds are converted, and at most TELEMETRY_MAX_SKEW_SECONDS ahead of now."""
+    if not value:
+        return now
+    ts = float(value)
+    if not math.isfinite(ts) or ts < 0:
+        raise ValueError("ts must be epoch seconds")
+    if ts > 1e11:  # epoch milliseconds (1e11 s is the year 5138)
+        ts /= 1000
+    return min(ts, now + TELEMETRY_MAX_SKEW_SECONDS)
+
+
+def parse_ping(ping, now):
+    """(vehicle_id, [lat, lon, fuel_level, current_load_kg], ts) from a ping dict; missing fields are NaN.
+
+    Positions come as "lat"/"lon" or a "gps_coordinates" string like "51.5074 N, 0.1278 W".
+    Raises ValueError/TypeError/KeyError for pings that cannot be applied.
+    """
+    vehicle_id = int(ping["vehicle_id"])
+    if ping.get("gps_coordinates") is not None:
+        lat, lon = parse_gps(ping["gps_coordinates"])
+    else:
+        lat, lon = _number(ping.get("lat")), _number(ping.get("lon"))
+        if math.isnan(lat) != math.isnan(lon):
+            raise ValueError("lat and lon must be given together")
+        if abs(lat) > 90 or abs(lon) > 180:
+            raise ValueError("lat/lon out of range")
+    fuel, load = _number(ping.get("fuel_level")), _number(ping.get("current_load_kg"))
+    if not (math.isnan(fuel) or 0 <= fuel <= 100) or not (math.isnan(load) or load >= 0):
+        raise ValueError("fuel_level must be 0-100 and current_load_kg non-negative")
+    row = [lat, lon, fuel, load]
+    if all(math.isnan(v) for v in row):
+        raise ValueError("ping carries no position, fuel or load")
+    return vehicle_id, row, _timestamp(ping.get("ts"), now)
+
+
+def parse_payload(body, content_type=""):
+    """Pings from a /telemetry body: {"pings": [...]}, a JSON list, or NDJSON; returns (pings, unparsable lines)."""
+    text = body.decode("utf-8") if isinstance(body, bytes) else body
+    if "ndjson" not in (content_type or ""):
+        try:
+            payload = json.loads(text)
+            pings = payload.get("pings") if isinstance(payload, dict) else payload
+            if isinstance(pings, list):
+                return pings, 0
+        except ValueError:
+            pass
+    pings, bad = [], 0
+    for line in text.splitlines():
+        if line.strip():
+            try:
+                pings.append(json.loads(line))
+            except ValueError:
+                bad += 1
+    return pings, bad
+
+
+def _last_occurrence(keys):
+    """Index of the last occurrence of every distinct key."""
+    _, from_end = np.unique(keys[::-1], return_index=True)
+    return len(keys) - 1 - from_end
+
+
+class FleetState:
+    """Latest position, fuel and load per vehicle, held in NumPy arrays with one slot per vehicle_id.
+
+    Pings are applied in batches, newest timestamp wins per field; changed slots stay dirty
+    until flush() hands them to a warehouse sink. Once seeded from the vehicles table, pings
+    for vehicles that are not in it are rejected.
+    """
+
+    def __init__(self, capacity=1024):
+        self._slots = {}  # vehicle_id -> row in the arrays
+        self.vehicle_ids = np.zeros(capacity, dtype=np.int64)
+        self.values = np.full((capacity, len(FIELDS)), np.nan)
+        self.updated_at = np.zeros(capacity)  # 0 = seeded from the vehicles table, no ping yet
+        self.dirty = np.zeros(capacity, dtype=bool)
+        # Spatial grid over the current positions, moved along with every applied ping
+        self.index = GridIndex()
+        self.size = 0
+        self.fleet = None  # vehicle_ids of the last seed; None accepts any vehicle
+        self.counts = {"accepted": 0, "rejected": 0, "stale": 0, "flushed": 0}
+        self._lock = threading.Lock()
+        self._threads = {}
+
+    def _slot(self, vehicle_id):
+        slot = self._slots.get(vehicle_id)
+        if slot is None:
+            if self.size == len(self.vehicle_ids):
+                grow = len(self.vehicle_ids)
+                self.vehicle_ids = np.concatenate([self.vehicle_ids, np.zeros(grow, dtype=np.int64)])
+                self.values = np.vstack([self.values, np.full((grow, len(FIELDS)), np.nan)])
+                self.updated_at = np.concatenate([self.updated_at, np.zeros(grow)])
+                self.dirty = np.concatenate([self.dirty, np.zeros(grow, dtype=bool)])
+            slot = self._slots[vehicle_id] = self.size
+            self.vehicle_ids[slot] = vehicle_id
+            self.size += 1
+        return slot
+
+    def ingest(self, pings, now=None):
+        """Applies a batch of ping dicts; returns {"accepted", "rejected", "stale"} counts."""
+        now = time.time() if now is None else now
+        ids, rows, stamps, rejected = [], [], [], 0
+        fleet = self.fleet
+        for ping in pings:
+            try:
+                vehicle_id, row, ts = parse_ping(ping, now)
+            except (KeyError, TypeError, ValueError, AttributeError):
+                rejected += 1
+                continue
+            if fleet is not None and vehicle_id not in fleet:
+                rejected += 1
+                continue
+            ids.append(vehicle_id)
+            rows.append(row)
+            stamps.append(ts)
+        result = {"accepted": 0, "rejected": rejected, "stale": 0}
+        if ids:
+            rows, stamps = np.array(rows, dtype=float), np.array(stamps)
+            with self._lock:
+                slots = np.fromiter((self._slot(v) for v in ids), dtype=np.int64, count=len(ids))
+                # Pings older than what a vehicle already reported are dropped; the rest apply oldest first
+                fresh = stamps >= self.updated_at[slots]
+                slots, rows, stamps = slots[fresh], rows[fresh], stamps[fresh]
+                order = np.argsort(stamps, kind="stable")
+                slots, rows, stamps = slots[order], rows[order], stamps[order]
+                for field in range(len(FIELDS)):
+                    given = np.flatnonzero(~np.isnan(rows[:, field]))
+                    latest = given[_last_occurrence(slots[given])]
+                    self.values[slots[latest], field] = rows[latest, field]
+                moved = np.unique(slots[~np.isnan(rows[:, LAT])])
+                self.index.update_many(self.vehicle_ids[moved], self.values[moved, LAT], self.values[moved, LON])
+                np.maximum.at(self.updated_at, slots, stamps)
+                self.dirty[slots] = True
+            result.update(accepted=len(slots), stale=len(ids) - len(slots))
+        with self._lock:
+            for key, value in result.items():
+                self.counts[key] += value
+        for key, value in result.items():
+            if value:
+                METRICS.inc("telemetry_pings_total", value, result=key)
+        return result
+
+    def seed(self, rows):
+        """Loads vehicles table rows (vehicle_id, gps_coordinates, fuel_level, current_load_kg) for vehicles without pings.
+
+        The rows also become the known fleet that pings are checked against.
+        """
+        with self._lock:
+            self.fleet = frozenset(int(r["vehicle_id"]) for r in rows if r.get("vehicle_id") is not None)
+            for r in rows:
+                if r.get("vehicle_id") is None or r["vehicle_id"] in self._slots:
+                    continue
+                try:
+                    lat, lon = parse_gps(r.get("gps_coordinates"))
+                except ValueError:
+                    lat = lon = math.nan
+                slot = self._slot(int(r["vehicle_id"]))
+                self.values[slot] = [lat, lon, _number(r.get("fuel_level")), _number(r.get("current_load_kg"))]
+                self.index.update(int(r["vehicle_id"]), lat, lon)
+
+    def within(self, lat, lon, radius_km, where=None):
+        """[(vehicle_id, km)] of vehicles within radius_km of a point, nearest first."""
+        with self._lock:
+            return self.index.within(lat, lon, radius_km, where)
+
+    def nearest(self, lat, lon, k=1, where=None):
+        """[(vehicle_id, km)] of the k vehicles nearest to a point."""
+        with self._lock:
+            return self.index.nearest(lat, lon, k, where)
+
+    def arrays(self):
+        """Copies of (vehicle_ids, values, updated_at) for vectorized consumers."""
+        with self._lock:
+            n = self.size
+            return self.vehicle_ids[:n].copy(), self.values[:n].copy(), self.updated_at[:n].copy()
+
+    def snapshot(self, vehicle_ids=None, now=None):
+        """Current state as row dicts, ordered by vehicle_id (optionally only the given vehicles)."""
+        now = time.time() if now is None else now
+        ids, values, updated_at = self.arrays()
+        order = np.argsort(ids)
+        if vehicle_ids is not None:
+            order = order[np.isin(ids[order], list(vehicle_ids))]
+        return [self._row(ids[i], values[i], updated_at[i], now) for i in order]
+
+    @staticmethod
+    def _row(vehicle_id, values, updated_at, now):
+        lat, lon, fuel, load = (None if math.isnan(v) else round(float(v), 4) for v in values)
+        return {
+            "vehicle_id": int(vehicle_id),
+            "lat": lat,
+            "lon": lon,
+            "gps_coordinates": format_gps(lat, lon) if lat is not None else None,
+            "fuel_level": fuel,
+            "current_load_kg": load,
+            "age_seconds": round(float(now - updated_at), 1) if updated_at else None,
+        }
+
+    def flush(self, sink):
+        """Hands every changed vehicle to sink(rows) in one batch; returns the number of rows flushed."""
+        with self._lock:
+            slots = np.flatnonzero(self.dirty[:self.size])
+            if not len(slots):
+                return 0
+            now = time.time()
+            rows = [self._row(self.vehicle_ids[s], self.values[s], self.updated_at[s], now) for s in slots]
+            self.dirty[slots] = False
+        try:
+            sink(rows)
+        except Exception:
+            with self._lock:
+                self.dirty[slots] = True  # retried on the next flush
+            raise
+        with self._lock:
+            self.counts["flushed"] += len(rows)
+        METRICS.inc("telemetry_flushed_rows_total", len(rows))
+        return len(rows)
+
+    def _start(self, name, loop):
+        with self._lock:
+            if name in self._threads:
+                return
+            self._threads[name] = threading.Thread(target=loop, name=f"telemetry-{name}", daemon=True)
+            self._threads[name].start()
+
+    def start_flusher(self, sink, interval=TELEMETRY_FLUSH_SECONDS):
+        """Flushes changed vehicles every interval seconds in a background thread (once per process)."""
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    flushed = self.flush(sink)
+                    if flushed:
+                        print(f"Fleet State: Flushed {flushed} vehicles to the warehouse")
+                except Exception as e:
+                    print(f"Fleet State: Flush failed, will retry: {e}")
+        self._start("flush", loop)
+
+    def follow(self, path, poll_seconds=1.0):
+        """Ingests pings appended to an NDJSON file, like `tail -f` (restarts from the top if it is truncated)."""
+        def loop():
+            offset, partial = 0, ""
+            while True:
+                try:
+                    if os.path.getsize(path) < offset:
+                        offset, partial = 0, ""
+                    with open(path) as f:
+                        f.seek(offset)
+                        chunk = f.read()
+                        offset = f.tell()
+                    lines = (partial + chunk).split("\n")
+                    partial = lines.pop()  # incomplete last line, completed by a later write
+                    if lines:
+                        pings, bad = parse_payload("\n".join(lines), "application/x-ndjson")
+                        self.ingest(pings)
+                        if bad:
+                            METRICS.inc("telemetry_pings_total", bad, result="rejected")
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    print(f"Fleet State: Could not read {path}: {e}")
+                time.sleep(poll_seconds)
+        self._start("follow", loop)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counts, vehicles=self.size, dirty=int(self.dirty[:self.size].sum()),
+                        fleet=len(self.fleet) if self.fleet is not None else None)
+
+
+def sqlalchemy_sink(engine, table="vehicles", lock=None):
+    """Flush sink for SQLAlchemy databases (local SQLite, the replica): one executemany UPDATE per flush."""
+    from sqlalchemy import text
+    statement = text(
+        f"UPDATE {table} SET gps_coordinates = COALESCE(:gps_coordinates, gps_coordinates), "
+        f"fuel_level = COALESCE(:fuel_level, fuel_level), "
+        f"current_load_kg = COALESCE(:current_load_kg, current_load_kg) WHERE vehicle_id = :vehicle_id"
+    )
+
+    def sink(rows):
+        params = [{k: r[k] for k in ("vehicle_id", "gps_coordinates", "fuel_level", "current_load_kg")} for r in rows]
+        with lock or contextlib.nullcontext(), engine.begin() as connection:
+            connection.execute(statement, params)
+    return sink
+
+
+def bigquery_sink(client, dataset_id, table="vehicles"):
+    """Flush sink for BigQuery: one staging load and one MERGE per flush, instead of a DML job per vehicle."""
+    def sink(rows):
+        import pandas as pd
+        from google.cloud import bigquery
+        staging = f"{dataset_id}._staging_telemetry"
+        schema = [bigquery.SchemaField("vehicle_id", "INT64"), bigquery.SchemaField("gps_coordinates", "STRING"),
+                  bigquery.SchemaField("fuel_level", "FLOAT64"), bigquery.SchemaField("current_load_kg", "FLOAT64")]
+        frame = pd.DataFrame(rows, columns=[f.name for f in schema])
+        job_config = bigquery.LoadJobConfig(schema=schema, write_disposition="WRITE_TRUNCATE")
+        client.load_table_from_dataframe(frame, staging, job_config=job_config).result()
+        client.query(
+            f"MERGE `{dataset_id}.{table}` T USING `{staging}` S ON T.vehicle_id = S.vehicle_id "
+            f"WHEN MATCHED THEN UPDATE SET gps_coordinates = COALESCE(S.gps_coordinates, T.gps_coordinates), "
+            f"fuel_level = COALESCE(S.fuel_level, T.fuel_level), "
+            f"current_load_kg = COALESCE(S.current_load_kg, T.current_load_kg)"
+        ).result()
+    return sink
+
+
+# One store per process: /telemetry ingests into it before the agent exists, the agent reads and flushes it
+SHARED_FLEET_STATE = FleetState()
@@ -0,0 +1,201 @@
+import json
+import os
+import re
+from cache import normalize_query
+from geo import CITY_COORDINATES
+from warehouse import canonicalize_sql, referenced_tables
+
+TABLES = ["shipments", "drivers", "vehicles"]
+# Place names in the seed data that have no coordinates in geo.CITY_COORDINATES
+UNGEOCODED_CITIES = ["Wrightview", "New Donport"]
+# Cities used to pick up city entities from questions and answers: every geocoded city plus the ones above
+KNOWN_CITIES = [city.title() for city in CITY_COORDINATES] + UNGEOCODED_CITIES
+# Shown when no rule produces enough suggestions (the previous LLM fallback list)
+FALLBACK_SUGGESTIONS = ["Show me delayed shipments", "What is the fleet capacity?", "Identify bottlenecks"]
+
+_SHIPMENT_ID = re.compile(r"\bshipments?\s+(?:id\s+|#|no\.?\s*)?(\d+)", re.I)
+_VEHICLE_ID = re.compile(r"\b(?:vehicles?\s+(?:id\s+|#)?|v-0*)(\d+)", re.I)
+_CITY = re.compile(r"\b(" + "|".join(re.escape(c) for c in KNOWN_CITIES) + r")\b", re.I)
+_CANONICAL_CITY = {c.lower(): c for c in KNOWN_CITIES}
+
+# Intent keywords, checked in order against the question and the SQL that answered it
+INTENT_KEYWORDS = [
+    ("financial", ["cost", "revenue", "profit", "salary", "price", "margin"]),
+    ("low_fuel_vehicles", ["fuel"]),
+    ("fleet_capacity", ["capacity", "utilization", "utilisation", "load"]),
+    ("delayed_shipments", ["delay", "late"]),
+    ("drivers", ["driver"]),
+    ("shipment_status", ["shipment"]),
+    ("vehicles", ["vehicle", "truck", "van", "fleet"]),
+]
+MANAGEMENT_ROLES = ["Admin", "Logistics Manager"]
+
+
+class FollowupRule:
+    """Suggestion templates offered when the context matches every condition that is set.
+
+    Templates are formatted with the extracted entities ({shipment_id}, {vehicle_id}, {city});
+    a template whose entity was not found is skipped.
+    """
+
+    def __init__(self, name, suggestions, intents=None, tables=None, keywords=None, roles=None,
+                 exclude_roles=None):
+        self.name = name
+        self.suggestions = list(suggestions)
+        self.intents = set(intents or [])
+        self.tables = set(tables or [])
+        self.keywords = [k.lower() for k in keywords or []]
+        self.roles = set(roles or [])
+        self.exclude_roles = set(exclude_roles or [])
+
+    def applies(self, context):
+        if self.intents and context["intent"] not in self.intents:
+            return False
+        if self.tables and not self.tables & context["tables"]:
+            return False
+        if self.keywords and not any(k in context["text"] for k in self.keywords):
+            return False
+        if self.roles and context["role"] not in self.roles:
+            return False
+        return context["role"] not in self.exclude_roles
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**data)
+
+
+# Suggestions are phrased like the query templates where possible, so clicking one stays on the fast path.
+# Template answers carry the template name as intent, so every template name appears in some rule.
+DEFAULT_RULES = [
+    FollowupRule("delayed_detail", [
+        "What is the status of shipment {shipment_id}?",
+        "Show delayed shipments in {city}",
+        "Which drivers are in {city}?",
+    ], intents=["delayed_shipments", "delayed_shipments_by_city"]),
+    FollowupRule("delayed_strategy", [
+        "How can we reduce delivery delays?",
+    ], intents=["delayed_shipments", "delayed_shipments_by_city"], roles=MANAGEMENT_ROLES),
+    FollowupRule("shipment_detail", [
+        "Show delayed shipments in {city}",
+        "Which drivers are in {city}?",
+        "Show me delayed shipments",
+    ], intents=["shipment_status"]),
+    FollowupRule("capacity_detail", [
+        "Show active vehicles with fuel below 25%",
+        "Show me delayed shipments",
+    ], intents=["fleet_capacity"]),
+    FollowupRule("capacity_strategy", [
+        "How can we improve fleet utilization?",
+    ], intents=["fleet_capacity", "vehicles"], roles=MANAGEMENT_ROLES),
+    FollowupRule("fuel_detail", [
+        "What is the fleet capacity?",
+        "Suggest a refuelling plan for vehicle {vehicle_id}",
+        "Show vehicles with fuel below 50%",
+    ], intents=["low_fuel_vehicles"]),
+    FollowupRule("dispatch_detail", [
+        "What is the status of shipment {shipment_id}?",
+        "Show active vehicles with fuel below 25%",
+        "What is the fleet capacity?",
+    ], intents=["dispatch_plan"]),
+    FollowupRule("nearby_detail", [
+        "Which drivers are in {city}?",
+        "Show vehicles with fuel below 50%",
+        "Assign the pending shipments to vehicles",
+    ], intents=["nearby_vehicles", "nearby_drivers"]),
+    FollowupRule("driver_detail", [
+        "Show delayed shipments in {city}",
+        "Which drivers are in {city}?",
+        "Which drivers have the highest rating?",
+    ], intents=["drivers", "drivers_in_city"]),
+    FollowupRule("vehicle_detail", [
+        "Show vehicles with fuel below 50%",
+        "What is the fleet capacity?",
+    ], tables=["vehicles"]),
+    FollowupRule("financial_detail", [
+        "Which shipments have the lowest margin?",
+        "What is the total revenue of delayed shipments?",
+    ], intents=["financial"], exclude_roles=["Guest"]),
+    FollowupRule("shipments_general", [
+        "Show me delayed shipments",
+        "What is the status of shipment {shipment_id}?",
+    ], tables=["shipments"]),
+    FollowupRule("drivers_general", [
+        "Which drivers are in {city}?",
+    ], tables=["drivers"]),
+]
+
+
+def load_rules(path):
+    """Reads extra rules from a JSON list of FollowupRule keyword dicts."""
+    with open(path) as f:
+        return [FollowupRule.from_dict(d) for d in json.load(f)]
+
+
+def extract_entities(*texts):
+    """Shipment IDs, vehicle IDs and cities mentioned in the texts, in order of first appearance."""
+    entities = {"shipment_id": [], "vehicle_id": [], "city": []}
+    for text in texts:
+        if not text:
+            continue
+        for key, values in (
+            ("shipment_id", _SHIPMENT_ID.findall(text)),
+            ("vehicle_id", _VEHICLE_ID.findall(text)),
+            ("city", [_CANONICAL_CITY[c.lower()] for c in _CITY.findall(text)]),
+        ):
+            for value in values:
+                if value not in entities[key]:
+                    entities[key].append(value)
+    return entities
+
+
+def detect_intent(query, sql=None):
+    text = f"{query} {sql or ''}".lower()
+    for intent, keywords in INTENT_KEYWORDS:
+        if any(k in text for k in keywords):
+            return intent
+    return "general"
+
+
+class FollowupEngine:
+    """Derives follow-up suggestions from intent, tables, entities and role without calling the LLM."""
+
+    def __init__(self, rules=None, fallback=None):
+        self.rules = list(DEFAULT_RULES if rules is None else rules)
+        self.fallback = list(FALLBACK_SUGGESTIONS if fallback is None else fallback)
+
+    def suggest(self, query, response_text="", sql=None, role="Guest", intent=None, limit=3):
+        context = {
+            "intent": intent or detect_intent(query, sql),
+            "tables": set(referenced_tables(canonicalize_sql(sql), TABLES)) if sql else set(),
+            "text": f"{query} {response_text}".lower(),
+            "role": role,
+        }
+        # Entities from the question first, so "delayed shipments in Tokyo" keeps Tokyo as the city
+        entities = {k: v[0] for k, v in extract_entities(query, response_text, sql).items() if v}
+
+        asked = normalize_query(query)
+        suggestions, seen = [], {asked}
+        for rule in self.rules:
+            if not rule.applies(context):
+                continue
+            for template in rule.suggestions:
+                try:
+                    suggestion = template.format(**entities)
+                except KeyError:
+                    continue
+                key = normalize_query(suggestion)
+                if key not in seen:
+                    seen.add(key)
+                    suggestions.append(suggestion)
+        for suggestion in self.fallback:
+            if normalize_query(suggestion) not in seen:
+                seen.add(normalize_query(suggestion))
+                suggestions.append(suggestion)
+        return suggestions[:limit]
+
+
+def build_engine(rules_path=None):
+    """Default rules, preceded by any rules from rules_path (FOLLOWUP_RULES_PATH)."""
+    rules_path = rules_path or os.getenv("FOLLOWUP_RULES_PATH")
+    extra = load_rules(rules_path) if rules_path else []
+    return FollowupEngine(extra + DEFAULT_RULES)
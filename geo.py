@@ -0,0 +1,179 @@
+import math
+import os
+import re
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 2 * math.pi * EARTH_RADIUS_KM / 360
+# Grid cell size of GridIndex; ~111 km of latitude per degree
+GEO_CELL_DEGREES = float(os.getenv("GEO_CELL_DEGREES", "1.0"))
+
+# City-centre coordinates for location names used by shipments (origin/destination) and drivers (current_location)
+CITY_COORDINATES = {
+    "amsterdam": (52.3676, 4.9041),
+    "berlin": (52.5200, 13.4050),
+    "chicago": (41.8781, -87.6298),
+    "delhi": (28.7041, 77.1025),
+    "dubai": (25.2048, 55.2708),
+    "hamburg": (53.5511, 9.9937),
+    "hong kong": (22.3193, 114.1694),
+    "london": (51.5074, -0.1278),
+    "los angeles": (34.0522, -118.2437),
+    "madrid": (40.4168, -3.7038),
+    "manchester": (53.4808, -2.2426),
+    "milan": (45.4642, 9.1900),
+    "mumbai": (19.0760, 72.8777),
+    "new york": (40.7128, -74.0060),
+    "paris": (48.8566, 2.3522),
+    "rotterdam": (51.9244, 4.4777),
+    "seoul": (37.5665, 126.9780),
+    "shanghai": (31.2304, 121.4737),
+    "singapore": (1.3521, 103.8198),
+    "sydney": (-33.8688, 151.2093),
+    "tokyo": (35.6762, 139.6503),
+    "toronto": (43.6532, -79.3832),
+}
+
+# "51.5074 N, 0.1278 W" (the vehicles.gps_coordinates format) or signed "51.5074, -0.1278"
+_GPS = re.compile(
+    r"^\s*([+-]?\d+(?:\.\d+)?)\s*([NS])?\s*,\s*([+-]?\d+(?:\.\d+)?)\s*([EW])?\s*$", re.I
+)
+
+
+def parse_gps(text):
+    """Parses a coordinate string into (lat, lon) in signed decimal degrees; raises ValueError if invalid."""
+    m = _GPS.match(text or "")
+    if not m:
+        raise ValueError(f"Unrecognized coordinates: {text!r}")
+    lat, lat_hemi, lon, lon_hemi = float(m.group(1)), m.group(2), float(m.group(3)), m.group(4)
+    if lat_hemi and lat_hemi.upper() == "S":
+        lat = -abs(lat)
+    if lon_hemi and lon_hemi.upper() == "W":
+        lon = -abs(lon)
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        raise ValueError(f"Coordinates out of range: {text!r}")
+    return lat, lon
+
+
+def format_gps(lat, lon):
+    """Inverse of parse_gps, in the "51.5074 N, 0.1278 W" format the vehicles table stores."""
+    return f"{abs(lat):.4f} {'N' if lat >= 0 else 'S'}, {abs(lon):.4f} {'E' if lon >= 0 else 'W'}"
+
+
+def city_coordinates(name):
+    """(lat, lon) of a known city name (case-insensitive), or None."""
+    return CITY_COORDINATES.get((name or "").strip().lower())
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in km; every argument may be a scalar or a NumPy array (broadcast)."""
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=float)) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+class GridIndex:
+    """Points (key -> lat/lon) bucketed into a cell_degrees grid for radius and k-nearest lookups.
+
+    A lookup only measures the points in the cells overlapping the search circle. Not thread-safe;
+    the owner serializes access (FleetState uses its own lock).
+    """
+
+    def __init__(self, cell_degrees=GEO_CELL_DEGREES):
+        self.cell_degrees = cell_degrees
+        self.columns = int(math.ceil(360 / cell_degrees))
+        self._cells = {}  # (row, column) -> set of keys
+        self._points = {}  # key -> (lat, lon, cell)
+
+    def __len__(self):
+        return len(self._points)
+
+    def update(self, key, lat, lon):
+        """Adds or moves a point; a NaN position removes it."""
+        self.update_many([key], [lat], [lon])
+
+    def update_many(self, keys, lats, lons):
+        """update() for arrays of points, with the grid cells computed in one pass."""
+        lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+        missing = np.isnan(lats) | np.isnan(lons)
+        rows = ((np.where(missing, 0, lats) + 90) // self.cell_degrees).astype(np.int64)
+        columns = ((np.where(missing, 0, lons) + 180) // self.cell_degrees % self.columns).astype(np.int64)
+        for key, lat, lon, row, column, gone in zip(np.asarray(keys).tolist(), lats.tolist(), lons.tolist(),
+                                                    rows.tolist(), columns.tolist(), missing.tolist()):
+            if gone:
+                self.remove(key)
+                continue
+            old = self._points.get(key)
+            cell = (row, column)
+            if old is None or old[2] != cell:
+                if old is not None:
+                    self._discard(key, old[2])
+                self._cells.setdefault(cell, set()).add(key)
+            self._points[key] = (lat, lon, cell)
+
+    def remove(self, key):
+        old = self._points.pop(key, None)
+        if old is not None:
+            self._discard(key, old[2])
+
+    def _discard(self, key, cell):
+        keys = self._cells[cell]
+        keys.discard(key)
+        if not keys:
+            del self._cells[cell]
+
+    def _candidates(self, lat, lon, radius_km):
+        """Keys in the cells overlapping the circle (or every key when that is fewer cells to visit)."""
+        lat_span = radius_km / KM_PER_DEGREE
+        first_row = int((max(lat - lat_span, -90) + 90) // self.cell_degrees)
+        last_row = int((min(lat + lat_span, 90) + 90) // self.cell_degrees)
+        widest = abs(lat) + lat_span
+        lon_span = 180 if widest >= 89.9 else min(180, lat_span / math.cos(math.radians(widest)))
+        if lon_span >= 180:
+            columns = range(self.columns)
+        else:
+            columns = range(int((lon - lon_span + 180) // self.cell_degrees),
+                            int((lon + lon_span + 180) // self.cell_degrees) + 1)
+        if (last_row - first_row + 1) * len(columns) >= len(self._cells):
+            return list(self._points)
+        return [key for row in range(first_row, last_row + 1) for column in columns
+                for key in self._cells.get((row, column % self.columns), ())]
+
+    def within(self, lat, lon, radius_km, where=None):
+        """[(key, km)] of points within radius_km, nearest first; where(key) filters them."""
+        keys = self._candidates(lat, lon, radius_km)
+        if where is not None:
+            keys = [k for k in keys if where(k)]
+        if not keys:
+            return []
+        points = np.array([self._points[k][:2] for k in keys], dtype=float)
+        km = haversine_km(lat, lon, points[:, 0], points[:, 1])
+        inside = np.flatnonzero(km <= radius_km)
+        return [(keys[i], float(km[i])) for i in inside[np.argsort(km[inside], kind="stable")]]
+
+    def nearest(self, lat, lon, k=1, where=None):
+        """[(key, km)] of the k nearest points; the search circle doubles until it holds k points."""
+        radius = self.cell_degrees * KM_PER_DEGREE / 4
+        while True:
+            found = self.within(lat, lon, radius, where)
+            if len(found) >= k or radius >= math.pi * EARTH_RADIUS_KM:
+                return found[:k]
+            radius *= 2
+
+
+def find_place(text):
+    """(name, (lat, lon)) of the first known city or coordinate pair in free text, or None."""
+    lowered = (text or "").lower()
+    matches = [(lowered.find(city), city) for city in CITY_COORDINATES
+               if re.search(rf"\b{re.escape(city)}\b", lowered)]
+    if matches:
+        city = min(matches)[1]
+        return city.title(), CITY_COORDINATES[city]
+    m = re.search(r"[+-]?\d+(?:\.\d+)?\s*[NS]?\s*,\s*[+-]?\d+(?:\.\d+)?\s*[EW]?", text or "", re.I)
+    if m:
+        try:
+            position = parse_gps(m.group(0))
+            return format_gps(*position), position
+        except ValueError:
+            pass
+    return None
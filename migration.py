@@ -0,0 +1,217 @@
+import json
+import os
+import resource
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Rows read from SQLite, written to Parquet and loaded per step; bounds memory per table worker
+MIGRATION_CHUNK_ROWS = int(os.getenv("MIGRATION_CHUNK_ROWS", "100000"))
+# Tables migrated at the same time
+MIGRATION_WORKERS = int(os.getenv("MIGRATION_WORKERS", "3"))
+# Parquet batches in flight and checkpoint.json (progress per table, used to resume)
+MIGRATION_DIR = os.getenv("MIGRATION_DIR", "migration_state")
+PARQUET_COMPRESSION = os.getenv("PARQUET_COMPRESSION", "zstd")
+
+
+def arrow_schema(conn, table):
+    """Arrow schema from the SQLite column declarations, so every chunk loads with the same types."""
+    fields = []
+    for _, name, declared, *_ in conn.execute(f"PRAGMA table_info({table})"):
+        declared = (declared or "").upper()
+        if "INT" in declared:
+            kind = pa.int64()
+        elif any(t in declared for t in ("REAL", "FLOA", "DOUB", "NUMERIC", "DECIMAL")):
+            kind = pa.float64()
+        elif "BOOL" in declared:
+            kind = pa.bool_()
+        else:
+            # TEXT, TIMESTAMP and DATE values come back from SQLite as strings
+            kind = pa.string()
+        fields.append(pa.field(name, kind))
+    return pa.schema(fields)
+
+
+def _as_bool(values):
+    # SQLite stores booleans as 0/1
+    return [None if v is None else bool(v) for v in values]
+
+
+def read_chunks(conn, table, schema, chunk_rows, after_rowid=0):
+    """Yields (last rowid, Arrow table) in rowid order, chunk_rows at a time (keyset pagination)."""
+    columns = ", ".join(f'"{f.name}"' for f in schema)
+    while True:
+        cursor = conn.execute(
+            f"SELECT rowid, {columns} FROM {table} WHERE rowid > ? ORDER BY rowid LIMIT ?", (after_rowid, chunk_rows)
+        )
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        after_rowid = rows[-1][0]
+        by_column = list(zip(*rows))[1:]
+        arrays = [pa.array(_as_bool(values) if f.type == pa.bool_() else values, type=f.type)
+                  for f, values in zip(schema, by_column)]
+        yield after_rowid, pa.Table.from_arrays(arrays, schema=schema)
+
+
+def peak_memory_mb():
+    """Peak resident set size of this process (ru_maxrss is KB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / 1024 / (1024 if sys.platform == "darwin" else 1), 1)
+
+
+class BigQueryTarget:
+    """Loads Parquet batches into BigQuery; job IDs are deterministic so a retried chunk is never loaded twice."""
+
+    def __init__(self, client, dataset_ref):
+        self.client = client
+        self.dataset_ref = dataset_ref
+
+    def load(self, table, path, append, job_id):
+        from google.api_core.exceptions import Conflict
+        from google.cloud import bigquery
+        job_config = bigquery.LoadJobConfig(
+            source_format=bigquery.SourceFormat.PARQUET,
+            write_disposition="WRITE_APPEND" if append else "WRITE_TRUNCATE",
+        )
+        try:
+            with open(path, "rb") as f:
+                job = self.client.load_table_from_file(f, self.dataset_ref.table(table), job_id=job_id,
+                                                       job_config=job_config)
+        except Conflict:
+            # Submitted before a crash: wait for that job instead of loading the chunk again
+            job = self.client.get_job(job_id)
+        job.result()
+
+
+class SQLiteTarget:
+    """Local stand-in for BigQuery; loaded job IDs are recorded in the same transaction as the rows."""
+
+    def __init__(self, path):
+        self.path = path
+        with sqlite3.connect(path) as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS _migration_jobs (job_id TEXT PRIMARY KEY)")
+
+    def load(self, table, path, append, job_id):
+        df = pq.read_table(path).to_pandas()
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                if conn.execute("SELECT 1 FROM _migration_jobs WHERE job_id = ?", (job_id,)).fetchone():
+                    return
+                df.to_sql(table, conn, if_exists="append" if append else "replace", index=False)
+                conn.execute("INSERT INTO _migration_jobs VALUES (?)", (job_id,))
+        finally:
+            conn.close()
+
+
+class Migration:
+    """Streams SQLite tables to a warehouse target in Parquet chunks, tables in parallel, resumable.
+
+    checkpoint.json records the last migrated rowid of every table after each loaded chunk;
+    a rerun continues from there unless the source database changed or restart is set.
+    """
+
+    def __init__(self, source_db, target, state_dir=MIGRATION_DIR, chunk_rows=MIGRATION_CHUNK_ROWS,
+                 workers=MIGRATION_WORKERS):
+        self.source_db = source_db
+        self.target = target
+        self.state_dir = state_dir
+        self.chunk_rows = chunk_rows
+        self.workers = workers
+        self._lock = threading.Lock()
+        self.checkpoint = None
+
+    def _checkpoint_path(self):
+        return os.path.join(self.state_dir, "checkpoint.json")
+
+    def _source_stamp(self):
+        stat = os.stat(self.source_db)
+        return f"{stat.st_size}:{int(stat.st_mtime)}"
+
+    def _load_checkpoint(self, restart):
+        if not restart and os.path.exists(self._checkpoint_path()):
+            with open(self._checkpoint_path()) as f:
+                checkpoint = json.load(f)
+            if checkpoint.get("source") == self._source_stamp():
+                return checkpoint
+            print("Migration: Source database changed since the checkpoint, starting over")
+        return {"source": self._source_stamp(), "run_id": str(int(time.time())), "tables": {}}
+
+    def _save_checkpoint(self):
+        with self._lock:
+            with open(self._checkpoint_path() + ".tmp", "w") as f:
+                json.dump(self.checkpoint, f, indent=2)
+            os.replace(self._checkpoint_path() + ".tmp", self._checkpoint_path())
+
+    def _load_chunk(self, table, progress, batch, last_rowid, chunk_dir):
+        """Writes one Parquet batch, loads it and records it in the checkpoint; returns the Parquet size."""
+        chunk = progress["chunks"]
+        path = os.path.join(chunk_dir, f"part-{chunk:05d}.parquet")
+        pq.write_table(batch, path, compression=PARQUET_COMPRESSION)
+        size = os.path.getsize(path)
+        job_id = f"migrate_{self.checkpoint['run_id']}_{table}_{chunk:05d}"
+        self.target.load(table, path, append=chunk > 0, job_id=job_id)
+        os.remove(path)
+        with self._lock:
+            progress.update(last_rowid=last_rowid, chunks=chunk + 1, rows=progress["rows"] + batch.num_rows,
+                            parquet_bytes=progress["parquet_bytes"] + size)
+        self._save_checkpoint()
+        print(f"Migration: {table} chunk {chunk} ({batch.num_rows} rows, {size / 1024:.0f} KB Parquet)")
+
+    def migrate_table(self, table):
+        """Migrates one table chunk by chunk; returns its report."""
+        progress = self.checkpoint["tables"].setdefault(
+            table, {"last_rowid": 0, "chunks": 0, "rows": 0, "parquet_bytes": 0, "done": False}
+        )
+        if progress["done"]:
+            print(f"Migration: {table} already migrated ({progress['rows']} rows), skipping")
+            return dict(progress, rows_migrated=0, seconds=0.0, rows_per_sec=0.0)
+        started = time.perf_counter()
+        rows_before = progress["rows"]
+        chunk_dir = os.path.join(self.state_dir, table)
+        os.makedirs(chunk_dir, exist_ok=True)
+        # sqlite3 connections cannot be shared between threads, so every table worker opens its own
+        conn = sqlite3.connect(self.source_db)
+        try:
+            schema = arrow_schema(conn, table)
+            for last_rowid, batch in read_chunks(conn, table, schema, self.chunk_rows, progress["last_rowid"]):
+                self._load_chunk(table, progress, batch, last_rowid, chunk_dir)
+            if progress["chunks"] == 0:
+                # Empty source table: load the schema alone so the target table exists
+                self._load_chunk(table, progress, schema.empty_table(), 0, chunk_dir)
+        finally:
+            conn.close()
+        with self._lock:
+            progress["done"] = True
+        self._save_checkpoint()
+        seconds = time.perf_counter() - started
+        migrated = progress["rows"] - rows_before
+        return dict(progress, rows_migrated=migrated, seconds=round(seconds, 2),
+                    rows_per_sec=round(migrated / seconds) if seconds else 0.0)
+
+    def run(self, tables, restart=False):
+        """Migrates the tables in parallel; returns {"tables": {table: report}, rows_per_sec, peak_memory_mb}."""
+        os.makedirs(self.state_dir, exist_ok=True)
+        self.checkpoint = self._load_checkpoint(restart)
+        self._save_checkpoint()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, min(self.workers, len(tables))),
+                                thread_name_prefix="migrate") as pool:
+            reports = dict(zip(tables, pool.map(self.migrate_table, tables)))
+        seconds = time.perf_counter() - started
+        migrated = sum(r["rows_migrated"] for r in reports.values())
+        summary = {
+            "tables": reports,
+            "rows_migrated": migrated,
+            "seconds": round(seconds, 2),
+            "rows_per_sec": round(migrated / seconds) if seconds else 0.0,
+            "peak_memory_mb": peak_memory_mb(),
+        }
+        print(f"Migration: {migrated} rows in {summary['seconds']}s ({summary['rows_per_sec']} rows/sec), "
+              f"peak memory {summary['peak_memory_mb']} MB")
+        return summary
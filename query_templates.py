@@ -0,0 +1,219 @@
+import re
+import threading
+from collections import deque
+from cache import normalize_query
+from followups import KNOWN_CITIES
+
+# Optional leading filler words ("show me all the ...") shared by the patterns below
+_LEAD = r"(?:(?:please|can you|could you|show|list|get|give|display|find|tell|check|what is|what are|whats|which are|are there any|are there)\s+)*(?:(?:me|us|all|the|any|current|currently)\s+)*"
+_TAIL = r"(?:\s+(?:please|right now|now|today|currently))?"
+# City slot: only cities known to the dataset, so "from London to Paris" or "in Berlin who are available"
+# are not read as one city name and are left to the Data Analyst
+_CITY_SLOT = r"(?P<city>" + "|".join(
+    re.escape(c.lower()) for c in sorted(KNOWN_CITIES, key=len, reverse=True)
+) + r")"
+
+
+def _count(n, noun):
+    return f"{n} {noun}" if n == 1 else f"{n} {noun}s"
+
+
+def _fmt_shipment(row):
+    return (f"- Shipment {row['id']}: {row['origin']} → {row['destination']} | {row['status']} | "
+            f"{row['priority']} priority | {row['cargo_type']} ({row['weight_kg']} kg)")
+
+
+def _summarize_delayed(rows, params):
+    where = f" involving {params['city']}" if params.get("city") else ""
+    if not rows:
+        return f"There are currently no delayed shipments{where}."
+    lines = "\n".join(_fmt_shipment(r) for r in rows)
+    total = rows[0].get("total_delayed") or len(rows)
+    shown = f" (showing the first {len(rows)})" if total > len(rows) else ""
+    return f"Found {_count(total, 'delayed shipment')}{where}{shown}:\n{lines}"
+
+
+def _summarize_capacity(rows, params):
+    row = rows[0] if rows else {}
+    if not row or not row.get("vehicles"):
+        return "No vehicles were found in the fleet."
+    capacity = row["total_capacity_kg"] or 0
+    load = row["total_load_kg"] or 0
+    utilization = (load / capacity * 100) if capacity else 0.0
+    return (f"The fleet has {_count(row['vehicles'], 'vehicle')} ({row['active_vehicles']} active) with a total capacity of "
+            f"{capacity:,.0f} kg. {load:,.0f} kg is currently loaded ({utilization:.1f}% utilization), "
+            f"leaving {capacity - load:,.0f} kg available.")
+
+
+def _summarize_low_fuel(rows, params):
+    scope = "active vehicle" if params.get("active") else "vehicle"
+    if not rows:
+        return f"No {scope}s have a fuel level below {params['threshold']:g}%."
+    lines = "\n".join(
+        f"- Vehicle {r['vehicle_id']} ({r['type']}, {r['status']}): {r['fuel_level']}% fuel, at {r['gps_coordinates']}"
+        for r in rows
+    )
+    return f"Found {_count(len(rows), scope)} with a fuel level below {params['threshold']:g}%:\n{lines}"
+
+
+def _summarize_shipment_status(rows, params):
+    if not rows:
+        return f"Shipment {params['shipment_id']} was not found."
+    row = rows[0]
+    return (f"Shipment {row['id']} ({row['cargo_type']}, {row['weight_kg']} kg) from {row['origin']} to "
+            f"{row['destination']} is **{row['status']}** with {row['priority']} priority. "
+            f"Scheduled delivery: {row['delivery_date']}.")
+
+
+def _summarize_drivers_in_city(rows, params):
+    if not rows:
+        return f"No drivers are currently located in {params['city']}."
+    lines = "\n".join(
+        f"- {r['name']} (ID {r['id']}): {r['status']}, rating {r['rating']}, {r['experience_years']} years experience"
+        for r in rows
+    )
+    return f"Found {_count(len(rows), 'driver')} currently located in {params['city']}:\n{lines}"
+
+
+class QueryTemplate:
+    """A prepared SQL statement that answers one common question intent without the ReAct agent."""
+
+    def __init__(self, name, patterns, sql, summarize, slots=None, defaults=None, fallback_on_empty=False):
+        self.name = name
+        self.patterns = [re.compile(p) for p in patterns]
+        self.sql = sql
+        self.summarize = summarize
+        self.slots = slots or {}  # slot name -> converter applied to the captured text
+        self.defaults = defaults or {}  # values for optional slots that were not captured
+        self.fallback_on_empty = fallback_on_empty  # no rows: let the Data Analyst answer instead
+
+    def match(self, normalized_query):
+        """Returns the bound SQL parameters if the whole query matches one of the patterns."""
+        for pattern in self.patterns:
+            m = pattern.fullmatch(normalized_query)
+            if m:
+                params = dict(self.defaults)
+                params.update({k: self.slots.get(k, str)(v) for k, v in m.groupdict().items() if v is not None})
+                return params
+        return None
+
+
+def _city(text):
+    return text.title()
+
+
+def _flag(text):
+    return True
+
+
+DEFAULT_TEMPLATES = [
+    QueryTemplate(
+        "delayed_shipments",
+        [
+            _LEAD + r"(?:delayed|late) shipments" + _TAIL,
+            _LEAD + r"shipments (?:that are |which are )?(?:currently )?(?:delayed|late)" + _TAIL,
+        ],
+        "SELECT id, origin, destination, status, priority, cargo_type, weight_kg, COUNT(*) OVER () AS total_delayed "
+        "FROM shipments WHERE status = 'Delayed' ORDER BY id LIMIT 50",
+        _summarize_delayed,
+    ),
+    QueryTemplate(
+        "delayed_shipments_by_city",
+        [
+            _LEAD + r"(?:delayed|late) shipments (?:in|from|to|for|at) " + _CITY_SLOT + _TAIL,
+            _LEAD + r"shipments (?:in|from|to|for|at) " + _CITY_SLOT + r" (?:that are |which are )?(?:currently )?(?:delayed|late)" + _TAIL,
+        ],
+        "SELECT id, origin, destination, status, priority, cargo_type, weight_kg, COUNT(*) OVER () AS total_delayed "
+        "FROM shipments WHERE status = 'Delayed' AND (LOWER(origin) = LOWER(:city) OR LOWER(destination) = LOWER(:city)) "
+        "ORDER BY id LIMIT 50",
+        _summarize_delayed,
+        slots={"city": _city},
+        fallback_on_empty=True,
+    ),
+    QueryTemplate(
+        "fleet_capacity",
+        [
+            _LEAD + r"(?:total |overall |available )?fleet capacity" + _TAIL,
+            _LEAD + r"(?:total |overall )?capacity of the fleet" + _TAIL,
+            r"how much capacity (?:does the fleet have|is available)(?: in the fleet)?",
+        ],
+        "SELECT COUNT(*) AS vehicles, SUM(CASE WHEN status = 'Active' THEN 1 ELSE 0 END) AS active_vehicles, "
+        "SUM(capacity_kg) AS total_capacity_kg, SUM(current_load_kg) AS total_load_kg FROM vehicles",
+        _summarize_capacity,
+    ),
+    QueryTemplate(
+        "low_fuel_vehicles",
+        [
+            _LEAD + r"(?:(?P<active>active) )?vehicles (?:with|having|that have) (?:a )?fuel(?: levels?)? "
+                    r"(?:below|under|less than|lower than) (?P<threshold>\d+(?:\.\d+)?)(?: ?%| percent)?" + _TAIL,
+        ],
+        "SELECT vehicle_id, type, status, fuel_level, gps_coordinates FROM vehicles "
+        "WHERE fuel_level < :threshold AND (:active = FALSE OR status = 'Active') ORDER BY fuel_level",
+        _summarize_low_fuel,
+        slots={"threshold": float, "active": _flag},
+        defaults={"active": False},
+    ),
+    QueryTemplate(
+        "shipment_status",
+        [
+            _LEAD + r"(?:the )?status (?:of|for) shipment (?:id |number |no |#)?(?P<shipment_id>\d+)" + _TAIL,
+            _LEAD + r"shipment (?:id |number |no |#)?(?P<shipment_id>\d+)(?: status)?" + _TAIL,
+            r"where is shipment (?:id |number |no |#)?(?P<shipment_id>\d+)",
+        ],
+        "SELECT id, origin, destination, status, priority, cargo_type, weight_kg, delivery_date FROM shipments "
+        "WHERE id = :shipment_id",
+        _summarize_shipment_status,
+        slots={"shipment_id": int},
+    ),
+    QueryTemplate(
+        "drivers_in_city",
+        [
+            _LEAD + r"drivers (?:that are |who are )?(?:currently )?(?:in|at|located in) " + _CITY_SLOT + _TAIL,
+            r"which drivers are (?:currently )?(?:in|at|located in) " + _CITY_SLOT,
+        ],
+        "SELECT id, name, status, rating, experience_years, current_location FROM drivers "
+        "WHERE LOWER(current_location) = LOWER(:city) ORDER BY rating DESC",
+        _summarize_drivers_in_city,
+        slots={"city": _city},
+        fallback_on_empty=True,
+    ),
+]
+
+
+class TemplateRegistry:
+    """Ordered set of query templates consulted before the Data Analyst, with hit/miss accounting."""
+
+    def __init__(self, templates=None, miss_log_size=100):
+        self.templates = list(DEFAULT_TEMPLATES if templates is None else templates)
+        self.hits = {}
+        self.misses = 0
+        self.recent_misses = deque(maxlen=miss_log_size)
+        self._lock = threading.Lock()
+
+    def register(self, template):
+        self.templates.append(template)
+
+    def match(self, query):
+        """Returns (template, params) for the first template matching the whole query, else None."""
+        normalized = normalize_query(query)
+        for template in self.templates:
+            params = template.match(normalized)
+            if params is not None:
+                with self._lock:
+                    self.hits[template.name] = self.hits.get(template.name, 0) + 1
+                print(f"Template Fast Path: HIT {template.name} {params}")
+                return template, params
+        with self._lock:
+            self.misses += 1
+            self.recent_misses.append(normalized)
+        print(f"Template Fast Path: MISS '{normalized}'")
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {
+                "templates": [t.name for t in self.templates],
+                "hits": dict(self.hits),
+                "misses": self.misses,
+                "recent_misses": list(self.recent_misses),
+            }
@@ -0,0 +1,165 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from followups import extract_entities
+
+# Token budget for the conversation history pasted into each analyst/strategist prompt
+SESSION_HISTORY_TOKENS = int(os.getenv("SESSION_HISTORY_TOKENS", "400"))
+# Most recent turns kept verbatim (answers truncated to fit); older turns are reduced to their questions
+SESSION_RECENT_TURNS = int(os.getenv("SESSION_RECENT_TURNS", "2"))
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "50"))
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "1000"))
+# Directory for persisted sessions; unset keeps sessions in memory only
+SESSION_STORE_DIR = os.getenv("SESSION_STORE_DIR")
+
+# Entities listed per kind in the compacted history
+MAX_ENTITIES = 5
+_ENTITY_LABELS = [("shipment_id", "shipments"), ("vehicle_id", "vehicles"), ("city", "cities")]
+
+
+def estimate_tokens(text):
+    """Approximate Gemini token count (about four characters per token)."""
+    return (len(text) + 3) // 4 if text else 0
+
+
+def _truncate(text, max_tokens):
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    return text[:max(0, max_tokens * 4 - 3)].rstrip() + "..."
+
+
+def render_turns(turns):
+    """Verbatim transcript, in the format the frontend used to send as history."""
+    return "\n".join(f"USER: {t['query']}\nASSISTANT: {t['summary']}" for t in turns)
+
+
+def entity_line(texts):
+    """One line listing the shipment/vehicle IDs and cities mentioned, most recent first."""
+    entities = extract_entities(*texts)
+    parts = [f"{label} {', '.join(entities[key][:MAX_ENTITIES])}" for key, label in _ENTITY_LABELS if entities[key]]
+    return f"Referenced entities: {'; '.join(parts)}" if parts else ""
+
+
+def compact_history(turns, budget=SESSION_HISTORY_TOKENS, recent=SESSION_RECENT_TURNS):
+    """History text for the prompts within budget tokens.
+
+    Entities from every turn are always kept, so "it" and "that shipment" stay resolvable after
+    the turn that introduced them has been compacted away.
+    """
+    if not turns:
+        return ""
+    # 1. Entities from the whole conversation, newest turn first
+    entities = entity_line(f"{t['query']} {t['summary']} {t.get('sql') or ''}" for t in reversed(turns))
+    remaining = budget - estimate_tokens(entities)
+    # turns[-0:] would be every turn, so split by index
+    split = max(len(turns) - recent, 0)
+
+    # 2. Recent turns verbatim, newest first; the answer is truncated to what is left of the budget
+    kept = []
+    for turn in reversed(turns[split:]):
+        question = f"USER: {turn['query']}"
+        if remaining - estimate_tokens(question) <= 0 and kept:
+            break
+        remaining -= estimate_tokens(question)
+        answer = "ASSISTANT: " + _truncate(turn["summary"], max(remaining - 3, 8))
+        remaining -= estimate_tokens(answer)
+        kept.insert(0, f"{question}\n{answer}")
+
+    # 3. Older turns reduced to their questions while budget remains
+    earlier = []
+    for turn in reversed(turns[:split]):
+        line = f"- {turn['query']}"
+        if estimate_tokens(line) > remaining:
+            break
+        remaining -= estimate_tokens(line)
+        earlier.insert(0, line)
+
+    lines = [entities] if entities else []
+    if earlier:
+        lines += ["Earlier questions:"] + earlier
+    return "\n".join(lines + kept)
+
+
+def trim_history(history, budget=SESSION_HISTORY_TOKENS):
+    """Budget for client-supplied history (no session): entities from all of it plus its most recent part."""
+    if estimate_tokens(history) <= budget:
+        return history
+    entities = entity_line([history])
+    tail_tokens = max(budget - estimate_tokens(entities), 8)
+    tail = "..." + history[-(tail_tokens * 4 - 3):]
+    return f"{entities}\n{tail}" if entities else tail
+
+
+class FileSessionBackend:
+    """Persists each session's turns as a JSON file, so sessions survive restarts of the process."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, session_id):
+        # Session IDs come from clients, so they are hashed rather than used as file names
+        return os.path.join(self.directory, hashlib.sha1(session_id.encode("utf-8")).hexdigest() + ".json")
+
+    def load(self, session_id):
+        try:
+            with open(self._path(session_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, session_id, turns):
+        path = self._path(session_id)
+        with open(path + ".tmp", "w") as f:
+            json.dump(turns, f)
+        os.replace(path + ".tmp", path)
+
+
+class SessionStore:
+    """Server-side conversation history per session ID (LRU in memory, optional persistence backend)."""
+
+    def __init__(self, backend=None, max_sessions=SESSION_MAX_SESSIONS, max_turns=SESSION_MAX_TURNS):
+        self.backend = backend
+        self.max_sessions = max_sessions
+        self.max_turns = max_turns
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, session_id):
+        turns = self._sessions.get(session_id)
+        if turns is None:
+            turns = (self.backend.load(session_id) if self.backend else None) or []
+            self._sessions[session_id] = turns
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+        self._sessions.move_to_end(session_id)
+        return turns
+
+    def turns(self, session_id):
+        with self._lock:
+            return list(self._get(session_id))
+
+    def append(self, session_id, query, summary, sql=None, keys=None):
+        """Records a turn; keys are the primary keys its SQL returned, per table (see references.py)."""
+        with self._lock:
+            turns = self._get(session_id)
+            turns.append({"query": query, "summary": summary, "sql": sql, "keys": keys or {}, "at": time.time()})
+            del turns[:-self.max_turns]
+            if self.backend:
+                self.backend.save(session_id, turns)
+
+    def history(self, session_id, budget=SESSION_HISTORY_TOKENS):
+        """Returns (compacted history, tokens of the verbatim transcript it replaces)."""
+        turns = self.turns(session_id)
+        return compact_history(turns, budget), estimate_tokens(render_turns(turns))
+
+    def stats(self):
+        with self._lock:
+            return {"sessions": len(self._sessions), "persistent": self.backend is not None}
+
+
+def build_store():
+    return SessionStore(FileSessionBackend(SESSION_STORE_DIR) if SESSION_STORE_DIR else None)
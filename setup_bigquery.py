@@ -1,9 +1,9 @@
 import os
-import pandas as pd
+import argparse
 from google.cloud import bigquery
 from google.oauth2 import service_account
-from sqlalchemy import create_engine
-import sqlite3
+from schema_snapshot import build_snapshot
+from migration import MIGRATION_CHUNK_ROWS, MIGRATION_DIR, MIGRATION_WORKERS, BigQueryTarget, Migration, SQLiteTarget
 
 # --- CONFIGURATION ---
 # REPLACE THESE WITH YOUR ACTUAL VALUES
@@ -11,8 +11,17 @@ PROJECT_ID = "inspiring-keel-423204-c7"
 DATASET_ID = "logistics_control_tower"
 SERVICE_ACCOUNT_FILE = "service-account.json"
 SQLITE_DB = "sales_data.db"
+TABLES = ["shipments", "drivers", "vehicles"]
+# Schema snapshot loaded by agents.py (root for local runs, backend/ ships with the function)
+SCHEMA_SNAPSHOT_PATHS = ["schema_snapshot.json", os.path.join("backend", "schema_snapshot.json")]
+
+def setup_bigquery(restart=False, chunk_rows=MIGRATION_CHUNK_ROWS, workers=MIGRATION_WORKERS, local_db=None):
+    # Offline stand-in: the same chunked, resumable migration into a local SQLite database
+    if local_db:
+        Migration(SQLITE_DB, SQLiteTarget(local_db), os.path.splitext(local_db)[0] + "_migration_state",
+                  chunk_rows, workers).run(TABLES, restart=restart)
+        return
 
-def setup_bigquery():
     if not os.path.exists(SERVICE_ACCOUNT_FILE):
         print(f"Error: {SERVICE_ACCOUNT_FILE} not found. Please upload it to the root folder.")
         return
@@ -31,21 +40,22 @@ def setup_bigquery():
         dataset = client.create_dataset(dataset)
         print(f"Created dataset {DATASET_ID}")
 
-    # 2. Migrate SQLite Tables
-    conn = sqlite3.connect(SQLITE_DB)
-    tables = ["shipments", "drivers", "vehicles"]
-    
-    for table in tables:
-        print(f"Migrating {table}...")
-        df = pd.read_sql_query(f"SELECT * FROM {table}", conn)
-        
-        # Load into BigQuery
-        table_ref = dataset_ref.table(table)
-        job_config = bigquery.LoadJobConfig(write_disposition="WRITE_TRUNCATE")
-        client.load_table_from_dataframe(df, table_ref, job_config=job_config).result()
-        print(f"Successfully migrated {table} to BigQuery.")
+    # 2. Migrate SQLite Tables (bounded chunks as Parquet, tables in parallel, resumes from the checkpoint)
+    tables = TABLES
+    summary = Migration(SQLITE_DB, BigQueryTarget(client, dataset_ref), MIGRATION_DIR, chunk_rows, workers).run(
+        tables, restart=restart
+    )
+    for table, report in summary["tables"].items():
+        print(f"Successfully migrated {table} to BigQuery ({report['rows']} rows, {report['rows_per_sec']} rows/sec).")
+
+    # 3. Schema Snapshot (DDL, column descriptions and sample rows for the Data Analyst)
+    print("Writing schema snapshot...")
+    snapshot = build_snapshot(client, PROJECT_ID, DATASET_ID, tables)
+    for path in SCHEMA_SNAPSHOT_PATHS:
+        snapshot.save(path)
+    print(f"Schema snapshot {snapshot.version} written to {', '.join(SCHEMA_SNAPSHOT_PATHS)}.")
 
-    # 3. Setup Gemini Model in BigQuery (BigQuery ML)
+    # 4. Setup Gemini Model in BigQuery (BigQuery ML)
     # Note: This requires the 'Vertex AI User' role on the service account.
     print("Setting up BigQuery ML (Gemini)...")
     connection_id = f"{PROJECT_ID}.us.vertex-ai-conn"
@@ -64,4 +74,10 @@ def setup_bigquery():
         print(f"Warning: Could not create ML model automatically. You may need to create the connection manually. Error: {e}")
 
 if __name__ == "__main__":
-    setup_bigquery()
+    parser = argparse.ArgumentParser(description="Create the dataset, migrate sales_data.db and configure BigQuery ML.")
+    parser.add_argument("--restart", action="store_true", help="Ignore the migration checkpoint and start over")
+    parser.add_argument("--chunk-rows", type=int, default=MIGRATION_CHUNK_ROWS, help="Rows per Parquet chunk")
+    parser.add_argument("--workers", type=int, default=MIGRATION_WORKERS, help="Tables migrated in parallel")
+    parser.add_argument("--local", metavar="SQLITE_DB", help="Migrate into a local SQLite database instead of BigQuery")
+    args = parser.parse_args()
+    setup_bigquery(restart=args.restart, chunk_rows=args.chunk_rows, workers=args.workers, local_db=args.local)
@@ -0,0 +1,218 @@
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime, timezone
+import pandas as pd
+from tables import KEY_COLUMNS
+
+# Row hashes and change versions of the last successful sync, one Parquet file per table
+SYNC_STATE_DIR = os.getenv("SYNC_STATE_DIR", "sync_state")
+# Marks staged rows that are deletions rather than upserts
+DELETED_COLUMN = "_deleted"
+
+
+def row_hashes(df, key):
+    """64-bit hash of every row (all columns, in name order), indexed by the key column."""
+    if df[key].duplicated().any():
+        raise ValueError(f"Duplicate values in key column {key}")
+    hashes = pd.util.hash_pandas_object(df[sorted(df.columns)], index=False)
+    return pd.Series(hashes.to_numpy(), index=pd.Index(df[key].to_numpy(), name=key), name="hash")
+
+
+def diff_rows(df, key, previous):
+    """Compares a table against the hashes of the last sync.
+
+    Returns (inserted rows, updated rows, deleted keys, current hashes).
+    """
+    current = row_hashes(df, key)
+    known = current.index.isin(previous.index)
+    changed = known & (current.to_numpy() != previous.reindex(current.index).to_numpy())
+    deleted = previous.index[~previous.index.isin(current.index)].tolist()
+    return df[~known], df[changed], deleted, current
+
+
+def staging_frame(upserts, key, deleted, columns):
+    """Delta rows in the target's column order; deletions carry only the key."""
+    frames = [upserts[columns].assign(**{DELETED_COLUMN: False})]
+    if deleted:
+        frames.append(pd.DataFrame({key: deleted, DELETED_COLUMN: True}))
+    return pd.concat(frames, ignore_index=True).reindex(columns=columns + [DELETED_COLUMN])
+
+
+def merge_statement(target, staging, key, columns):
+    """BigQuery MERGE applying a staged delta keyed on key."""
+    updates = ", ".join(f"{c} = S.{c}" for c in columns if c != key)
+    return (
+        f"MERGE `{target}` T USING `{staging}` S ON T.{key} = S.{key}\n"
+        f"WHEN MATCHED AND S.{DELETED_COLUMN} THEN DELETE\n"
+        f"WHEN MATCHED THEN UPDATE SET {updates}\n"
+        f"WHEN NOT MATCHED AND NOT S.{DELETED_COLUMN} THEN INSERT ({', '.join(columns)}) "
+        f"VALUES ({', '.join('S.' + c for c in columns)})"
+    )
+
+
+class BigQuerySyncBackend:
+    """Applies deltas to BigQuery: load into a staging table, then one MERGE into the target."""
+
+    def __init__(self, client, dataset_ref):
+        self.client = client
+        self.dataset_ref = dataset_ref
+
+    def _table_id(self, table):
+        return f"{self.dataset_ref.project}.{self.dataset_ref.dataset_id}.{table}"
+
+    def exists(self, table):
+        from google.api_core.exceptions import NotFound
+        try:
+            self.client.get_table(self._table_id(table))
+            return True
+        except NotFound:
+            return False
+
+    def replace(self, table, df):
+        from google.cloud import bigquery
+        job_config = bigquery.LoadJobConfig(write_disposition="WRITE_TRUNCATE")
+        self.client.load_table_from_dataframe(df, self._table_id(table), job_config=job_config).result()
+
+    def merge(self, table, key, staged):
+        from google.cloud import bigquery
+        target = self._table_id(table)
+        staging = self._table_id(f"_staging_{table}")
+        # The target's schema, so deletion rows (all NULL but the key) load with the right types
+        schema = self.client.get_table(target).schema + [bigquery.SchemaField(DELETED_COLUMN, "BOOL")]
+        job_config = bigquery.LoadJobConfig(write_disposition="WRITE_TRUNCATE", schema=schema)
+        try:
+            self.client.load_table_from_dataframe(staged, staging, job_config=job_config).result()
+            columns = [c for c in staged.columns if c != DELETED_COLUMN]
+            self.client.query(merge_statement(target, staging, key, columns)).result()
+        finally:
+            self.client.delete_table(staging, not_found_ok=True)
+
+
+class SQLiteSyncBackend:
+    """Local stand-in for BigQuery: the same staging table, with the MERGE as delete + upsert in one transaction."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def exists(self, table):
+        with sqlite3.connect(self.path) as conn:
+            return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+    def replace(self, table, df):
+        with sqlite3.connect(self.path) as conn:
+            df.to_sql(table, conn, if_exists="replace", index=False)
+
+    def merge(self, table, key, staged):
+        staging = f"_staging_{table}"
+        columns = [c for c in staged.columns if c != DELETED_COLUMN]
+        updates = ", ".join(f"{c} = excluded.{c}" for c in columns if c != key)
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                staged.to_sql(staging, conn, if_exists="replace", index=False)
+                # ON CONFLICT needs a unique index on the key (to_sql creates none)
+                conn.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS _sync_{table}_{key} ON {table} ({key})")
+                conn.execute(f"DELETE FROM {table} WHERE {key} IN "
+                             f"(SELECT {key} FROM {staging} WHERE {DELETED_COLUMN})")
+                conn.execute(f"INSERT INTO {table} ({', '.join(columns)}) SELECT {', '.join(columns)} FROM {staging} "
+                             f"WHERE NOT {DELETED_COLUMN} ON CONFLICT ({key}) DO UPDATE SET {updates}")
+                conn.execute(f"DROP TABLE {staging}")
+        finally:
+            conn.close()
+
+
+def write_replica_snapshot(frames, replica_dir, versions=None):
+    """Writes {table: DataFrame} as Parquet files plus the manifest warehouse.LocalReplica.load() reads."""
+    os.makedirs(replica_dir, exist_ok=True)
+    generated_at = datetime.now(timezone.utc).isoformat()
+    tables = {}
+    for name, df in frames.items():
+        file_name = f"{name}.parquet"
+        df.to_parquet(os.path.join(replica_dir, file_name), index=False)
+        tables[name] = {"file": file_name, "rows": len(df), "version": (versions or {}).get(name, generated_at)}
+    with open(os.path.join(replica_dir, "manifest.json"), "w") as f:
+        json.dump({"generated_at": generated_at, "tables": tables}, f, indent=2)
+
+
+class IncrementalSync:
+    """Syncs {table: DataFrame} into a backend, writing only rows that changed since the last sync.
+
+    Each table that changes gets a new change version in the manifest, a record of the sync
+    history (no cache reads it). Unchanged tables are not written at all, so their last-modified
+    time in the warehouse, which the agent's caches are keyed on, stays the same.
+    """
+
+    def __init__(self, backend, state_dir=SYNC_STATE_DIR, key_columns=None):
+        self.backend = backend
+        self.state_dir = state_dir
+        self.key_columns = dict(KEY_COLUMNS if key_columns is None else key_columns)
+        self.manifest = self._load_manifest()
+
+    def _manifest_path(self):
+        return os.path.join(self.state_dir, "manifest.json")
+
+    def _load_manifest(self):
+        if os.path.exists(self._manifest_path()):
+            with open(self._manifest_path()) as f:
+                return json.load(f)
+        return {"tables": {}}
+
+    def _load_hashes(self, table):
+        path = os.path.join(self.state_dir, f"{table}.parquet")
+        if table not in self.manifest["tables"] or not os.path.exists(path):
+            return None
+        state = pd.read_parquet(path)
+        return pd.Series(state["hash"].to_numpy(), index=pd.Index(state["key"].to_numpy()), name="hash")
+
+    def _save(self, table, hashes, entry):
+        os.makedirs(self.state_dir, exist_ok=True)
+        path = os.path.join(self.state_dir, f"{table}.parquet")
+        pd.DataFrame({"key": hashes.index.to_numpy(), "hash": hashes.to_numpy()}).to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+        self.manifest["tables"][table] = entry
+        with open(self._manifest_path() + ".tmp", "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(self._manifest_path() + ".tmp", self._manifest_path())
+
+    def change_versions(self):
+        """{table: change version}; a table's version only increases when its rows change."""
+        return {table: entry["version"] for table, entry in self.manifest["tables"].items()}
+
+    def sync_table(self, table, df, full=False):
+        """Syncs one table; returns its report (inserted/updated/deleted counts, version, mode, seconds)."""
+        started = time.perf_counter()
+        key = self.key_columns[table]
+        previous = None if full else self._load_hashes(table)
+        entry = dict(self.manifest["tables"].get(table, {"version": 0}))
+
+        if previous is None or not self.backend.exists(table):
+            # First sync (or forced): full load establishes the baseline hashes
+            hashes = row_hashes(df, key)
+            self.backend.replace(table, df)
+            counts, mode = {"inserted": len(df), "updated": 0, "deleted": 0}, "full"
+        else:
+            inserted, updated, deleted, hashes = diff_rows(df, key, previous)
+            counts = {"inserted": len(inserted), "updated": len(updated), "deleted": len(deleted)}
+            if not any(counts.values()):
+                return dict(counts, version=entry["version"], mode="unchanged", seconds=round(time.perf_counter() - started, 3))
+            staged = staging_frame(pd.concat([inserted, updated]), key, deleted, list(df.columns))
+            self.backend.merge(table, key, staged)
+            mode = "merge"
+
+        # State is saved only after the backend accepted the delta, so a failed run retries the same delta
+        entry.update(counts, version=entry["version"] + 1, rows=len(df),
+                     synced_at=datetime.now(timezone.utc).isoformat())
+        self._save(table, hashes, entry)
+        return dict(counts, version=entry["version"], mode=mode, seconds=round(time.perf_counter() - started, 3))
+
+    def sync(self, frames, full=False):
+        """Syncs every table in frames; returns {table: report}."""
+        report = {}
+        for table, df in frames.items():
+            report[table] = self.sync_table(table, df, full)
+            r = report[table]
+            print(f"Sync: {table} {r['mode']} (+{r['inserted']} ~{r['updated']} -{r['deleted']}) "
+                  f"-> version {r['version']} in {r['seconds']}s")
+        return report
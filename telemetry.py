@@ -0,0 +1,233 @@
+import bisect
+import contextvars
+import threading
+import time
+import weakref
+
+# Histogram buckets in seconds, from template fast-path lookups up to slow ReAct runs
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Span that SQL statements and LLM calls are attributed to on the current thread/context
+_current_span = contextvars.ContextVar("telemetry_span", default=None)
+
+
+class Histogram:
+    """Cumulative Prometheus-style histogram."""
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """In-process counters and histograms rendered in the Prometheus text format (no collector needed)."""
+
+    def __init__(self):
+        self.help = {}
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> Histogram
+        self._lock = threading.Lock()
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].observe(value)
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{str(v)}"' for k, v in pairs) + "}"
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for kind, series in (("counter", self.counters), ("histogram", self.histograms)):
+                seen = set()
+                for name, labels in sorted(series):
+                    if name not in seen:
+                        seen.add(name)
+                        if name in self.help:
+                            lines.append(f"# HELP {name} {self.help[name]}")
+                        lines.append(f"# TYPE {name} {kind}")
+                    value = series[(name, labels)]
+                    if kind == "counter":
+                        lines.append(f"{name}{self._labels(labels)} {value:g}")
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(value.buckets + ("+Inf",), value.counts):
+                        cumulative += count
+                        lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"{name}_sum{self._labels(labels)} {value.sum:g}")
+                    lines.append(f"{name}_count{self._labels(labels)} {value.count}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+METRICS.describe("agent_stage_duration_seconds", "Duration of each orchestrator stage")
+METRICS.describe("http_request_duration_seconds", "Duration of HTTP requests handled by process_query")
+METRICS.describe("llm_calls_total", "LLM calls by orchestrator stage")
+METRICS.describe("llm_tokens_total", "LLM tokens by orchestrator stage and direction")
+METRICS.describe("agent_iterations_total", "ReAct tool iterations executed by the Data Analyst")
+METRICS.describe("sql_statements_total", "SQL statements executed by backend")
+METRICS.describe("bigquery_bytes_processed_total", "Bytes processed by BigQuery query jobs")
+METRICS.describe("coalesced_total", "Requests (level=run) and SQL statements (level=sql) served by an identical in-flight call")
+METRICS.describe("sql_batch_deduplicated_total", "Statements shared between queries of a /query/batch request")
+METRICS.describe("session_prompt_tokens_saved_total", "Prompt tokens saved by compacting conversation history")
+METRICS.describe("sql_guard_rejected_total", "Data Analyst statements rejected by the SQL guard, by role and reason")
+METRICS.describe("sql_guard_limit_injected_total", "Exploratory Data Analyst statements given an automatic LIMIT")
+METRICS.describe("sql_guard_estimated_bytes_total", "Bytes the SQL guard estimated before execution, by estimator")
+METRICS.describe("telemetry_pings_total", "Vehicle telemetry pings by result (accepted, rejected, stale)")
+METRICS.describe("telemetry_flushed_rows_total", "Vehicle rows written back to the warehouse by telemetry flushes")
+
+
+class Span:
+    """Timed stage of a request; collects LLM, token, iteration and SQL counts while it is current."""
+
+    def __init__(self, name):
+        self.name = name
+        self.duration_ms = None
+        self.attributes = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, value=1):
+        with self._lock:
+            self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def __enter__(self):
+        self._token = _current_span.set(self)
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self._started
+        _current_span.reset(self._token)
+        self.duration_ms = round(elapsed * 1000, 1)
+        METRICS.observe("agent_stage_duration_seconds", elapsed, stage=self.name)
+        if self.attributes.get("agent_iterations"):
+            METRICS.inc("agent_iterations_total", self.attributes["agent_iterations"])
+        return False
+
+    def to_dict(self):
+        return {"name": self.name, "duration_ms": self.duration_ms, **self.attributes}
+
+
+class Trace:
+    """The spans recorded for one request, in start order."""
+
+    def __init__(self):
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def span(self, name):
+        span = Span(name)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def timed(self, name, fn, *args, **kwargs):
+        """Runs fn inside a span and returns (result, elapsed milliseconds)."""
+        with self.span(name) as span:
+            result = fn(*args, **kwargs)
+        return result, span.duration_ms
+
+    def to_list(self):
+        with self._lock:
+            return [span.to_dict() for span in self.spans]
+
+
+def current_span():
+    return _current_span.get()
+
+
+def record_llm_call(input_tokens=0, output_tokens=0):
+    span = _current_span.get()
+    stage = span.name if span is not None else "other"
+    METRICS.inc("llm_calls_total", stage=stage)
+    METRICS.inc("llm_tokens_total", input_tokens, stage=stage, direction="input")
+    METRICS.inc("llm_tokens_total", output_tokens, stage=stage, direction="output")
+    if span is not None:
+        span.add("llm_calls")
+        span.add("input_tokens", input_tokens)
+        span.add("output_tokens", output_tokens)
+
+
+def record_sql(backend, bytes_processed=None):
+    METRICS.inc("sql_statements_total", backend=backend)
+    if bytes_processed:
+        METRICS.inc("bigquery_bytes_processed_total", bytes_processed)
+    span = _current_span.get()
+    if span is not None:
+        span.add("sql_statements")
+        if bytes_processed:
+            span.add("bigquery_bytes_processed", bytes_processed)
+
+
+_instrumented_engines = weakref.WeakSet()
+
+
+def instrument_engine(engine, backend=None):
+    """Counts every statement an SQLAlchemy engine executes, plus BigQuery bytes processed."""
+    from sqlalchemy import event
+    if engine in _instrumented_engines:
+        return
+    _instrumented_engines.add(engine)
+    backend = backend or engine.dialect.name
+
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # google.cloud.bigquery.dbapi cursors keep the finished query job
+        job = getattr(cursor, "query_job", None)
+        record_sql(backend, getattr(job, "total_bytes_processed", None))
+
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+_llm_handler = None
+
+
+def instrument_llm(llm):
+    """Attaches a shared LangChain callback that attributes LLM calls and token usage to the current span."""
+    global _llm_handler
+    if _llm_handler is None:
+        # Imported here so importing telemetry stays cheap for the HTTP handler's cold start
+        from langchain_core.callbacks import BaseCallbackHandler
+
+        class LLMTelemetryHandler(BaseCallbackHandler):
+            def on_llm_end(self, response, **kwargs):
+                input_tokens = output_tokens = 0
+                for generations in response.generations:
+                    for generation in generations:
+                        usage = getattr(getattr(generation, "message", None), "usage_metadata", None) or {}
+                        input_tokens += usage.get("input_tokens", 0)
+                        output_tokens += usage.get("output_tokens", 0)
+                record_llm_call(input_tokens, output_tokens)
+
+        _llm_handler = LLMTelemetryHandler()
+    if llm.callbacks is None or isinstance(llm.callbacks, list):
+        if _llm_handler not in (llm.callbacks or []):
+            llm.callbacks = list(llm.callbacks or []) + [_llm_handler]
+    else:
+        llm.callbacks.add_handler(_llm_handler)
+    return llm
+
+
+def observe_request(route, method, status, seconds):
+    METRICS.observe("http_request_duration_seconds", seconds, route=route, method=method, status=status)
@@ -0,0 +1,440 @@
+"""Offline latency benchmark for the multi-agent pipeline.
+
+Drives MultiAgentLogisticsSystem.run and backend/main.py::process_query with a deterministic
+fake chat model and a local SQLite copy of sales_data.db, so no Vertex AI or BigQuery access
+is needed. Reports p50/p95/p99 latency, LLM calls, SQL statements and allocations per scenario.
+
+With --throughput it instead serves the same agent over HTTP through the functions_framework
+handler (main.py) and the async FastAPI service (api.py) and compares requests/second under
+concurrent load.
+
+Before each measured request the question -> SQL example store is reset to SEED_EXAMPLES, as if
+the analytics question had been answered once before; --no-examples disables the few-shot hints.
+
+Usage:
+    python tests/benchmark.py                          # compare against tests/benchmark_baseline.json
+    python tests/benchmark.py --save-baseline          # record a new baseline
+    python tests/benchmark.py --llm-latency-ms 200 --iterations 50
+    python tests/benchmark.py --no-examples             # analyst without few-shot example hints
+    KPI_SHORTCUT=false python tests/benchmark.py        # KPI questions go to the analyst
+    python tests/benchmark.py --throughput --requests 64 --concurrency 16
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import re
+import shutil
+import socket
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BACKEND = os.path.join(ROOT, "backend")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, BACKEND)
+# The benchmark installs its own agent into main.py, so skip the background pre-warm
+os.environ.setdefault("PREWARM_ON_START", "false")
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from sqlalchemy import event
+
+DEFAULT_SQLITE = os.path.join(ROOT, "sales_data.db")
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+# name -> (query, role, history)
+SCENARIOS = {
+    "analytics": ("Which delayed shipments carry insured cargo and who are the customers?", "Logistics Manager", ""),
+    "analytics_paraphrase": ("List the customers whose insured shipments are delayed", "Logistics Manager", ""),
+    "analytics_template": ("Show me all delayed shipments", "Logistics Manager", ""),
+    "analytics_kpi": ("What is the profit margin by customer?", "Logistics Manager", ""),
+    "analytics_dispatch": ("Assign the pending and delayed shipments to vehicles", "Logistics Manager", ""),
+    "analytics_nearby": ("Which vehicles are near London?", "Logistics Manager", ""),
+    "strategy": ("How can we optimize vehicle load utilization across the fleet?", "Logistics Manager", ""),
+    "communication": ("Check my inbox for new messages", "Logistics Manager", ""),
+    "rbac_denied": ("What is the total salary cost of our drivers?", "Guest", ""),
+}
+
+# SQL the fake Data Analyst "writes" for each topic in the question
+ANALYST_SQL = [
+    ("utilization", "SELECT vehicle_id, type, capacity_kg, current_load_kg FROM vehicles WHERE status = 'Active'"),
+    ("driver", "SELECT id, name, status, rating, current_location FROM drivers"),
+    ("shipment", "SELECT id, cargo_type, customer_name FROM shipments WHERE status = 'Delayed' AND insurance_status"),
+]
+
+# Example store contents before every measured request: one earlier analytics run
+SEED_EXAMPLES = [(SCENARIOS["analytics"][0], ANALYST_SQL[-1][1], 2)]
+
+
+class FakeChatModel(BaseChatModel):
+    """Deterministic stand-in for Gemini: scripted ReAct steps, fixed latency and token counts."""
+
+    latency_ms: float = 50.0
+    output_tokens: int = 120
+    calls: int = 0
+    input_tokens: int = 0
+
+    @property
+    def _llm_type(self):
+        return "fake-benchmark"
+
+    def _respond(self, prompt):
+        if "Return ONLY a JSON list" in prompt:
+            return '["Which vehicles have low fuel?", "Show delayed shipments", "What is the fleet capacity?"]'
+        if "Senior Fleet Operations Manager" in prompt:
+            return ("1. Rebalance loads from the most utilized trucks onto idle capacity.\n"
+                    "2. Schedule maintenance for vehicles below 15% fuel.\n"
+                    "3. Prioritize delayed high-priority shipments for the next dispatch window.")
+        if "Double check the" in prompt:
+            return re.findall(r"(SELECT[^\n]*)", prompt)[-1]
+
+        # ReAct Data Analyst: list tables -> schema -> query -> answer
+        question = prompt.split("Question:")[-1]
+        steps = question.count("Observation:")
+        hinted = re.findall(r"^SQL: (SELECT[^\n]*)", question, re.M)
+        if steps == 0 and hinted:
+            # A verified example already names the tables and columns, so go straight to the query
+            return f"Thought: A similar question was answered before.\nAction: sql_db_query\nAction Input: {hinted[0]}"
+        if steps == 0:
+            return "Thought: I should look at the tables in the database.\nAction: sql_db_list_tables\nAction Input: "
+        if steps == 1:
+            return "Thought: I should inspect the relevant tables.\nAction: sql_db_schema\nAction Input: shipments, vehicles"
+        if steps == 2 and "Action: sql_db_query" not in question:
+            sql = next((s for keyword, s in ANALYST_SQL if keyword in question.lower()), ANALYST_SQL[-1][1])
+            return f"Thought: I can now query the data.\nAction: sql_db_query\nAction Input: {sql}"
+        observation = question.rsplit("Observation:", 1)[-1].split("Thought:")[0].strip()
+        return f"Thought: I now know the final answer.\nFinal Answer: Query results: {observation[:400]}"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        prompt = "\n".join(str(m.content) for m in messages)
+        prompt_tokens = len(prompt) // 4
+        with _counter_lock:
+            self.calls += 1
+            self.input_tokens += prompt_tokens
+        time.sleep(self.latency_ms / 1000)
+        message = AIMessage(
+            content=self._respond(prompt),
+            usage_metadata={"input_tokens": prompt_tokens, "output_tokens": self.output_tokens,
+                            "total_tokens": prompt_tokens + self.output_tokens},
+        )
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def bind_tools(self, tools, **kwargs):
+        return self
+
+
+_counter_lock = threading.Lock()
+
+
+def prepare_database(source, workdir):
+    """Copies the SQLite source (or builds one from the seed data) so runs never modify it."""
+    path = os.path.join(workdir, "sales_data.db")
+    if os.path.exists(source):
+        shutil.copyfile(source, path)
+        return path
+    print(f"{source} not found, building a local copy from update_bigquery_data.build_datasets()")
+    from update_bigquery_data import build_datasets
+    with sqlite3.connect(path) as conn:
+        for name, df in build_datasets().items():
+            df.to_sql(name, conn, index=False)
+    return path
+
+
+def _agent_iterations():
+    """ReAct iterations the Data Analyst has run in this process (telemetry counter)."""
+    from telemetry import METRICS
+    return sum(v for (name, _), v in list(METRICS.counters.items()) if name == "agent_iterations_total")
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    k = (len(ordered) - 1) * pct / 100
+    low = int(k)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (k - low)
+
+
+class Bench:
+    def __init__(self, args, db_path):
+        import agents
+        import main
+        self.llm = FakeChatModel(latency_ms=args.llm_latency_ms, output_tokens=args.output_tokens)
+        self.system = agents.MultiAgentLogisticsSystem(llm=self.llm, db_uri=f"sqlite:///{db_path}")
+        self.sql_statements = 0
+        event.listen(self.system.db._engine, "before_cursor_execute", self._count_sql)
+        self.warm_cache = args.warm_cache
+        # Isolated example store next to the database copy (None disables the hints)
+        from examples import ExampleStore
+        no_examples = getattr(args, "no_examples", False)
+        self.system.examples = None if no_examples else ExampleStore(os.path.join(os.path.dirname(db_path), "examples.json"))
+        # KPI aggregates as update_bigquery_data.py would build them for this database
+        import pandas as pd
+        from kpis import KPIStore
+        self.system.kpis = KPIStore()
+        with self.system.db._engine.connect() as connection:
+            self.system.kpis.refresh({t: pd.read_sql_table(t, connection) for t in agents.TABLES})
+
+        # process_query through a Flask test client, with the benchmark agent preinstalled
+        from flask import Flask, request
+        main.agent = self.system
+        self.app = Flask("benchmark")
+        self.app.add_url_rule("/<path:path>", "process_query", lambda path: main.process_query(request),
+                              methods=["GET", "POST", "OPTIONS"])
+        self.client = self.app.test_client()
+
+    def _count_sql(self, *args):
+        with _counter_lock:
+            self.sql_statements += 1
+
+    def _reset_caches(self):
+        if not self.warm_cache:
+            self.system.response_cache.invalidate()
+            self.system.db.result_cache.clear()
+            if self.system.examples is not None:
+                from examples import ExampleStore
+                self.system.examples = ExampleStore()
+                for question, sql, rows in SEED_EXAMPLES:
+                    self.system.examples.add(question, sql, rows)
+
+    def call(self, target, query, role, history):
+        if target == "run":
+            return self.system.run(query, role, history)
+        response = self.client.post("/query", json={"query": query, "role": role, "history": history})
+        assert response.status_code == 200, response.get_data(as_text=True)
+        return json.loads(response.get_data(as_text=True))
+
+    def measure(self, target, scenario, iterations):
+        query, role, history = SCENARIOS[scenario]
+        self._reset_caches()
+        self.call(target, query, role, history)  # warm-up, not recorded
+
+        latencies = []
+        llm_calls = sql_statements = agent_iterations = 0
+        for _ in range(iterations):
+            self._reset_caches()
+            llm_before, sql_before, iterations_before = self.llm.calls, self.sql_statements, _agent_iterations()
+            started = time.perf_counter()
+            self.call(target, query, role, history)
+            latencies.append((time.perf_counter() - started) * 1000)
+            llm_calls += self.llm.calls - llm_before
+            sql_statements += self.sql_statements - sql_before
+            agent_iterations += _agent_iterations() - iterations_before
+
+        # One extra traced request for allocation figures (tracing distorts latency)
+        self._reset_caches()
+        tracemalloc.start()
+        before, _ = tracemalloc.get_traced_memory()
+        self.call(target, query, role, history)
+        after, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return {
+            "p50_ms": round(percentile(latencies, 50), 2),
+            "p95_ms": round(percentile(latencies, 95), 2),
+            "p99_ms": round(percentile(latencies, 99), 2),
+            "mean_ms": round(sum(latencies) / len(latencies), 2),
+            "llm_calls": round(llm_calls / iterations, 2),
+            "sql_statements": round(sql_statements / iterations, 2),
+            "agent_iterations": round(agent_iterations / iterations, 2),
+            "alloc_peak_kb": round((peak - before) / 1024, 1),
+            "alloc_retained_kb": round((after - before) / 1024, 1),
+        }
+
+
+def print_results(results, baseline=None):
+    header = f"{'scenario':<32}{'p50':>9}{'p95':>9}{'p99':>9}{'llm':>6}{'sql':>6}{'iters':>7}{'peak KB':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        print(f"{name:<32}{r['p50_ms']:>9.1f}{r['p95_ms']:>9.1f}{r['p99_ms']:>9.1f}"
+              f"{r['llm_calls']:>6g}{r['sql_statements']:>6g}{r.get('agent_iterations', 0):>7g}{r['alloc_peak_kb']:>10.1f}")
+        base = (baseline or {}).get(name)
+        if base:
+            deltas = [
+                f"{key} {(r[key] - base[key]) / base[key] * 100:+.1f}%"
+                for key in ("p50_ms", "p95_ms", "alloc_peak_kb") if base.get(key)
+            ] + [
+                f"{key} {base[key]:g}->{r[key]:g}"
+                for key in ("llm_calls", "sql_statements", "agent_iterations") if key in base and base[key] != r[key]
+            ]
+            print(f"{'  vs baseline:':<32}{', '.join(deltas)}")
+
+
+def serve_wsgi(app, threaded):
+    """Serves the Flask-wrapped functions_framework handler; threaded=False handles one request at a time."""
+    import logging
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=threaded)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server.shutdown
+
+
+def serve_asgi(app):
+    import uvicorn
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+
+    def stop():
+        server.should_exit = True
+        thread.join()
+    return f"http://127.0.0.1:{port}", stop
+
+
+async def generate_load(url, requests, concurrency):
+    """Sends distinct analytics questions (no response-cache hits) with a fixed number in flight."""
+    import httpx
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, errors = [], 0
+
+    async def one(client, i):
+        nonlocal errors
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.post(f"{url}/query", json={
+                "query": f"Which delayed shipments are insured for depot {i}?", "role": "Logistics Manager"})
+            latencies.append((time.perf_counter() - started) * 1000)
+            if response.status_code != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    async with httpx.AsyncClient(timeout=600) as client:
+        await asyncio.gather(*(one(client, i) for i in range(requests)))
+    return time.perf_counter() - started, latencies, errors
+
+
+def throughput(bench, args):
+    import api
+    api.agent = bench.system
+    servers = [
+        ("functions_framework (1 at a time)", lambda: serve_wsgi(bench.app, threaded=False)),
+        ("functions_framework (threaded)", lambda: serve_wsgi(bench.app, threaded=True)),
+        ("api.py async (uvicorn)", lambda: serve_asgi(api.app)),
+    ]
+    results = {}
+    for name, start in servers:
+        bench._reset_caches()
+        url, stop = start()
+        try:
+            wall, latencies, errors = asyncio.run(generate_load(url, args.requests, args.concurrency))
+        finally:
+            stop()
+        results[name] = {
+            "requests_per_s": round(args.requests / wall, 2),
+            "p50_ms": round(percentile(latencies, 50), 1),
+            "p95_ms": round(percentile(latencies, 95), 1),
+            "errors": errors,
+        }
+    return results
+
+
+def print_throughput(results):
+    header = f"{'server':<36}{'req/s':>9}{'p50':>10}{'p95':>10}{'errors':>8}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        print(f"{name:<36}{r['requests_per_s']:>9.2f}{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['errors']:>8}")
+
+
+def regressions(results, baseline, max_regression_pct):
+    failed = []
+    for name, r in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        # Ignore sub-millisecond jitter on the paths that never reach the LLM
+        slower = r["p95_ms"] - base.get("p95_ms", r["p95_ms"])
+        if slower > 5.0 and slower / base["p95_ms"] * 100 > max_regression_pct:
+            failed.append(f"{name}: p95 {base['p95_ms']} -> {r['p95_ms']} ms")
+        for key in ("llm_calls", "sql_statements"):
+            if r[key] > base.get(key, r[key]):
+                failed.append(f"{name}: {key} {base[key]} -> {r[key]}")
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--targets", nargs="+", choices=["run", "http"], default=["run", "http"])
+    parser.add_argument("--llm-latency-ms", type=float, default=50.0, help="Fake model latency per call")
+    parser.add_argument("--output-tokens", type=int, default=120, help="Fake model output tokens per call")
+    parser.add_argument("--sqlite", default=DEFAULT_SQLITE, help="SQLite source copied for the run")
+    parser.add_argument("--warm-cache", action="store_true", help="Keep response/SQL caches between iterations")
+    parser.add_argument("--no-examples", action="store_true", help="Disable few-shot hints from the example store")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Write results to --baseline")
+    parser.add_argument("--max-regression", type=float, default=25.0, help="Allowed p95 regression in percent")
+    parser.add_argument("--json", help="Also write results to this file")
+    parser.add_argument("--verbose", action="store_true", help="Show agent and request logs")
+    parser.add_argument("--throughput", action="store_true", help="Compare HTTP serving throughput instead")
+    parser.add_argument("--requests", type=int, default=32, help="Requests per server in --throughput mode")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight in --throughput mode")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="agent-bench-")
+    logs = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, "w"))
+    try:
+        with logs:
+            bench = Bench(args, prepare_database(args.sqlite, workdir))
+            if args.throughput:
+                served = throughput(bench, args)
+            results = {}
+            for target in ([] if args.throughput else args.targets):
+                for scenario in args.scenarios:
+                    results[f"{target}:{scenario}"] = bench.measure(target, scenario, args.iterations)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.throughput:
+        print(f"\nThroughput: {args.requests} distinct analytics queries, {args.concurrency} in flight, "
+              f"fake LLM {args.llm_latency_ms:g} ms/call (latency in ms)\n")
+        print_throughput(served)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump({"config": vars(args), "throughput": served}, f, indent=2)
+        return
+
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+
+    print(f"\nBenchmark: {args.iterations} iterations, fake LLM {args.llm_latency_ms:g} ms/call, "
+          f"caches {'warm' if args.warm_cache else 'cleared'}, example hints {'off' if args.no_examples else 'on'} "
+          f"(latency in ms)\n")
+    print_results(results, baseline)
+
+    report = {"config": {k: v for k, v in vars(args).items() if k not in ("baseline", "save_baseline", "json")},
+              "results": results}
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nBaseline written to {args.baseline}")
+    elif baseline:
+        failed = regressions(results, baseline, args.max_regression)
+        if failed:
+            print("\nRegressions:\n  " + "\n  ".join(failed))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
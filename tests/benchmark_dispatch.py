@@ -0,0 +1,126 @@
+"""Scaling benchmark for the dispatch optimizer (backend/dispatch.py).
+
+Generates random pending/delayed shipments and vehicles around the known cities and times
+plan_dispatch at growing sizes. At the smaller sizes it also runs a plain-Python version of the
+same greedy assignment (distance per pair, no matrix), checks both produce the same plan, and
+reports the speedup.
+
+Usage:
+    python tests/benchmark_dispatch.py
+    python tests/benchmark_dispatch.py --sizes 1000 5000 10000 --repeat 5
+    python tests/benchmark_dispatch.py --live       # vehicle positions from a FleetState instead of the table
+"""
+import argparse
+import math
+import os
+import random
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+
+from dispatch import DISPATCH_MIN_FUEL, DISPATCH_RANGE_KM, PRIORITY_RANK, plan_dispatch, vehicle_arrays
+from fleet_state import FleetState
+from geo import CITY_COORDINATES, EARTH_RADIUS_KM, city_coordinates, format_gps
+
+
+def generate(shipments, vehicles, seed=7):
+    """Random shipments (origins from the known cities, a few unknown) and vehicles scattered around them."""
+    rng = random.Random(seed)
+    cities = [c.title() for c in CITY_COORDINATES] + ["Wrightview"]
+    shipment_rows = [{
+        "id": i,
+        "origin": rng.choice(cities),
+        "destination": rng.choice(cities),
+        "status": rng.choice(["Pending", "Delayed"]),
+        "priority": rng.choice(list(PRIORITY_RANK)),
+        "weight_kg": round(rng.uniform(100, 4000), 1),
+    } for i in range(1, shipments + 1)]
+    vehicle_rows = []
+    for i in range(1, vehicles + 1):
+        lat, lon = CITY_COORDINATES[rng.choice(list(CITY_COORDINATES))]
+        capacity = rng.choice([2500, 8000, 15000, 18000])
+        vehicle_rows.append({
+            "vehicle_id": i,
+            "type": "Truck",
+            "capacity_kg": capacity,
+            "status": "Active" if rng.random() < 0.85 else "Maintenance",
+            "fuel_level": round(rng.uniform(5, 100), 1),
+            "current_load_kg": round(rng.uniform(0, capacity), 1),
+            "gps_coordinates": format_gps(lat + rng.uniform(-2, 2), lon + rng.uniform(-2, 2)),
+        })
+    return shipment_rows, vehicle_rows
+
+
+def _haversine(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(1.0, a)))
+
+
+def naive_plan(shipments, vehicles):
+    """The same greedy assignment in plain Python: every shipment scans every vehicle."""
+    ids, lat, lon, fuel, remaining, active = (a.tolist() for a in vehicle_arrays(vehicles))
+    order = sorted(range(len(shipments)), key=lambda s: (
+        PRIORITY_RANK.get(shipments[s]["priority"], len(PRIORITY_RANK)),
+        shipments[s]["status"] != "Delayed",
+        -shipments[s]["weight_kg"],
+        s,
+    ))
+    assignments = []
+    for s in order:
+        origin = city_coordinates(shipments[s]["origin"])
+        best, best_km = None, math.inf
+        for v in range(len(vehicles)):
+            if not active[v] or not fuel[v] >= DISPATCH_MIN_FUEL or math.isnan(lat[v]) or origin is None:
+                continue
+            km = _haversine(origin[0], origin[1], lat[v], lon[v])
+            if km <= fuel[v] / 100 * DISPATCH_RANGE_KM and remaining[v] >= shipments[s]["weight_kg"] and km < best_km:
+                best, best_km = v, km
+        if best is not None:
+            remaining[best] -= shipments[s]["weight_kg"]
+            assignments.append((shipments[s]["id"], int(ids[best])))
+    return assignments
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        samples.append((time.perf_counter() - started) * 1000)
+    return result, statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", type=int, default=[100, 500, 1000, 2000, 5000, 10000],
+                        help="Shipments and vehicles per run (same count for both)")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per size (median reported)")
+    parser.add_argument("--naive-up-to", type=int, default=1000, help="Largest size the plain-Python version runs at")
+    parser.add_argument("--live", action="store_true", help="Overlay positions/fuel/load from a FleetState")
+    args = parser.parse_args()
+
+    print(f"{'size':>7} {'solve ms':>9} {'assigned':>9} {'vehicles':>9} {'naive ms':>9} {'speedup':>8}  same plan")
+    for size in args.sizes:
+        shipments, vehicles = generate(size, size)
+        fleet_state = None
+        if args.live:
+            fleet_state = FleetState()
+            fleet_state.ingest([{"vehicle_id": v["vehicle_id"], "gps_coordinates": v["gps_coordinates"],
+                                 "fuel_level": v["fuel_level"], "current_load_kg": v["current_load_kg"]}
+                                for v in vehicles])
+        plan, solve_ms = timed(lambda: plan_dispatch(shipments, vehicles, fleet_state), args.repeat)
+        naive_ms, speedup, same = "-", "-", "-"
+        if size <= args.naive_up_to:
+            expected, naive = timed(lambda: naive_plan(shipments, vehicles), 1)
+            same = "yes" if expected == [(a["shipment_id"], a["vehicle_id"]) for a in plan["assignments"]] else "NO"
+            naive_ms, speedup = f"{naive:.1f}", f"{naive / solve_ms:.0f}x"
+        print(f"{size:>7} {solve_ms:>9.1f} {len(plan['assignments']):>9} {plan['vehicles_used']:>9} "
+              f"{naive_ms:>9} {speedup:>8}  {same}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+"""Shared test fixtures; puts backend/ and the repository root on sys.path (as tests/benchmark.py does)."""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+# Tests construct their own agents; never start the background pre-warm
+os.environ.setdefault("PREWARM_ON_START", "false")
+
+
+@pytest.fixture(scope="session")
+def local_db(tmp_path_factory):
+    """SQLite copy of sales_data.db (built from the seed data if it is missing), as the benchmark uses."""
+    from benchmark import DEFAULT_SQLITE, prepare_database
+    return prepare_database(DEFAULT_SQLITE, str(tmp_path_factory.mktemp("warehouse")))
+
+
+@pytest.fixture
+def local_agent(local_db):
+    """Agent over the SQLite copy with the benchmark's fake chat model: no Vertex AI or BigQuery."""
+    import agents
+    from benchmark import FakeChatModel
+    return agents.MultiAgentLogisticsSystem(llm=FakeChatModel(latency_ms=0, output_tokens=10),
+                                            db_uri=f"sqlite:///{local_db}")
@@ -0,0 +1,88 @@
+"""Every route in backend/openapi.yaml must be served by both the deployed handler (main.py) and api.py."""
+import json
+import os
+
+import pytest
+import yaml
+from fastapi.testclient import TestClient
+from flask import Flask, request
+
+import api
+import cache
+import fleet_state
+import main
+
+SPEC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend", "openapi.yaml")
+BODIES = {
+    "/query": {"query": "Show me all delayed shipments"},
+    "/query/stream": {"query": "Show me all delayed shipments"},
+    "/query/batch": {"queries": [{"query": "Show me all delayed shipments"}]},
+    "/telemetry": {"pings": []},
+}
+HEADERS = {"X-API-Key": "test-key"}
+
+
+def _operations():
+    with open(SPEC) as f:
+        paths = yaml.safe_load(f)["paths"]
+    return [(path, method) for path, ops in paths.items() for method in ops]
+
+
+@pytest.fixture
+def installed_agent(local_agent, monkeypatch):
+    def no_samples():
+        raise RuntimeError("no BigQuery in tests")
+    monkeypatch.setattr(main, "agent", local_agent)
+    monkeypatch.setattr(api, "agent", local_agent)
+    monkeypatch.setattr(main.sample_cache, "get", no_samples)
+    monkeypatch.setattr(api.sample_cache, "get", no_samples)
+    monkeypatch.setattr(fleet_state, "TELEMETRY_API_KEY", "test-key")
+    return local_agent
+
+
+@pytest.mark.parametrize("path, method", _operations())
+def test_functions_framework_handler_serves_the_documented_route(installed_agent, path, method):
+    app = Flask("contract")
+    app.add_url_rule("/<path:path>", "process_query", lambda path: main.process_query(request),
+                     methods=["GET", "POST", "OPTIONS"])
+    response = app.test_client().open(path, method=method.upper(), json=BODIES.get(path), headers=HEADERS)
+    assert response.status_code < 400 or path == "/sample"  # /sample reads BigQuery
+
+
+@pytest.mark.parametrize("path, method", _operations())
+def test_fastapi_service_serves_the_documented_route(installed_agent, path, method):
+    with TestClient(api.app, raise_server_exceptions=False) as client:
+        response = client.request(method.upper(), path, json=BODIES.get(path), headers=HEADERS)
+    assert response.status_code < 400 or path == "/sample"
+
+
+def test_fastapi_stream_runs_the_analyst_under_the_sql_guard(installed_agent, monkeypatch):
+    import warehouse
+    current_guard, seen = warehouse.current_guard, []
+
+    def recording_guard():
+        seen.append(current_guard())
+        return seen[-1]
+    monkeypatch.setattr(warehouse, "current_guard", recording_guard)
+    query = {"query": "Which delayed shipments carry insured cargo and who are the customers?",
+             "role": "Logistics Manager"}
+    with TestClient(api.app) as client:
+        response = client.post("/query/stream", json=query)
+    events = [json.loads(line) for line in response.text.splitlines()]
+    assert events[-1]["event"] == "done", events[-1]
+    assert seen and all(guard is not None and guard[1] == "Logistics Manager" for guard in seen)
+
+
+@pytest.mark.parametrize("key, headers, status", [
+    ("", HEADERS, 503),
+    ("test-key", {}, 401),
+    ("test-key", {"X-API-Key": "wrong"}, 401),
+    ("test-key", HEADERS, 200),
+])
+def test_cache_invalidation_requires_the_admin_key(installed_agent, monkeypatch, key, headers, status):
+    monkeypatch.setattr(cache, "CACHE_ADMIN_API_KEY", key)
+    app = Flask("contract")
+    app.add_url_rule("/<path:path>", "process_query", lambda path: main.process_query(request), methods=["POST"])
+    assert app.test_client().post("/cache/invalidate", headers=headers).status_code == status
+    with TestClient(api.app, raise_server_exceptions=False) as client:
+        assert client.post("/cache/invalidate", headers=headers).status_code == status
@@ -0,0 +1,133 @@
+import threading
+import time
+
+from sqlalchemy import create_engine, text
+
+from cache import DataVersionTracker, ResponseCache, SQLResultCache, SingleFlight, normalize_query
+from warehouse import CachedSQLDatabase
+
+
+def test_normalize_query_keeps_decimals_and_drops_punctuation():
+    assert normalize_query("  Show me ALL delayed shipments?! ") == "show me all delayed shipments"
+    assert normalize_query("Fuel below 12.5%.") == "fuel below 12.5%"
+
+
+def test_response_cache_key_ignores_case_and_punctuation():
+    assert ResponseCache.make_key("Delayed shipments?", "Guest") == ResponseCache.make_key("delayed shipments", "Guest")
+    assert ResponseCache.make_key("delayed shipments", "Guest") != ResponseCache.make_key("delayed shipments", "Admin")
+
+
+def test_response_cache_is_invalidated_by_a_new_data_version():
+    cache = ResponseCache()
+    cache.set("k", "answer", data_version="v1")
+    assert cache.get("k", data_version="v1") == "answer"
+    assert cache.get("k", data_version="v2") is None
+    assert cache.stats()["invalidations"] == 1
+
+
+def test_response_cache_expires_and_evicts_least_recently_used():
+    cache = ResponseCache(max_entries=2, ttl_seconds=0.05)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    time.sleep(0.06)
+    assert cache.get("a") is None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_response_cache_invalidate_drops_everything():
+    cache = ResponseCache()
+    cache.set("a", 1)
+    cache.invalidate()
+    assert cache.get("a") is None
+
+
+def test_version_tracker_polls_at_most_once_per_interval_and_keeps_last_versions_on_error():
+    calls = []
+
+    def fetch():
+        calls.append(1)
+        if len(calls) > 1:
+            raise RuntimeError("warehouse unreachable")
+        return {"shipments": "1"}
+
+    tracker = DataVersionTracker(fetch, check_interval=3600)
+    token = tracker.version_token()
+    assert tracker.version_token() == token
+    assert len(calls) == 1
+    assert tracker.versions(force=True) == {"shipments": "1"}
+    assert tracker.version_token(["shipments"]) != tracker.version_token(["drivers"])
+
+
+def test_sql_result_cache_evicts_by_bytes_and_skips_oversized_results():
+    cache = SQLResultCache(max_bytes=200)
+    for key in "abcd":
+        cache.set(key, [key * 40])  # 44 bytes each
+    cache.get("a")
+    cache.set("e", ["e" * 40])
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.stats()["bytes"] <= 200
+    cache.set("huge", ["h" * 60])  # over a quarter of the budget
+    assert cache.get("huge") is None
+    cache.clear()
+    assert cache.stats()["entries"] == 0
+
+
+def test_cached_rows_are_invalidated_when_the_table_version_changes(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'fleet.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE vehicles (vehicle_id INTEGER, fuel_level REAL)"))
+        conn.execute(text("INSERT INTO vehicles VALUES (1, 50)"))
+    versions = {"vehicles": "1"}
+    db = CachedSQLDatabase(engine, result_cache=SQLResultCache(),
+                           table_versions=DataVersionTracker(lambda: versions, check_interval=0))
+    sql = "SELECT fuel_level FROM vehicles WHERE vehicle_id = 1"
+    assert db.fetch_rows(sql) == [{"fuel_level": 50.0}]
+
+    with engine.begin() as conn:
+        conn.execute(text("UPDATE vehicles SET fuel_level = 10"))
+    assert db.fetch_rows(sql) == [{"fuel_level": 50.0}]  # same version: served from the cache
+    versions["vehicles"] = "2"
+    assert db.fetch_rows(sql) == [{"fuel_level": 10.0}]
+
+
+def test_single_flight_coalesces_concurrent_calls_and_propagates_errors():
+    flight = SingleFlight("test")
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def slow_failure():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        raise ValueError("warehouse timeout")
+
+    errors = []
+
+    def call():
+        try:
+            flight.do("q", slow_failure)
+        except ValueError as e:
+            errors.append(str(e))
+
+    leader = threading.Thread(target=call)
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=call) for _ in range(3)]
+    for t in followers:
+        t.start()
+    while flight.stats()["coalesced"] < 3:
+        time.sleep(0.001)
+    release.set()
+    for t in [leader] + followers:
+        t.join(5)
+
+    assert len(calls) == 1
+    assert errors == ["warehouse timeout"] * 4
+    assert flight.stats() == {"executed": 1, "coalesced": 3, "in_flight": 0}
+    # Nothing is remembered once the call ends, failures included
+    assert flight.do("q", lambda: "ok") == ("ok", False)
@@ -0,0 +1,86 @@
+import pytest
+
+from dispatch import DISPATCH_PATTERN, plan_dispatch
+from fleet_state import FleetState
+from geo import CITY_COORDINATES, format_gps
+
+LONDON = format_gps(*CITY_COORDINATES["london"])
+PARIS = format_gps(*CITY_COORDINATES["paris"])
+
+
+@pytest.mark.parametrize("query", [
+    "Assign the pending and delayed shipments to vehicles",
+    "Please dispatch the delayed orders",
+    "Can you allocate trucks to the waiting loads?",
+    "Plan the dispatch for today",
+    "Which truck should take shipment 12?",
+])
+def test_dispatch_requests_match(query):
+    assert DISPATCH_PATTERN.search(query)
+
+
+@pytest.mark.parametrize("query", [
+    "Which shipments are assigned to vehicle 5?",
+    "Which vehicle is assigned to shipment 12?",
+    "Show the driver assigned to truck 7",
+    "How many orders were dispatched to trucks last week?",
+    "Dispatched shipments by origin",
+    "List the assignments of vehicle 3",
+])
+def test_assignment_lookups_do_not_match(query):
+    assert not DISPATCH_PATTERN.search(query)
+
+
+def _shipment(id, weight, origin="London", priority="Standard", status="Pending"):
+    return {"id": id, "origin": origin, "destination": "Paris", "status": status, "priority": priority,
+            "weight_kg": weight}
+
+
+def _vehicle(vehicle_id, gps=LONDON, capacity=1000, load=0, fuel=80, status="Active"):
+    return {"vehicle_id": vehicle_id, "type": "Truck", "capacity_kg": capacity, "status": status,
+            "fuel_level": fuel, "current_load_kg": load, "gps_coordinates": gps}
+
+
+def _assigned(plan):
+    return {a["shipment_id"]: a["vehicle_id"] for a in plan["assignments"]}
+
+
+def test_spare_capacity_is_used_up_across_shipments():
+    shipments = [_shipment(1, 600), _shipment(2, 300), _shipment(3, 200)]
+    plan = plan_dispatch(shipments, [_vehicle(1, capacity=1000, load=100)])
+    # Heavier first: 600 + 300 fill the 900 kg spare, the 200 kg shipment no longer fits
+    assert _assigned(plan) == {1: 1, 2: 1}
+    assert plan["unassigned"] == [{"shipment_id": 3, "origin": "London",
+                                   "reason": "no vehicle in range with enough spare capacity"}]
+
+
+def test_priority_goes_first_and_takes_the_nearest_vehicle():
+    shipments = [_shipment(1, 500), _shipment(2, 500, priority="Urgent")]
+    vehicles = [_vehicle(1, gps=PARIS, capacity=500), _vehicle(2, capacity=500)]
+    plan = plan_dispatch(shipments, vehicles)
+    assert _assigned(plan) == {2: 2, 1: 1}
+    assert plan["assignments"][0]["distance_km"] == 0.0
+
+
+def test_fuel_floor_range_and_status():
+    vehicles = [
+        _vehicle(1, fuel=10),  # below DISPATCH_MIN_FUEL
+        _vehicle(2, status="Maintenance"),
+        _vehicle(3, gps=PARIS, fuel=30),  # ~340 km away, 30% of 1000 km reach
+    ]
+    plan = plan_dispatch([_shipment(1, 100)], vehicles, min_fuel=20, range_km=1000)
+    assert plan["vehicles_available"] == 1
+    assert plan["unassigned"][0]["reason"] == "no available vehicle within fuel range"
+    assert _assigned(plan_dispatch([_shipment(1, 100)], vehicles, min_fuel=20, range_km=1200)) == {1: 3}
+
+
+def test_unknown_origin_is_reported():
+    plan = plan_dispatch([_shipment(1, 100, origin="Wrightview")], [_vehicle(1)])
+    assert plan["unassigned"][0]["reason"] == "unknown origin 'Wrightview'"
+
+
+def test_live_telemetry_overrides_the_table():
+    live = FleetState()
+    live.ingest([{"vehicle_id": 1, "gps_coordinates": LONDON, "fuel_level": 5, "current_load_kg": 0}])
+    plan = plan_dispatch([_shipment(1, 100)], [_vehicle(1), _vehicle(2, gps=PARIS)], live)
+    assert _assigned(plan) == {1: 2}
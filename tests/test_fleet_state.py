@@ -0,0 +1,103 @@
+import json
+
+import pytest
+from flask import Flask, request
+
+import fleet_state
+import main
+from fleet_state import FleetState, authorize, parse_payload
+
+NOW = 1_760_000_000.0
+
+
+def _ping(vehicle_id, ts, **fields):
+    return dict({"vehicle_id": vehicle_id, "ts": ts}, **fields)
+
+
+def test_newest_timestamp_wins_per_field_within_and_across_batches():
+    state = FleetState()
+    result = state.ingest([
+        _ping(1, NOW - 10, lat=51.5, lon=-0.1, fuel_level=50),
+        _ping(1, NOW - 5, fuel_level=40),
+        _ping(1, NOW - 8, lat=48.8, lon=2.3, fuel_level=45),  # older than the fuel above, newer position
+    ], now=NOW)
+    assert result == {"accepted": 3, "rejected": 0, "stale": 0}
+    row = state.snapshot(now=NOW)[0]
+    assert (row["lat"], row["lon"], row["fuel_level"]) == (48.8, 2.3, 40.0)
+
+    assert state.ingest([_ping(1, NOW - 6, fuel_level=99)], now=NOW) == {"accepted": 0, "rejected": 0, "stale": 1}
+    assert state.snapshot(now=NOW)[0]["fuel_level"] == 40.0
+    assert state.within(48.8, 2.3, 10) == [(1, pytest.approx(0.0, abs=0.01))]
+
+
+def test_future_and_millisecond_timestamps_cannot_make_later_pings_stale():
+    state = FleetState()
+    state.ingest([_ping(1, NOW + 86400, fuel_level=10), _ping(2, NOW * 1000, fuel_level=10)], now=NOW)
+    later = NOW + fleet_state.TELEMETRY_MAX_SKEW_SECONDS + 1
+    assert state.ingest([_ping(1, later, fuel_level=20), _ping(2, later, fuel_level=20)], now=later)["accepted"] == 2
+    assert [r["fuel_level"] for r in state.snapshot(now=later)] == [20.0, 20.0]
+
+
+@pytest.mark.parametrize("ping", [
+    {"ts": NOW, "fuel_level": 10},  # no vehicle_id
+    _ping(1, NOW),  # nothing to apply
+    _ping(1, NOW, lat=95, lon=0),
+    _ping(1, NOW, lat=50),
+    _ping(1, NOW, fuel_level=120),
+    _ping(1, "nan", fuel_level=10),
+])
+def test_invalid_pings_are_rejected(ping):
+    assert FleetState().ingest([ping], now=NOW)["rejected"] == 1
+
+
+def test_once_seeded_only_known_vehicles_are_accepted():
+    state = FleetState()
+    state.seed([{"vehicle_id": 1, "gps_coordinates": "51.5074 N, 0.1278 W", "fuel_level": 70, "current_load_kg": 0}])
+    result = state.ingest([_ping(1, NOW, fuel_level=60), _ping(999, NOW, fuel_level=60)], now=NOW)
+    assert (result["accepted"], result["rejected"]) == (1, 1)
+    assert [r["vehicle_id"] for r in state.snapshot()] == [1]
+
+
+def test_failed_flush_keeps_vehicles_dirty():
+    state = FleetState()
+    state.ingest([_ping(1, NOW, fuel_level=60)], now=NOW)
+
+    def failing(rows):
+        raise RuntimeError("warehouse unavailable")
+    with pytest.raises(RuntimeError):
+        state.flush(failing)
+    flushed = []
+    assert state.flush(flushed.extend) == 1
+    assert flushed[0]["vehicle_id"] == 1 and state.flush(flushed.extend) == 0
+
+
+def test_payload_formats():
+    assert parse_payload(b'{"pings": [{"vehicle_id": 1}]}') == ([{"vehicle_id": 1}], 0)
+    assert parse_payload(b'{"vehicle_id": 1}\nnot json\n{"vehicle_id": 2}', "application/x-ndjson") == (
+        [{"vehicle_id": 1}, {"vehicle_id": 2}], 1)
+
+
+def test_api_key(monkeypatch):
+    monkeypatch.setattr(fleet_state, "TELEMETRY_API_KEY", "")
+    assert authorize("anything")[0] == 503
+    monkeypatch.setattr(fleet_state, "TELEMETRY_API_KEY", "secret")
+    assert authorize(None)[0] == 401
+    assert authorize("wrong")[0] == 401
+    assert authorize("secret") is None
+
+
+def test_telemetry_route_seeds_the_fleet_and_starts_the_flusher_without_warmup(local_agent, monkeypatch):
+    monkeypatch.setattr(fleet_state, "TELEMETRY_API_KEY", "secret")
+    monkeypatch.setattr(main, "agent", local_agent)
+    local_agent.fleet_state = FleetState()
+    app = Flask("telemetry")
+    app.add_url_rule("/<path:path>", "process_query", lambda path: main.process_query(request), methods=["POST"])
+    client = app.test_client()
+
+    body = {"pings": [_ping(1, None, fuel_level=55), _ping(10 ** 9, None, fuel_level=55)]}
+    assert client.post("/telemetry", json=body).status_code == 401
+    response = client.post("/telemetry", json=body, headers={"X-API-Key": "secret"})
+    assert response.status_code == 200
+    result = json.loads(response.data)
+    assert (result["accepted"], result["rejected"]) == (1, 1)
+    assert "flush" in local_agent.fleet_state._threads
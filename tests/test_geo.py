@@ -0,0 +1,83 @@
+import pytest
+
+from geo import GridIndex, haversine_km
+from nearby import EXTRA_FILTERS, GEO_NEAR_RADIUS_KM, parse_proximity
+
+
+def _index(points):
+    """Grid with the given points over a 5° background, so lookups visit cells instead of scanning every key."""
+    index = GridIndex(cell_degrees=1)
+    for lat in range(-85, 90, 5):
+        for lon in range(-180, 180, 5):
+            index.update(f"bg {lat},{lon}", lat + 0.5, lon + 0.5)
+    for key, (lat, lon) in points.items():
+        index.update(key, lat, lon)
+    return index
+
+
+def _only(found):
+    return [key for key, _ in found if not key.startswith("bg ")]
+
+
+def test_within_crosses_the_antimeridian():
+    index = _index({"east": (10.0, 179.9), "west": (10.0, -179.9), "far": (10.0, 170.0)})
+    found = index.within(10.0, 179.95, 50)
+    assert _only(found) == ["east", "west"]
+    assert found[0][1] == pytest.approx(float(haversine_km(10.0, 179.95, 10.0, 179.9)))
+    assert _only(index.within(10.0, -179.95, 50)) == ["west", "east"]
+
+
+def test_nearest_crosses_the_antimeridian():
+    index = _index({"east": (-20.0, 179.5), "west": (-20.0, -179.8)})
+    assert _only(index.nearest(-20.0, -179.9, k=200))[:2] == ["west", "east"]
+
+
+@pytest.mark.parametrize("pole", [89.95, -89.95])
+def test_within_near_the_poles_spans_all_longitudes(pole):
+    sign = 1 if pole > 0 else -1
+    index = _index({"a": (sign * 89.9, 0.0), "b": (sign * 89.9, 179.0), "c": (sign * 89.9, -91.0)})
+    found = index.within(pole, 45.0, 30)
+    assert sorted(_only(found)) == ["a", "b", "c"]
+    assert all(km <= 30 for _, km in found)
+
+
+def test_moves_and_removals_leave_the_old_cell():
+    index = _index({"v": (51.5, -0.1)})
+    index.update("v", 48.85, 2.35)
+    assert _only(index.within(51.5, -0.1, 50)) == []
+    assert _only(index.within(48.85, 2.35, 1)) == ["v"]
+    index.update("v", float("nan"), float("nan"))
+    assert "v" not in _only(index.nearest(48.85, 2.35, k=len(index)))
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("Which vehicles are near London?", {"kind": "vehicles", "place": "London", "radius_km": GEO_NEAR_RADIUS_KM}),
+    ("trucks within 100 km of Paris", {"kind": "vehicles", "place": "Paris", "radius_km": 100.0}),
+    ("closest available driver to Berlin", {"kind": "drivers", "place": "Berlin", "k": 1, "available": True}),
+    ("the 5 nearest vans to Madrid", {"kind": "vehicles", "place": "Madrid", "k": 5}),
+])
+def test_parse_proximity(query, expected):
+    request = parse_proximity(query)
+    assert request is not None and not EXTRA_FILTERS.search(query)
+    assert {key: request[key] for key in expected} == expected
+
+
+@pytest.mark.parametrize("query", [
+    "Show vehicles in Berlin",
+    "Drivers at Paris",
+    "Which vehicles are waiting in London?",
+])
+def test_in_or_at_a_city_is_not_a_proximity_lookup(query):
+    assert parse_proximity(query) is None
+
+
+@pytest.mark.parametrize("query", [
+    "Show vehicles near Berlin that are in maintenance",
+    "How many vehicles are in service near Paris?",
+    "Count the trucks near London",
+    "Trucks near Paris with fuel below 20%",
+    "Which idle trucks are near Rome?",
+    "Drivers near Madrid who are off duty",
+])
+def test_conditions_are_left_to_the_analyst(query):
+    assert EXTRA_FILTERS.search(query)
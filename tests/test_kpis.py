@@ -0,0 +1,51 @@
+import pytest
+
+from kpis import KPIStore
+from update_bigquery_data import build_datasets
+
+
+@pytest.fixture(scope="module")
+def store():
+    store = KPIStore()
+    store.refresh(build_datasets(), {"shipments": "1", "drivers": "1", "vehicles": "1"})
+    return store
+
+
+@pytest.mark.parametrize("query, name", [
+    ("What is the profit margin by customer?", "margin_by_customer"),
+    ("Which customers are most profitable?", "margin_by_customer"),
+    ("Show the profit margin for each cargo type", "margin_by_cargo_type"),
+    ("What is the fleet utilization?", "fleet_utilization"),
+    ("What is the utilization of the fleet?", "fleet_utilization"),
+    ("Show utilization by vehicle type", "utilization_by_type"),
+    ("Show delay rates", "delays_by_origin"),
+    ("Show delayed shipments by origin city", "delays_by_origin"),
+    ("Show the distribution of driver ratings", "driver_rating_distribution"),
+])
+def test_unfiltered_questions_are_answered_from_the_aggregates(store, query, name):
+    assert store.match(query, "Logistics Manager").name == name
+
+
+@pytest.mark.parametrize("query", [
+    "What is the profit margin by customer for delayed shipments?",
+    "What is the profit margin for delayed shipments by customer?",
+    "What was the fleet utilization last week?",
+    "Show delay rates for shipments to Paris",
+    "Which customers are most profitable in electronics?",
+    "What is the fleet utilization of trucks in maintenance?",
+    "Show the distribution of driver ratings in 2024",
+])
+def test_filtered_questions_go_to_the_analyst(store, query):
+    assert store.match(query, "Logistics Manager") is None
+
+
+def test_financial_kpis_are_not_served_to_guests(store):
+    assert store.match("What is the profit margin by customer?", "Guest") is None
+    assert store.match("What is the fleet utilization?", "Guest").name == "fleet_utilization"
+
+
+def test_refresh_recomputes_only_changed_sources(store):
+    frames = build_datasets()
+    assert store.refresh(frames, {"shipments": "1", "drivers": "1", "vehicles": "1"}) == []
+    changed = store.refresh(frames, {"shipments": "1", "drivers": "2", "vehicles": "1"})
+    assert changed == ["driver_rating_distribution"]
@@ -0,0 +1,68 @@
+from types import SimpleNamespace
+
+import pytest
+
+from agents import MultiAgentLogisticsSystem
+from query_templates import TemplateRegistry
+
+
+@pytest.fixture
+def registry():
+    return TemplateRegistry()
+
+
+@pytest.mark.parametrize("query, name, params", [
+    ("Show me all delayed shipments", "delayed_shipments", {}),
+    ("delayed shipments in london", "delayed_shipments_by_city", {"city": "London"}),
+    ("shipments from New York that are delayed", "delayed_shipments_by_city", {"city": "New York"}),
+    ("Which drivers are in Berlin?", "drivers_in_city", {"city": "Berlin"}),
+    ("vehicles with fuel below 30%", "low_fuel_vehicles", {"threshold": 30.0, "active": False}),
+    ("status of shipment #42", "shipment_status", {"shipment_id": 42}),
+])
+def test_slots_are_extracted(registry, query, name, params):
+    template, bound = registry.match(query)
+    assert template.name == name
+    assert bound == params
+
+
+@pytest.mark.parametrize("query", [
+    "delayed shipments from London to Paris",
+    "drivers in Berlin who are available",
+    "show delayed shipments in london with high priority",
+    "drivers in Atlantis",
+])
+def test_trailing_qualifiers_are_not_read_as_a_city(registry, query):
+    assert registry.match(query) is None
+
+
+def _run_template(rows, query):
+    system = SimpleNamespace(templates=TemplateRegistry(), db=SimpleNamespace(fetch_rows=lambda sql, parameters: rows))
+    return MultiAgentLogisticsSystem._run_template(system, query)
+
+
+def test_city_template_without_rows_falls_back_to_the_analyst():
+    assert _run_template([], "Which drivers are in Tokyo?") is None
+
+
+def test_delayed_summary_reports_the_total_not_the_page():
+    row = {"id": 1, "origin": "London", "destination": "Paris", "status": "Delayed", "priority": "High",
+           "cargo_type": "Food", "weight_kg": 10, "total_delayed": 120}
+    facts, _, intent, _ = _run_template([row] * 50, "Show me all delayed shipments")
+    assert intent == "delayed_shipments"
+    assert facts.startswith("Found 120 delayed shipments (showing the first 50):")
+
+
+def test_every_template_answer_gets_rule_based_followups():
+    from followups import DEFAULT_RULES, FollowupEngine
+    for template in TemplateRegistry().templates:
+        assert any(template.name in rule.intents for rule in DEFAULT_RULES), template.name
+    suggestions = FollowupEngine().suggest("Show delayed shipments in Tokyo", role="Logistics Manager",
+                                           intent="delayed_shipments_by_city")
+    assert "Which drivers are in Tokyo?" in suggestions
+
+
+def test_city_list_follows_the_geocoded_cities():
+    from followups import KNOWN_CITIES
+    from geo import CITY_COORDINATES
+    assert {c.lower() for c in KNOWN_CITIES} >= set(CITY_COORDINATES)
+    assert TemplateRegistry().match("Which drivers are in Hong Kong?")[1] == {"city": "Hong Kong"}
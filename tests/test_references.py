@@ -0,0 +1,80 @@
+import pytest
+
+from references import Reference, answer_from_rows, resolve_reference, result_keys, visible_columns
+
+TURNS = [
+    {"query": "Show me all delayed shipments", "keys": {"shipments": [3, 7]}},
+    {"query": "Show vehicles with fuel below 30%", "keys": {"vehicles": [12]}},
+]
+
+
+@pytest.mark.parametrize("query, table, ids", [
+    ("What is the total weight of those shipments?", "shipments", [3, 7]),
+    ("Which of these delayed shipments are insured?", "shipments", [3, 7]),
+    ("Where is that truck now?", "vehicles", [12]),
+    ("Show the fuel level for all of those vehicles", "vehicles", [12]),
+])
+def test_determiner_before_a_table_noun_resolves_to_that_table(query, table, ids):
+    reference = resolve_reference(query, TURNS)
+    assert (reference.table, reference.ids) == (table, ids)
+
+
+@pytest.mark.parametrize("query", [
+    "Show all vehicles and their capacity",
+    "Show all of the vehicles",
+    "Is it raining in London?",
+    "What is the total revenue of them?",
+    "Which drivers have the same rating?",
+    "Show those drivers",  # no earlier turn returned drivers
+    "Compare shipment 4 with those shipments",  # explicit IDs
+])
+def test_bare_pronouns_and_whole_table_questions_are_not_references(query):
+    assert resolve_reference(query, TURNS) is None
+
+
+def test_result_keys_attribute_id_to_the_first_from_table():
+    rows = [{"id": 1, "vehicle_id": 5}, {"id": 2, "vehicle_id": 5}]
+    assert result_keys("SELECT s.id, v.vehicle_id FROM shipments s JOIN vehicles v ON 1=1", rows) == {
+        "shipments": [1, 2], "vehicles": [5]}
+
+
+def test_guests_see_no_financial_columns_and_get_no_financial_answers():
+    columns = ["id", "origin", "cost", "revenue", "weight_kg"]
+    assert visible_columns(columns, "Guest") == ["id", "origin", "weight_kg"]
+    assert visible_columns(columns, "Logistics Manager") == columns
+    reference = Reference("shipments", [3, 7], "Show me all delayed shipments")
+    assert reference.sql(["id", "weight_kg"]) == "SELECT id, weight_kg FROM shipments WHERE id IN (3, 7) ORDER BY id"
+    rows = [{"id": 3, "weight_kg": 100.0}, {"id": 7, "weight_kg": 50.0}]
+    assert "Access Denied" in answer_from_rows("total revenue of those shipments", reference, rows, "Guest")
+    assert "Total weight kg: 150.00" in answer_from_rows("total weight of those shipments", reference, rows, "Guest")
+
+
+def test_reference_lookup_respects_the_role(local_agent):
+    local_agent.run("Show me all delayed shipments", role="Guest", session_id="guest")
+    guest = local_agent.run("What is the total revenue of those shipments?", role="Guest", session_id="guest")
+    assert "Access Denied" in guest["summary"]
+
+    local_agent.run("Show me all delayed shipments", role="Logistics Manager", session_id="manager")
+    reference = local_agent._resolve_reference("What is the total revenue of those shipments?", "manager")
+    facts, sql, _, rows = local_agent._run_reference("What is the total revenue of those shipments?", reference,
+                                                     "Logistics Manager")
+    assert "Total revenue:" in facts
+    guest_sql = local_agent._run_reference("What is the total weight of those shipments?", reference, "Guest")[1]
+    assert "revenue" in sql and "revenue" not in guest_sql and "cost" not in guest_sql
+
+
+@pytest.mark.parametrize("query", [
+    "How many of those shipments are delayed?",
+    "How many of these shipments are going to Paris?",
+    "How many of those shipments are high priority?",
+    "What is the total weight of those shipments above 500 kg?",
+])
+def test_filtered_questions_go_to_the_analyst(query):
+    reference = Reference("shipments", [1, 2, 3], "Show me all shipments")
+    rows = [{"id": 1, "status": "Delayed", "priority": "High", "destination": "Paris", "weight_kg": 600.0},
+            {"id": 2, "status": "Pending", "priority": "Standard", "destination": "Berlin", "weight_kg": 400.0},
+            {"id": 3, "status": "Delayed", "priority": "Urgent", "destination": "Paris", "weight_kg": 800.0}]
+    assert answer_from_rows(query, reference, rows, "Logistics Manager") is None
+    # The earlier turn's filter inside the reference phrase is not a new condition
+    assert answer_from_rows("How many of those delayed shipments are there?", reference, rows,
+                            "Logistics Manager").startswith("There are 3 shipments")
@@ -0,0 +1,22 @@
+import pytest
+
+from sessions import compact_history, estimate_tokens
+
+TURNS = [
+    {"query": f"What is the status of shipment {i}?", "summary": f"Shipment {i} is in transit to Paris. " * 5}
+    for i in range(1, 6)
+]
+
+
+@pytest.mark.parametrize("recent, verbatim", [(0, []), (2, [4, 5]), (10, [1, 2, 3, 4, 5])])
+def test_recent_turns_are_kept_verbatim_and_older_ones_as_questions(recent, verbatim):
+    history = compact_history(TURNS, budget=2000, recent=recent)
+    assert [i for i in range(1, 6) if f"USER: What is the status of shipment {i}?" in history] == verbatim
+    earlier = [i for i in range(1, 6) if f"- What is the status of shipment {i}?" in history]
+    assert earlier == [i for i in range(1, 6) if i not in verbatim]
+
+
+def test_entities_survive_compaction_within_the_budget():
+    history = compact_history(TURNS, budget=40, recent=0)
+    assert estimate_tokens(history) <= 40
+    assert "shipments 5, 4, 3, 2, 1" in history and "Paris" in history
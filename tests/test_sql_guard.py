@@ -0,0 +1,106 @@
+import ast
+
+import pytest
+from sqlalchemy import create_engine, text
+
+from cache import SQLResultCache
+from sql_guard import QueryRejected, SQLGuard
+from warehouse import CachedSQLDatabase, canonicalize_sql
+
+LIMITS = {"Guest": {"max_bytes": 1000, "max_rows": 20}, "Admin": {"max_bytes": 10 ** 9, "max_rows": 1000}}
+
+
+@pytest.fixture
+def guard():
+    return SQLGuard(LIMITS, auto_limit=100)
+
+
+def _rewrite(guard, sql, role="Guest"):
+    return guard.rewrite(sql, canonicalize_sql(sql), role)
+
+
+def test_exploratory_select_gets_the_role_capped_limit(guard):
+    assert _rewrite(guard, "SELECT * FROM shipments;") == ("SELECT * FROM shipments\nLIMIT 20", 20)
+    assert _rewrite(guard, "SELECT * FROM shipments", "Admin") == ("SELECT * FROM shipments\nLIMIT 100", 100)
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT id FROM shipments LIMIT 5",
+    "SELECT COUNT(*) FROM shipments",
+    "SELECT AVG(fuel_level) FROM vehicles WHERE status = 'Active'",
+])
+def test_limited_and_single_row_aggregates_are_left_alone(guard, sql):
+    assert _rewrite(guard, sql) == (sql, None)
+
+
+def test_grouped_aggregates_are_exploratory(guard):
+    assert _rewrite(guard, "SELECT status, COUNT(*) FROM shipments GROUP BY status")[1] == 20
+
+
+@pytest.mark.parametrize("sql, reason", [
+    ("SELECT id FROM shipments LIMIT 500", "rows"),
+    ("SELECT * FROM shipments CROSS JOIN drivers", "cross_join"),
+    ("SELECT * FROM shipments s, drivers d", "cross_join"),
+])
+def test_rejections(guard, sql, reason):
+    with pytest.raises(QueryRejected) as e:
+        _rewrite(guard, sql)
+    assert e.value.reason == reason
+
+
+def test_comma_join_with_a_condition_is_allowed(guard):
+    assert _rewrite(guard, "SELECT * FROM shipments s, drivers d WHERE s.id = d.id LIMIT 5")[1] is None
+
+
+def test_byte_limit_per_role(guard):
+    guard.check_bytes(10 ** 6, "Admin", "test")
+    with pytest.raises(QueryRejected) as e:
+        guard.check_bytes(10 ** 6, "Guest", "test")
+    assert e.value.reason == "bytes"
+    with pytest.raises(QueryRejected):
+        guard.check_bytes(10 ** 6, "Unknown Role", "test")  # unknown roles get the Guest limits
+
+
+def test_guarded_database_run_reports_the_injected_limit_and_returns_rejections(guard, tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'guard.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE shipments (id INTEGER)"))
+        conn.execute(text("INSERT INTO shipments VALUES " + ", ".join(f"({i})" for i in range(50))))
+    db = CachedSQLDatabase(engine, result_cache=SQLResultCache(), dry_run=lambda sql: 10)
+    with guard.active("Guest"):
+        assert "(First 20 rows only: LIMIT 20 was added automatically.)" in db.run("SELECT id FROM shipments")
+        assert db.run_no_throw("SELECT id FROM shipments LIMIT 500").startswith("Error: Query rejected by cost guard")
+    assert len(ast.literal_eval(db.run("SELECT id FROM shipments"))) == 50  # outside the guarded scope
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT *, (SELECT COUNT(*) FROM drivers) AS drivers FROM shipments",
+    "SELECT id FROM shipments WHERE cost > (SELECT AVG(cost) FROM shipments)",
+    "SELECT id, COUNT(*) OVER () AS total FROM shipments",
+    "SELECT COUNT(*) FROM shipments UNION ALL SELECT COUNT(*) FROM drivers",
+    "SELECT origin, n FROM (SELECT origin, COUNT(*) AS n FROM shipments GROUP BY origin)",
+])
+def test_aggregates_below_the_outer_select_list_do_not_skip_the_limit(guard, sql):
+    assert _rewrite(guard, sql)[1] == 20
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT ROUND(AVG(cost), 2), MAX(weight_kg) AS heaviest FROM shipments WHERE status = 'Delayed'",
+    "WITH d AS (SELECT * FROM shipments WHERE status = 'Delayed') SELECT COUNT(*) FROM d",
+    "SELECT COUNT(*) FROM shipments WHERE origin IN (SELECT current_location FROM drivers)",
+])
+def test_outer_single_row_aggregates_are_left_alone(guard, sql):
+    assert _rewrite(guard, sql) == (sql, None)
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM shipments s, (SELECT * FROM drivers WHERE rating > 4) d",
+    "SELECT * FROM (SELECT * FROM shipments WHERE status = 'Delayed') s, drivers d",
+    "SELECT * FROM shipments s, drivers d ORDER BY (SELECT MAX(id) FROM vehicles WHERE status = 'Active')",
+    "SELECT * FROM shipments s, drivers d LIMIT 5",
+    "SELECT * FROM (SELECT * FROM shipments s, drivers d) t WHERE t.id = 1",
+])
+def test_comma_join_needs_a_where_in_its_own_from_clause(guard, sql):
+    with pytest.raises(QueryRejected) as e:
+        _rewrite(guard, sql)
+    assert e.value.reason == "cross_join"
@@ -0,0 +1,77 @@
+import sqlite3
+
+import pandas as pd
+import pytest
+
+from sync import IncrementalSync, SQLiteSyncBackend, diff_rows, merge_statement, row_hashes
+
+
+def _vehicles(**changes):
+    df = pd.DataFrame({"vehicle_id": [1, 2, 3], "status": ["Active", "Active", "Maintenance"],
+                       "fuel_level": [80.0, 40.0, 10.0]})
+    for column, values in changes.items():
+        df[column] = values
+    return df
+
+
+def _table(path, table):
+    with sqlite3.connect(path) as conn:
+        return pd.read_sql(f"SELECT * FROM {table} ORDER BY vehicle_id", conn)
+
+
+def test_diff_rows_finds_inserts_updates_and_deletes():
+    previous = row_hashes(_vehicles(), "vehicle_id")
+    current = pd.concat([_vehicles(fuel_level=[80.0, 35.0, 10.0]).iloc[1:],
+                         pd.DataFrame({"vehicle_id": [4], "status": ["Active"], "fuel_level": [99.0]})])
+    inserted, updated, deleted, _ = diff_rows(current, "vehicle_id", previous)
+    assert inserted["vehicle_id"].tolist() == [4]
+    assert updated["vehicle_id"].tolist() == [2]
+    assert deleted == [1]
+
+
+def test_duplicate_keys_are_rejected():
+    with pytest.raises(ValueError):
+        row_hashes(pd.DataFrame({"vehicle_id": [1, 1]}), "vehicle_id")
+
+
+def test_sqlite_sync_merges_only_the_delta_and_versions_changed_tables(tmp_path):
+    db, state = str(tmp_path / "fleet.db"), str(tmp_path / "state")
+    drivers = pd.DataFrame({"id": [1], "name": ["Ada"]})
+    report = IncrementalSync(SQLiteSyncBackend(db), state).sync({"vehicles": _vehicles(), "drivers": drivers})
+    assert report["vehicles"]["mode"] == "full" and report["vehicles"]["version"] == 1
+
+    # A new instance picks the hashes up from the state directory
+    sync = IncrementalSync(SQLiteSyncBackend(db), state)
+    assert sync.sync_table("vehicles", _vehicles())["mode"] == "unchanged"
+
+    changed = pd.concat([_vehicles(fuel_level=[80.0, 35.0, 10.0]).iloc[1:],
+                         pd.DataFrame({"vehicle_id": [4], "status": ["Active"], "fuel_level": [99.0]})])
+    report = sync.sync({"vehicles": changed, "drivers": drivers})
+    assert {k: report["vehicles"][k] for k in ("mode", "inserted", "updated", "deleted", "version")} == {
+        "mode": "merge", "inserted": 1, "updated": 1, "deleted": 1, "version": 2}
+    assert report["drivers"]["mode"] == "unchanged"
+    assert sync.change_versions() == {"vehicles": 2, "drivers": 1}
+    pd.testing.assert_frame_equal(_table(db, "vehicles"), changed.sort_values("vehicle_id").reset_index(drop=True))
+
+
+def test_failed_merge_keeps_the_previous_state_so_the_next_run_retries(tmp_path):
+    db, state = str(tmp_path / "fleet.db"), str(tmp_path / "state")
+    IncrementalSync(SQLiteSyncBackend(db), state).sync({"vehicles": _vehicles()})
+
+    class FailingBackend(SQLiteSyncBackend):
+        def merge(self, table, key, staged):
+            raise RuntimeError("load job failed")
+
+    updated = _vehicles(fuel_level=[5.0, 40.0, 10.0])
+    with pytest.raises(RuntimeError):
+        IncrementalSync(FailingBackend(db), state).sync({"vehicles": updated})
+    report = IncrementalSync(SQLiteSyncBackend(db), state).sync_table("vehicles", updated)
+    assert (report["mode"], report["updated"], report["version"]) == ("merge", 1, 2)
+    assert _table(db, "vehicles")["fuel_level"].tolist() == [5.0, 40.0, 10.0]
+
+
+def test_merge_statement_deletes_updates_and_inserts():
+    sql = merge_statement("p.d.vehicles", "p.d._staging_vehicles", "vehicle_id", ["vehicle_id", "fuel_level"])
+    assert "ON T.vehicle_id = S.vehicle_id" in sql
+    assert "WHEN MATCHED AND S._deleted THEN DELETE" in sql
+    assert "UPDATE SET fuel_level = S.fuel_level" in sql
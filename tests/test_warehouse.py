@@ -0,0 +1,64 @@
+import threading
+import time
+
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+from cache import DataVersionTracker, SQLResultCache
+from warehouse import CachedSQLDatabase, LocalReplica
+
+
+def _vehicles(fuel):
+    return {"vehicles": pd.DataFrame({"vehicle_id": [1], "fuel_level": [fuel]})}
+
+
+def _wait_for_refresh(replica):
+    deadline = time.monotonic() + 5
+    while replica._refreshing and time.monotonic() < deadline:
+        time.sleep(0.001)
+
+
+def test_background_refresh_carries_the_warehouse_versions(tmp_path):
+    def loader():
+        return _vehicles(10.0), {"vehicles": "2026-01-02T00:00:00+00:00"}
+
+    replica = LocalReplica(str(tmp_path), max_age_seconds=-1, loader=loader)
+    replica.load_frames(_vehicles(50.0), {"vehicles": "2026-01-01T00:00:00+00:00"})
+    assert not replica.can_serve({"vehicles"})  # stale: served by the warehouse, refreshed in the background
+    _wait_for_refresh(replica)
+    assert replica.versions == {"vehicles": "2026-01-02T00:00:00+00:00"}
+
+
+def test_refresh_is_started_once_while_one_is_running(tmp_path):
+    release, calls = threading.Event(), []
+
+    def loader():
+        calls.append(1)
+        release.wait(5)
+        return _vehicles(10.0), {}
+
+    replica = LocalReplica(str(tmp_path), loader=loader)
+    for _ in range(5):
+        replica.refresh_in_background()
+    release.set()
+    _wait_for_refresh(replica)
+    assert len(calls) == 1
+
+
+def test_replica_reads_are_cached_under_the_replica_version(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'warehouse.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE vehicles (vehicle_id INTEGER, fuel_level REAL)"))
+        conn.execute(text("INSERT INTO vehicles VALUES (1, 10)"))
+    replica = LocalReplica(str(tmp_path))
+    replica.load_frames(_vehicles(50.0), {"vehicles": "v1"})
+    # The warehouse is already at v2; the replica still holds v1
+    db = CachedSQLDatabase(engine, result_cache=SQLResultCache(), replica=replica,
+                           table_versions=DataVersionTracker(lambda: {"vehicles": "v2"}, check_interval=3600))
+    sql = "SELECT fuel_level FROM vehicles"
+    assert db.fetch_rows(sql) == [{"fuel_level": 50.0}]
+    assert db.routing["replica"] == 1
+
+    replica.load_frames(_vehicles(10.0), {"vehicles": "v2"})
+    assert db.fetch_rows(sql) == [{"fuel_level": 10.0}]
+    assert db.routing["replica"] == 2
@@ -1,32 +1,37 @@
 import os
+import argparse
 import pandas as pd
 from google.cloud import bigquery
 from google.oauth2 import service_account
 from datetime import datetime, timedelta
+from schema_snapshot import build_snapshot
+from kpis import KPIStore
+from sync import SYNC_STATE_DIR, BigQuerySyncBackend, IncrementalSync, SQLiteSyncBackend, write_replica_snapshot
 
 # --- CONFIGURATION ---
 PROJECT_ID = "inspiring-keel-423204-c7"
 DATASET_ID = "logistics_control_tower"
 SERVICE_ACCOUNT_FILE = "service-account.json"
+# Schema snapshot loaded by agents.py (root for local runs, backend/ ships with the function)
+SCHEMA_SNAPSHOT_PATHS = ["schema_snapshot.json", os.path.join("backend", "schema_snapshot.json")]
+# Parquet replica loaded by agents.py when WAREHOUSE_BACKEND is "hybrid" or "replica"
+REPLICA_DIRS = ["replica", os.path.join("backend", "replica")]
+# Precomputed KPI aggregates served by /kpis and the analyst's KPI shortcut
+KPI_STORE_PATHS = ["kpis.json", os.path.join("backend", "kpis.json")]
 
-def update_data():
-    if not os.path.exists(SERVICE_ACCOUNT_FILE):
-        print(f"Error: {SERVICE_ACCOUNT_FILE} not found.")
-        return
-
-    credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE)
-    client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
-    dataset_ref = client.dataset(DATASET_ID)
-
+def build_datasets():
+    """Returns the seed tables as {table_name: DataFrame}."""
+    # Delivery dates are relative to midnight, so re-running on the same day produces no changes to sync
+    now = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
     # 1. Enhanced Shipments Data
     shipments_data = [
-        {"id": 10, "origin": "London", "destination": "Paris", "status": "In Transit", "priority": "High", "cost": 1200.50, "revenue": 1800.00, "weight_kg": 500.5, "cargo_type": "Electronics", "customer_name": "Tech Corp", "delivery_date": datetime.now() + timedelta(days=1), "insurance_status": True},
-        {"id": 11, "origin": "London", "destination": "Berlin", "status": "In Transit", "priority": "Standard", "cost": 1100.00, "revenue": 1600.00, "weight_kg": 800.0, "cargo_type": "Apparel", "customer_name": "Nordic Style", "delivery_date": datetime.now() + timedelta(days=2), "insurance_status": True},
-        {"id": 14, "origin": "Wrightview", "destination": "New Donport", "status": "Delayed", "priority": "Standard", "cost": 850.00, "revenue": 1200.00, "weight_kg": 1200.0, "cargo_type": "Furniture", "customer_name": "Home Furnishings", "delivery_date": datetime.now() + timedelta(days=3), "insurance_status": False},
-        {"id": 22, "origin": "Delhi", "destination": "Mumbai", "status": "Delivered", "priority": "Urgent", "cost": 3400.00, "revenue": 5000.00, "weight_kg": 2500.0, "cargo_type": "Medical Supplies", "customer_name": "Health Plus", "delivery_date": datetime.now() - timedelta(days=1), "insurance_status": True},
-        {"id": 35, "origin": "New York", "destination": "Chicago", "status": "Pending", "priority": "High", "cost": 950.00, "revenue": 1500.00, "weight_kg": 800.0, "cargo_type": "Textiles", "customer_name": "Fashion Hub", "delivery_date": datetime.now() + timedelta(days=2), "insurance_status": True},
-        {"id": 42, "origin": "Berlin", "destination": "Madrid", "status": "In Transit", "priority": "Standard", "cost": 1500.00, "revenue": 2200.00, "weight_kg": 1500.0, "cargo_type": "Machinery", "customer_name": "Auto Parts Ltd", "delivery_date": datetime.now() + timedelta(days=4), "insurance_status": True},
-        {"id": 50, "origin": "Tokyo", "destination": "Seoul", "status": "Delayed", "priority": "High", "cost": 2100.00, "revenue": 3200.00, "weight_kg": 600.0, "cargo_type": "Robotics", "customer_name": "Future Automation", "delivery_date": datetime.now() + timedelta(days=1), "insurance_status": True}
+        {"id": 10, "origin": "London", "destination": "Paris", "status": "In Transit", "priority": "High", "cost": 1200.50, "revenue": 1800.00, "weight_kg": 500.5, "cargo_type": "Electronics", "customer_name": "Tech Corp", "delivery_date": now + timedelta(days=1), "insurance_status": True},
+        {"id": 11, "origin": "London", "destination": "Berlin", "status": "In Transit", "priority": "Standard", "cost": 1100.00, "revenue": 1600.00, "weight_kg": 800.0, "cargo_type": "Apparel", "customer_name": "Nordic Style", "delivery_date": now + timedelta(days=2), "insurance_status": True},
+        {"id": 14, "origin": "Wrightview", "destination": "New Donport", "status": "Delayed", "priority": "Standard", "cost": 850.00, "revenue": 1200.00, "weight_kg": 1200.0, "cargo_type": "Furniture", "customer_name": "Home Furnishings", "delivery_date": now + timedelta(days=3), "insurance_status": False},
+        {"id": 22, "origin": "Delhi", "destination": "Mumbai", "status": "Delivered", "priority": "Urgent", "cost": 3400.00, "revenue": 5000.00, "weight_kg": 2500.0, "cargo_type": "Medical Supplies", "customer_name": "Health Plus", "delivery_date": now - timedelta(days=1), "insurance_status": True},
+        {"id": 35, "origin": "New York", "destination": "Chicago", "status": "Pending", "priority": "High", "cost": 950.00, "revenue": 1500.00, "weight_kg": 800.0, "cargo_type": "Textiles", "customer_name": "Fashion Hub", "delivery_date": now + timedelta(days=2), "insurance_status": True},
+        {"id": 42, "origin": "Berlin", "destination": "Madrid", "status": "In Transit", "priority": "Standard", "cost": 1500.00, "revenue": 2200.00, "weight_kg": 1500.0, "cargo_type": "Machinery", "customer_name": "Auto Parts Ltd", "delivery_date": now + timedelta(days=4), "insurance_status": True},
+        {"id": 50, "origin": "Tokyo", "destination": "Seoul", "status": "Delayed", "priority": "High", "cost": 2100.00, "revenue": 3200.00, "weight_kg": 600.0, "cargo_type": "Robotics", "customer_name": "Future Automation", "delivery_date": now + timedelta(days=1), "insurance_status": True}
     ]
     df_shipments = pd.DataFrame(shipments_data)
 
@@ -49,18 +54,57 @@ def update_data():
     ]
     df_vehicles = pd.DataFrame(vehicles_data)
 
-    datasets = {
+    return {
         "shipments": df_shipments,
         "drivers": df_drivers,
         "vehicles": df_vehicles
     }
 
-    for table_name, df in datasets.items():
-        print(f"Updating {table_name}...")
-        table_ref = dataset_ref.table(table_name)
-        job_config = bigquery.LoadJobConfig(write_disposition="WRITE_TRUNCATE")
-        client.load_table_from_dataframe(df, table_ref, job_config=job_config).result()
-        print(f"Successfully updated {table_name}.")
+def update_data(full=False, local_db=None):
+    datasets = build_datasets()
+
+    # Offline stand-in: the same incremental sync against a local SQLite database
+    if local_db:
+        state_dir = os.path.splitext(local_db)[0] + "_sync_state"
+        IncrementalSync(SQLiteSyncBackend(local_db), state_dir).sync(datasets, full=full)
+        return
+
+    if not os.path.exists(SERVICE_ACCOUNT_FILE):
+        print(f"Error: {SERVICE_ACCOUNT_FILE} not found.")
+        return
+
+    credentials = service_account.Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE)
+    client = bigquery.Client(credentials=credentials, project=PROJECT_ID)
+    dataset_ref = client.dataset(DATASET_ID)
+
+    # Only inserted/updated/deleted rows are staged and MERGEd; unchanged tables keep their
+    # modification time, so cached results that depend on them stay valid
+    report = IncrementalSync(BigQuerySyncBackend(client, dataset_ref), SYNC_STATE_DIR).sync(datasets, full=full)
+    changed = [t for t, r in report.items() if r["mode"] != "unchanged"]
+    print(f"Changed tables: {', '.join(changed) or 'none'}.")
+
+    # Refresh the schema snapshot so deployed agents see new columns without live reflection
+    snapshot = build_snapshot(client, PROJECT_ID, DATASET_ID, list(datasets))
+    for path in SCHEMA_SNAPSHOT_PATHS:
+        snapshot.save(path)
+    print(f"Schema snapshot {snapshot.version} written to {', '.join(SCHEMA_SNAPSHOT_PATHS)}.")
+
+    # Local replica snapshot, stamped with the BigQuery table versions it was taken at
+    versions = {t: client.get_table(dataset_ref.table(t)).modified.isoformat() for t in datasets}
+    for replica_dir in REPLICA_DIRS:
+        write_replica_snapshot(datasets, replica_dir, versions)
+    print(f"Local replica written to {', '.join(REPLICA_DIRS)}.")
+
+    # KPI aggregates: only those whose source tables got a new version are recomputed
+    kpis = KPIStore.load(KPI_STORE_PATHS[0])
+    changed = kpis.refresh(datasets, versions)
+    for path in KPI_STORE_PATHS:
+        kpis.save(path)
+    print(f"KPI aggregates written to {', '.join(KPI_STORE_PATHS)} ({len(changed)} recomputed).")
 
 if __name__ == "__main__":
-    update_data()
+    parser = argparse.ArgumentParser(description="Refresh the warehouse tables, schema snapshot, replica and KPIs.")
+    parser.add_argument("--full", action="store_true", help="Reload every table with WRITE_TRUNCATE instead of a MERGE of changed rows")
+    parser.add_argument("--local", metavar="SQLITE_DB", help="Sync into a local SQLite database instead of BigQuery")
+    args = parser.parse_args()
+    update_data(full=args.full, local_db=args.local)